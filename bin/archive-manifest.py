@@ -12,17 +12,16 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --jobs N            Number of processes to read archives with [default: 1]
 """
 
-import datman
-import datman.utils
-import pydicom
-import tarfile
-import zipfile
-import io
-import os.path
-import StringIO
+import sys
+
 import pandas as pd
+from docopt import docopt
+
+import datman.utils
+import datman.header_cache
 
 default_headers=[
     'StudyDescription',
@@ -32,28 +31,35 @@ default_headers=[
     'SeriesDescription']
 
 def main():
-    from docopt import docopt
-    import sys
     arguments = docopt(__doc__)
+    jobs = int(arguments['--jobs'])
 
     if arguments['--showheaders']:
-        for archive in arguments['<archive>']:
-            manifest = datman.utils.get_archive_headers(archive,
-                                                        stop_after_first=False)
-            filepath, headers = manifest.items()[0]
-            print ",".join([archive,filepath])
-            print "\t"+"\n\t".join(headers.dir())
+        scans = datman.utils.scan_archives(arguments['<archive>'], workers=jobs,
+                                           stop_after_first=False)
+        for archive, manifest, error in scans:
+            if error:
+                sys.stderr.write("{}: {}\n".format(archive, error))
+                continue
+            filepath, headers = next(iter(manifest.items()))
+            print(",".join([archive,filepath]))
+            print("\t"+"\n\t".join(headers.dir()))
         return
 
     headers = arguments['--headers'] and arguments['--headers'].split(',') or \
                 default_headers[:]
+    tags = headers + ['SeriesNumber']
     headers.insert(0,"Path")
 
     rows = []
-    for archive in arguments['<archive>']:
-        manifest = datman.utils.get_archive_headers(archive)
-        sortedseries = sorted(manifest.iteritems(),
-                              key = lambda x: x[1].get('SeriesNumber'))
+    scans = datman.utils.scan_archives(
+            arguments['<archive>'], workers=jobs, tags=tags,
+            reader=datman.header_cache.get_archive_headers)
+    for archive, manifest, error in scans:
+        if error:
+            sys.stderr.write("{}: {}\n".format(archive, error))
+            continue
+        sortedseries = sorted(manifest.items(), key=series_number)
         for path, dataset in sortedseries:
             row = dict([(header,dataset.get(header,"")) for header in headers])
             row['Path'] = path
@@ -61,7 +67,12 @@ def main():
             if arguments['--oneseries']: break
 
     data = pd.DataFrame(rows)
-    print data.to_csv(index=False)
+    print(data.to_csv(index=False))
+
+def series_number(item):
+    """Sort key for (path, headers) items that puts unnumbered series first"""
+    number = item[1].get('SeriesNumber')
+    return (number is not None, number or 0)
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,9 @@ Usage:
 
 Options:
     --show-newer     Show data files newer than QC doc
+    --full           Read every session folder again instead of only those
+                     that changed since the last run. Needed to notice data
+                     files that were rewritten in place.
     --root PATH      Path to parent folder to all study folders.
                      [default: /archive/data-2.0]
     --study=<study>  Process a singe study
@@ -14,6 +17,11 @@ Options:
 Expects to be run in the parent folder to all study folders. Looks for the file
 checklist.csv in subfolders, and prints out any QC pdf from those that haven't
 been signed off on.
+
+Sessions are found through the QC index in each study's metadata folder, which
+only looks inside a session's nii folder when the folder's own modification
+time has changed. A .nii.gz that is rewritten in place doesn't change it, so
+--show-newer won't report it unless --full is given.
 """
 
 import docopt
@@ -22,26 +30,7 @@ import os
 import os.path
 import re
 import datman.config as config
-
-def read_checklist(checklist_file):
-    checklist_dict = {}
-
-    with open(checklist_file) as checklist:
-        lines = checklist.readlines()
-
-    for line in lines:
-        entry = line.strip().split()
-        try:
-            key = os.path.splitext(entry[0])[0]
-        except:
-            # Empty line, skip it
-            continue
-        try:
-            rest = entry[1:]
-        except:
-            entry = ''
-        checklist_dict[key] = rest
-    return checklist_dict
+import datman.qc_index
 
 def get_project_dirs(root, maxdepth=2):
     """
@@ -94,36 +83,42 @@ def main():
     for projectdir in get_project_dirs(rootdir):
         checklist = os.path.join(projectdir, 'metadata', 'checklist.csv')
 
-        checklistdict = read_checklist(checklist)
+        index = datman.qc_index.QCIndex(
+                os.path.join(projectdir, 'metadata', datman.qc_index.INDEX_NAME),
+                os.path.join(projectdir, 'data', 'nii'),
+                os.path.join(projectdir, 'qc'), checklist)
+        index.update(full=arguments['--full'])
+        index.save()
 
-        for timepointdir in sorted(glob.glob(projectdir + '/data/nii/*')):
-            if '_PHA_' in timepointdir:
+        for timepoint, state in sorted(index.subjects.items()):
+            if '_PHA_' in timepoint:
                 continue
 
-            timepoint = os.path.basename(timepointdir)
-            qcdocname = 'qc_' + timepoint
-            qcdoc = os.path.join(projectdir, 'qc', timepoint, (qcdocname + '.html'))
-
-            data_mtime = max(map(get_mtime, glob.glob(timepointdir + '/*.nii.gz')+[timepointdir]))
+            timepointdir = os.path.join(projectdir, 'data', 'nii', timepoint)
+            qcdoc = os.path.join(projectdir, 'qc', timepoint,
+                    'qc_{}.html'.format(timepoint))
+            data_mtime = state['data_mtime']
+            qcdoc_mtime = state['report_mtime']
 
             # notify about missing QC reports or those with no checklist entry
-            if qcdocname not in checklistdict:
+            if state['checklist'] is None:
                 print('No checklist entry for {}'.format(timepointdir))
                 continue
-            elif not os.path.exists(qcdoc):
+            elif qcdoc_mtime is None:
                 print('No QC doc generated for {}'.format(timepointdir))
                 continue
 
             # find QC documents that are older than the most recent data export
-            if arguments['--show-newer'] and data_mtime > os.path.getmtime(qcdoc):
-                newer = filter(lambda x: os.path.getmtime(x) > os.path.getmtime(qcdoc), glob.glob(timepointdir + '/*'))
+            if arguments['--show-newer'] and data_mtime > qcdoc_mtime:
+                newer = [x for x in glob.glob(timepointdir + '/*')
+                         if get_mtime(x) > qcdoc_mtime]
                 if newer != []:
-                    print('{}: QC doc is older than data in folder {} {} {}'.format(qcdoc, timepointdir, data_mtime, os.path.getmtime(qcdoc)))
+                    print('{}: QC doc is older than data in folder {} {} {}'.format(qcdoc, timepointdir, data_mtime, qcdoc_mtime))
                     print('\t' + '\n\t'.join(newer))
 
             # notify about unchecked QC reports
-            if not checklistdict[qcdocname]:
-                print '{}: QC doc not signed off on'.format(qcdoc)
+            if not state['checklist']:
+                print('{}: QC doc not signed off on'.format(qcdoc))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Warms or inspects the archive header cache shared by the datman scripts.
+
+Usage:
+    dm_header_cache.py [options] warm <archive>...
+    dm_header_cache.py [options] show <archive>...
+    dm_header_cache.py [options] stats
+    dm_header_cache.py [options] prune
+
+Arguments:
+    <archive>           Exam archive (zip or tarball)
+
+Commands:
+    warm                Read the headers of each archive that isn't already
+                        cached (or has changed since it was)
+    show                Print the cached headers of each archive as csv,
+                        reading any that aren't cached
+    stats               Print the number of archives in the cache
+    prune               Remove entries for archives that no longer exist
+
+Options:
+    --cache FILE        Path to the cache file. Overrides DM_HEADER_CACHE
+    -v --verbose
+    -d --debug
+    -q --quiet
+
+DETAILS
+    The cache holds a few header fields (see datman.header_cache.FIELDS) from
+    one dicom in each series of an archive. Entries are keyed by the real path,
+    size and modification time of the archive so that changed archives are
+    read again. By default the cache is stored in
+    ~/.cache/datman/archive_headers.sqlite.
+"""
+import os
+import sys
+import logging
+
+import pandas as pd
+from docopt import docopt
+
+import datman.header_cache
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def main():
+    arguments = docopt(__doc__)
+    archives = arguments['<archive>']
+    cache_file = arguments['--cache']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+    quiet = arguments['--quiet']
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    if quiet:
+        logger.setLevel(logging.ERROR)
+
+    if not cache_file:
+        cache_file = datman.header_cache.get_cache_path()
+    if not cache_file:
+        logger.error('Header cache is turned off, set DM_HEADER_CACHE or '
+                     'use --cache')
+        sys.exit(1)
+    cache = datman.header_cache.HeaderCache(cache_file)
+
+    if arguments['warm']:
+        for archive in archives:
+            logger.info('Reading {}'.format(archive))
+            try:
+                cache.get_archive_headers(archive)
+            except Exception as e:
+                logger.error('Cant read headers from {}. Reason: {}'.format(
+                        archive, e))
+    elif arguments['show']:
+        rows = []
+        for archive in archives:
+            headers = cache.get_archive_headers(archive)
+            for path, header in headers.items():
+                row = dict(header)
+                row['Archive'] = archive
+                row['Path'] = path
+                rows.append(row)
+        columns = ['Archive', 'Path'] + datman.header_cache.FIELDS
+        print(pd.DataFrame(rows, columns=columns).to_csv(index=False))
+    elif arguments['prune']:
+        removed = cache.prune()
+        logger.info('Removed {} entries'.format(removed))
+
+    stats = cache.stats()
+    if arguments['stats']:
+        print('{}: {} archives'.format(cache_file, stats['entries']))
+    logger.info('Cache hits: {}, misses: {}'.format(stats['hits'],
+                                                    stats['misses']))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,8 @@ Options:
                                 overrides metadata/manifest.csv
     --scanid-field STR       Dicom field to match target_name with
                              [default: PatientName]
+    --jobs N                 Number of processes to read archive headers
+                             with [default: 1]
     -v --verbose             Verbose logging
     -d --debug                  Debug logging
     -q --quiet             Less debuggering
@@ -78,6 +80,7 @@ import pandas as pd
 import datman.config
 import datman.utils
 import datman.scanid
+import datman.header_cache
 import logging
 
 logger = logging.getLogger(os.path.basename(__file__))
@@ -86,6 +89,8 @@ dm_logger = logging.getLogger('datman')
 already_linked = {}
 lookup = None
 DRYRUN = None
+# archive path -> headers of its first dicom, read up front by scan_headers()
+scanned_headers = {}
 
 dtypes = {'source_name':'object',
         'PatientID':'object',
@@ -119,6 +124,7 @@ def main():
     lookup_path = arguments['--lookup']
     scanid_field = arguments['--scanid-field']
     zipfile = arguments['<zipfile>']
+    jobs = int(arguments['--jobs'])
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -193,10 +199,32 @@ def main():
                     if os.path.splitext(archive)[1] == '.zip']
 
     logger.info('Found {} archives'.format(len(archives)))
+    scan_headers(archives, scanid_field, jobs)
     for archive in archives:
         link_archive(archive, dicom_path, scanid_field, cfg)
 
 
+def scan_headers(archives, scanid_field, jobs):
+    """
+    Reads the headers link_archive() will need from every archive that isn't
+    linked yet, using jobs processes.
+    """
+    global scanned_headers
+    archives = [archive for archive in archives
+                if os.path.isfile(archive) and
+                os.path.realpath(archive) not in already_linked]
+    tags = [scanid_field] + [c.split("_")[1] for c in lookup.columns
+                             if c.startswith('dicom_')]
+    scans = datman.utils.scan_archives(
+            archives, workers=jobs, stop_after_first=True, tags=tags,
+            reader=datman.header_cache.get_archive_headers)
+    for scan in scans:
+        if scan.error:
+            # leave it to get_archive_headers() to report
+            continue
+        scanned_headers[scan.path] = scan.headers
+
+
 def link_archive(archive_path, dicom_path, scanid_field, config):
     if not os.path.isfile(archive_path):
         logger.error('Archive {} not found'.format(archive_path))
@@ -280,13 +308,16 @@ def get_scanid_from_lookup_table(archive_path):
         return (scanid, lookupinfo)
 
 
-def get_archive_headers(archive_path):
+def get_archive_headers(archive_path, tags=None):
     # get some DICOM headers from the archive
     header = None
     try:
-        header = datman.utils.get_archive_headers(archive_path,
-                                                  stop_after_first=True)
-        header = header.values()[0]
+        if archive_path in scanned_headers:
+            header = scanned_headers[archive_path]
+        else:
+            header = datman.header_cache.get_archive_headers(
+                    archive_path, stop_after_first=True, tags=tags)
+        header = list(header.values())[0]
     except:
         logger.warn("Archive: {} contains no DICOMs".format(archive_path))
     return header
@@ -299,7 +330,7 @@ def get_scanid_from_header(archive_path, scanid_field):
     Returns None if the header field isn't present or the value isn't a proper
     scan ID.
     """
-    header = get_archive_headers(archive_path)
+    header = get_archive_headers(archive_path, tags=[scanid_field])
     if not header:
         return False
     if scanid_field not in header:
@@ -324,13 +355,14 @@ def validate_headers(archive_path, lookupinfo, scanid_field):
 
     Checks that all dicom_* dicom header fields match the lookup table
     """
-    header = get_archive_headers(archive_path)
-    if not header:
-        return False
-
     columns = lookupinfo.columns.values.tolist()
     dicom_cols = [c for c in columns if c.startswith('dicom_')]
 
+    header = get_archive_headers(archive_path,
+                                 tags=[c.split("_")[1] for c in dicom_cols])
+    if not header:
+        return False
+
     for c in dicom_cols:
         f = c.split("_")[1]
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 """
 Generates quality control reports on defined MRI data types. If no subject is
-given, all subjects are submitted individually to the queue.
+given, all new subjects are submitted to the queue (or run locally with
+--local-workers).
 
 usage:
     dm-qc-report.py [options] <study>
-    dm-qc-report.py [options] <study> <session>
+    dm-qc-report.py [options] <study> <session>...
 
 Arguments:
     <study>           Name of the study to process e.g. ANDT
@@ -13,6 +14,12 @@ Arguments:
 
 Options:
     --rewrite          Rewrite the html of an existing qc page
+    --local-workers N  Run QC for all new subjects in this process, using N
+                       worker processes, instead of submitting jobs to the
+                       queue
+    --batch-size K     Number of subjects to QC in each queued job. If more
+                       than one, human subjects are submitted as a single
+                       array job [default: 1]
     --log-to-server    If set, all log messages will also be sent to the configured logging server. This is useful when the script is run with the Sun Grid Engine, since it swallows logging messages.
     -q --quiet         Only report errors
     -v --verbose       Be chatty
@@ -92,12 +99,17 @@ import logging.handlers
 import copy
 import random
 import string
+import concurrent.futures
 
 import numpy as np
 import pandas as pd
 import nibabel as nib
 
 import datman.config
+import datman.header_checks
+import datman.metadata
+import datman.montage
+import datman.qc_index
 import datman.utils
 import datman.scanid
 import datman.scan
@@ -120,13 +132,17 @@ def random_str(n):
 
 def slicer(fpath, pic, slicergap, picwidth):
     """
-    Uses FSL's slicer function to generate a montage png from a nifti file
+    Generates a montage png from a nifti file, laid out like FSL's slicer -S
         fpath       -- submitted image file name
         slicergap   -- int of "gap" between slices in Montage
         picwidth    -- width (in pixels) of output image
         pic         -- fullpath to for output image
     """
-    datman.utils.run("slicer {} -S {} {} {}".format(fpath,slicergap,picwidth,pic))
+    try:
+        datman.montage.slicer(fpath, pic, slicergap, picwidth)
+    except Exception as e:
+        logger.error("Failed to make montage of {}. Reason: {}".format(fpath,
+                e))
 
 def add_image(qc_html, image, title=None):
     """
@@ -291,20 +307,41 @@ def submit_qc_jobs(commands, chained=False):
         elif out:
             logger.debug(out)
 
+def submit_qc_array_job(commands):
+    """
+    Submits the given commands to the queue as one array job, with one task
+    per command.
+    """
+    jobname = "qc_report_{}_{}".format(time.strftime("%Y%m%d"), random_str(5))
+    logfile = '/tmp/{}.$TASK_ID.log'.format(jobname)
+    errfile = '/tmp/{}.$TASK_ID.err'.format(jobname)
+
+    job_file = make_job_file(jobname, datman.utils.make_array_job(commands))
+
+    run_cmd = "qsub -V -q main.q -t 1-{} -o '{}' -e '{}' -N {} {}".format(
+            len(commands), logfile, errfile, jobname, job_file)
+
+    rtn, out = datman.utils.run(run_cmd, specialquote=False)
+
+    if rtn:
+        logger.error("stdout: {}".format(out))
+    elif out:
+        logger.debug(out)
+
 def make_job_file(job_name, cmd):
     job_file = '/tmp/{}'.format(job_name)
-    with open(job_file, 'wb') as fid:
+    with open(job_file, 'w') as fid:
         fid.write('#!/bin/bash\n')
         fid.write(cmd)
     return job_file
 
-def make_qc_command(subject_id, study):
+def make_qc_command(subject_ids, study):
     arguments = docopt(__doc__)
     use_server = arguments['--log-to-server']
     verbose = arguments['--verbose']
     debug = arguments['--debug']
     quiet = arguments['--quiet']
-    command = " ".join([__file__, study, subject_id])
+    command = " ".join([__file__, study] + subject_ids)
     if verbose:
         command = " ".join([command, '-v'])
     if debug:
@@ -319,102 +356,127 @@ def make_qc_command(subject_id, study):
 
     return command
 
-def qc_all_scans(config):
+def qc_all_scans(config, batch_size=1, local_workers=None):
     """
-    Creates a dm-qc-report.py command for each scan and submits all jobs to the
-    queue. Phantom jobs are submitted in chained mode, which means they will run
+    Creates a dm-qc-report.py command for each batch of new scans and submits
+    all jobs to the queue, or runs them in this process if local_workers is
+    set. Phantom jobs are submitted in chained mode, which means they will run
     one at a time. This is currently needed because some of the phantom pipelines
     use expensive and limited software liscenses (i.e., MATLAB).
     """
-    human_commands = []
-    phantom_commands = []
-
     new_subs = get_new_subjects(config)
 
-    for subject in new_subs:
-        command = make_qc_command(subject, config.study_name)
+    humans = [subject for subject in new_subs if '_PHA_' not in subject]
+    phantoms = [subject for subject in new_subs if '_PHA_' in subject]
 
-        if '_PHA_' in subject:
-            phantom_commands.append(command)
-        else:
-            human_commands.append(command)
+    if local_workers:
+        qc_locally(humans, phantoms, config, local_workers)
+        return
+
+    human_commands = [make_qc_command(subjects, config.study_name) for
+                      subjects in datman.utils.make_batches(humans, batch_size)]
+    phantom_commands = [make_qc_command(subjects, config.study_name) for
+                        subjects in datman.utils.make_batches(phantoms,
+                                                              batch_size)]
 
     if human_commands:
         logger.debug('submitting human qc jobs\n{}'.format(human_commands))
-        submit_qc_jobs(human_commands)
+        if batch_size > 1:
+            submit_qc_array_job(human_commands)
+        else:
+            submit_qc_jobs(human_commands)
 
     if phantom_commands:
         logger.debug('running phantom qc jobs\n{}'.format(phantom_commands))
         submit_qc_jobs(phantom_commands, chained=True)
 
-def get_new_subjects(config):
-    qc_dir = config.get_path('qc')
-    nii_dir = config.get_path('nii')
-
-    subject_nii_dirs = glob.glob(os.path.join(nii_dir, '*'))
-    all_subs = [os.path.basename(path) for path in subject_nii_dirs]
+def qc_locally(humans, phantoms, config, workers):
+    """
+    Runs QC for the given subjects without the queue. Human subjects are
+    spread over a pool of worker processes, which share this process' config.
+    Phantoms are run one at a time in this process (see qc_all_scans).
 
-    if REWRITE:
-        return all_subs
-
-    # Finished subjects are those that have an html file in their qc output dir
-    html_pages = glob.glob(os.path.join(qc_dir, '*/*.html'))
-    subject_qc_dirs = [os.path.dirname(qc_path) for qc_path in html_pages]
-    finished_subs = [os.path.basename(path) for path in subject_qc_dirs]
-
-    # Finished phantoms are those that have a non-empty folder
-    # (so if qc outputs are missing, delete the folder to get it to re-run!)
-    qced_phantoms_paths = [subj for subj in glob.glob(os.path.join(qc_dir, '*_PHA_*'))
-            if len(os.listdir(subj)) > 0]
-    finished_phantoms = [os.path.basename(path) for path in qced_phantoms_paths]
-
-    new_subs = filter(lambda sub: sub not in finished_subs, all_subs)
-    # also filter out the finished phantoms
-    new_subs = filter(lambda sub: sub not in finished_phantoms, new_subs)
-    return new_subs
-
-def find_existing_reports(checklist_path):
-    found_reports = []
-    with open(checklist_path, 'r') as checklist:
-        for checklist_entry in checklist:
-            checklist_entry = checklist_entry.split(' ')[0].strip()
-            checklist_entry, checklist_ext = os.path.splitext(checklist_entry)
-            found_reports.append(checklist_entry)
-    return found_reports
-
-def add_report_to_checklist(qc_report, checklist_path, retry=3):
+    Returns the ids of the subjects that failed.
     """
-    Add the given report's name to the QC checklist if it is not already
-    present.
+    global _worker_config, _worker_rewrite
+    # Set before the pool is created so the forked workers inherit them
+    # (ProcessPoolExecutor only takes an initializer from python 3.7 on)
+    _worker_config = config
+    _worker_rewrite = REWRITE
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_worker_qc, subject_id): subject_id
+                   for subject_id in humans}
+
+        for subject_id in phantoms:
+            if not run_qc(subject_id, config, REWRITE):
+                failed.append(subject_id)
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                logger.error("QC worker failed for {}. Reason: {}".format(
+                        futures[future], e))
+                succeeded = False
+            if not succeeded:
+                failed.append(futures[future])
+
+    if failed:
+        logger.error("QC failed for {} of {} subjects: {}".format(len(failed),
+                len(humans) + len(phantoms), ", ".join(failed)))
+    return failed
+
+_worker_config = None
+_worker_rewrite = False
+
+def run_worker_qc(subject_id):
+    return run_qc(subject_id, _worker_config, _worker_rewrite)
+
+def run_qc(subject_id, config, rewrite):
     """
-    if not qc_report or retry == 0:
-        return
-
-    # remove extension from report name, so we don't double-count .pdfs vs .html
-    report_file_name = os.path.basename(qc_report)
-    report_name, report_ext = os.path.splitext(report_file_name)
+    Runs QC for one subject. Returns False if it failed.
 
+    REWRITE is reset first, since check_for_repeat_session may turn it on
+    for a single subject and the process may go on to QC others.
+    """
+    global REWRITE
+    REWRITE = rewrite
     try:
-        found_reports = find_existing_reports(checklist_path)
-    except IOError:
-        logger.info("{} does not exist. "\
-                "Attempting to create it".format(checklist_path))
-        found_reports = []
+        subject = prepare_scan(subject_id, config)
+        qc_single_scan(subject, config)
+    except (Exception, SystemExit) as e:
+        logger.error("QC failed for {}. Reason: {}".format(subject_id, e),
+                exc_info=not isinstance(e, SystemExit))
+        return False
+    return True
+
+def get_new_subjects(config):
+    """
+    Returns the subjects that need QC, using the study's QC index (see
+    datman.qc_index) to avoid searching the nii and qc folders again.
 
-    if report_name in found_reports:
+    Finished subjects are those that have an html file in their qc output dir.
+    Finished phantoms are those that have a non-empty folder (so if qc outputs
+    are missing, delete the folder to get it to re-run!)
+    """
+    index = datman.qc_index.get_index(config)
+    return index.get_new_subjects(rewrite=REWRITE)
+
+def add_report_to_checklist(qc_report, checklist_path):
+    """
+    Add the given report's name to the QC checklist if it is not already
+    present (with any extension, so we don't double-count .pdfs vs .html).
+    """
+    if not qc_report:
         return
 
     try:
-        with open(checklist_path, 'a') as checklist:
-            checklist.write(report_file_name + '\n')
-    except:
-        logger.error("Failed to write {} to checklist. Tries remaining: "
-                "{}".format(report_file_name, retry))
-        # Sleep for a short time to shuffle processes that are attempting
-        # concurrent writes.
-        wait_time = random.uniform(0, 10)
-        time.sleep(wait_time)
-        add_report_to_checklist(qc_report, checklist_path, retry=retry-1)
+        datman.metadata.add_to_checklist(checklist_path, [qc_report])
+    except (IOError, OSError) as e:
+        logger.error("Failed to write {} to checklist. Reason: {}".format(
+                os.path.basename(qc_report), e))
 
 def add_header_qc(nifti, qc_html, log_path):
     """
@@ -786,20 +848,18 @@ def get_standards(standard_dir, site):
 def run_header_qc(subject, standard_dir, log_file, config):
     """
     For each .dcm file found in 'dicoms', find the matching site / tag file in
-    'standards', and run qc-headers (from qcmon) on these files. Any
-    are written to log_file.
+    'standards' and compare their headers. Any differences are written to
+    log_file.
     """
 
     if not subject.dicoms:
         logger.debug("No dicoms found in {}".format(subject.dcm_path))
         return
 
-
-
-    standards_dict = get_standards(standard_dir, subject.site)
+    standards_dict = datman.header_checks.get_standard_map(standard_dir,
+            subject.site, get_standards)
     tag_settings=config.get_tags(site=subject.site)
 
-
     for dicom in subject.dicoms:
         try:
             standard = standards_dict[dicom.tag]
@@ -807,18 +867,19 @@ def run_header_qc(subject, standard_dir, log_file, config):
             logger.debug('No standard with tag {} found in {}'.format(dicom.tag,
                     standard_dir))
             continue
-        else:
-            #run header check for dicom
-            #if the scan is dti, call qc-headers with the dti tag
-            if tag_settings.get(dicom.tag, "qc_type") == 'dti':
-                datman.utils.run('qc-headers {} {} {} --dti'.format(dicom.path, standard.path,
-                        log_file))
-                logger.debug('doing dti {}'.format(dicom.tag))
-            else:
-                logger.debug('doing other scantype {}'.format(dicom.tag))
-                datman.utils.run('qc-headers {} {} {}'.format(dicom.path, standard.path,
-                        log_file))
 
+        # if the scan is dti, compare the bvals too
+        dti = tag_settings.get(dicom.tag, "qc_type") == 'dti'
+        logger.debug('Comparing headers of {} to {}{}'.format(dicom.path,
+                standard.path, ' (dti)' if dti else ''))
+        try:
+            diffs = datman.header_checks.compare_files(dicom.path,
+                    standard.path, dti=dti)
+        except Exception as e:
+            logger.error("Failed to compare headers of {} to {}. Reason: "
+                    "{}".format(dicom.path, standard.path, e))
+            continue
+        datman.header_checks.write_diffs(log_file, dicom.path, diffs)
 
     if not os.path.exists(log_file):
         logger.error("header-diff.log not generated for {}. Check that gold " \
@@ -1027,8 +1088,10 @@ def main():
     debug = arguments['--debug']
     quiet = arguments['--quiet']
     study = arguments['<study>']
-    session = arguments['<session>']
+    sessions = arguments['<session>']
     REWRITE = arguments['--rewrite']
+    local_workers = arguments['--local-workers']
+    batch_size = int(arguments['--batch-size'])
 
 
     config = get_config(study)
@@ -1043,12 +1106,24 @@ def main():
     if debug:
         logger.setLevel(logging.DEBUG)
 
-    if session:
-        subject = prepare_scan(session, config)
+    if len(sessions) == 1:
+        subject = prepare_scan(sessions[0], config)
         qc_single_scan(subject, config)
         return
 
-    qc_all_scans(config)
+    if sessions:
+        # A batch from the queue. Carry on past failed sessions, but still
+        # report the failure
+        rewrite = REWRITE
+        failed = [session for session in sessions
+                  if not run_qc(session, config, rewrite)]
+        if failed:
+            sys.exit(1)
+        return
+
+    if local_workers:
+        local_workers = int(local_workers)
+    qc_all_scans(config, batch_size=batch_size, local_workers=local_workers)
 
 if __name__ == "__main__":
     main()
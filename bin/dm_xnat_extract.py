@@ -19,6 +19,13 @@ Options:
     --server URL             XNAT server to connect to, overrides the server defined in the site config file.
     -u --username USER       XNAT username. If specified then the credentials file is ignored and you are prompted for password.
     --dont-update-dashboard  Dont update the dashboard database
+    --download-workers N     Number of series to download from XNAT at once [default: 1]
+    --convert-workers N      Number of series to convert at once [default: 1]
+    --jobs N                 Number of sessions to process at once [default: 1]
+    --max-connections N      Maximum number of XNAT connections to open at once. Sessions wait for a free connection when --jobs is larger. [default: 4]
+    --export-timeout S       Seconds each format's converter may run on a series before it is killed and the export counted as failed [default: 7200]
+    --refresh                Ignore the record of previously exported sessions and check every session on XNAT
+    --cache                  Cache XNAT metadata responses (e.g. project details) in memory for the rest of the run
 
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
@@ -56,6 +63,33 @@ NON-DICOM DATA
 
         /path/to/resources/SPN01_CMH_0001_01_01/
 
+PARALLEL EXPORT
+    Series that still need exporting are passed through two stages: a
+    download stage (a pool of --download-workers threads), which unpacks each
+    series' dicoms into a temporary folder as they are streamed from XNAT, and
+    a conversion stage (a pool of --convert-workers processes). At most
+    download-workers + convert-workers series of a session are held in
+    temporary folders at any one time. With the defaults each stage handles one
+    series at a time. All export formats of a series are converted at the same
+    time, so each conversion worker may run one converter per format.
+
+    When no session is given, --jobs sessions are processed at once, each with
+    its own XNAT connection borrowed from a pool of at most --max-connections.
+    Every session runs its own download threads, but all sessions share the
+    one pool of conversion processes, so at most convert-workers series are
+    converted at once. A summary of the sessions that failed is logged at the
+    end of the run.
+
+EXPORT INDEX
+    Sessions that were fully exported are recorded, along with the time they
+    were last modified on XNAT, in xnat_extract_index.sqlite in the study's
+    metadata folder. The series UIDs exported to each format are recorded too.
+    On later runs a session is only checked in detail if XNAT reports that it
+    has changed since then. Use --refresh to check every session, e.g. after
+    the export settings for a study have changed or outputs were deleted.
+    Modification times aren't fetched for --refresh runs or a named session,
+    so the sessions they export keep their earlier record.
+
 DEPENDENCIES
     dcm2nii
 
@@ -71,32 +105,49 @@ import fnmatch
 import platform
 import shutil
 import hashlib
-
-import pydicom as dicom
+import collections
+import concurrent.futures
+import contextlib
+import threading
 
 from docopt import docopt
 import datman.config
 import datman.xnat
+import datman.xnat_cache
 import datman.utils
 import datman.scanid
 import datman.dashboard
 import datman.exceptions
+import datman.extract_index
 
 logger = logging.getLogger(os.path.basename(__file__))
 
-xnat = None
 cfg = None
 dashboard = None
+# the dashboard database session is shared by all session threads
+dashboard_lock = threading.Lock()
+index = None
+# the converter processes are shared by all session threads
+converter_pool = None
 excluded_studies = ['testing']
 DRYRUN = False
 db_ignore = False   # if true dont update the dashboard db
+DOWNLOAD_WORKERS = 1
+CONVERT_WORKERS = 1
+JOBS = 1
+EXPORT_TIMEOUT = None
 
 def main():
-    global xnat
     global cfg
     global excluded_studies
     global DRYRUN
     global dashboard
+    global index
+    global converter_pool
+    global DOWNLOAD_WORKERS
+    global CONVERT_WORKERS
+    global JOBS
+    global EXPORT_TIMEOUT
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -107,6 +158,13 @@ def main():
     username = arguments['--username']
     session = arguments['<session>']
     db_ignore = arguments['--dont-update-dashboard']
+    DOWNLOAD_WORKERS = int(arguments['--download-workers'])
+    CONVERT_WORKERS = int(arguments['--convert-workers'])
+    JOBS = int(arguments['--jobs'])
+    EXPORT_TIMEOUT = int(arguments['--export-timeout'])
+    max_connections = int(arguments['--max-connections'])
+    refresh = arguments['--refresh']
+    use_cache = arguments['--cache']
 
     if arguments['--dry-run']:
         DRYRUN = True
@@ -139,12 +197,21 @@ def main():
 
     cfg = datman.config.config(study=study)
 
+    # Fork the converter processes before any thread is started. A process
+    # forked while another thread holds a lock (e.g. logging's) can deadlock
+    converter_pool = start_converters(CONVERT_WORKERS)
+
     #Get base URL link to xnat server, authentication info 
     server = datman.xnat.get_server(cfg, url=server)
     username, password = datman.xnat.get_auth(username)
 
-    #Initialize requests module object for XNAT REST API
-    xnat = datman.xnat.xnat(server, username, password)
+    #Initialize a pool of requests module objects for XNAT REST API
+    # the cache (if any) is shared by every connection in the pool
+    cache = datman.xnat_cache.ResponseCache() if use_cache else None
+    pool = datman.xnat.ConnectionPool(server, username, password,
+                                      max_connections=max_connections,
+                                      cache=cache,
+                                      **datman.xnat.get_connection_settings(cfg))
 
     # setup the dashboard object
     if not db_ignore:
@@ -156,37 +223,119 @@ def main():
     # get the list of xnat projects linked to the datman study
     xnat_projects = cfg.get_xnat_projects(study)
 
-    if session:
-        # if session has been provided on the command line, identify which
-        # project it is in
-        try:
-            xnat_project = xnat.find_session(session, xnat_projects)
-        except datman.exceptions.XnatException as e:
-            raise e
-
-        if not xnat_project:
-            logger.error('Failed to find session: {} in xnat.'
-                         ' Ensure it is named correctly with timepoint and repeat.'
-                         .format(session))
-            return
-
-        sessions = [(xnat_project, session)]
-    else:
-        sessions = collect_sessions(xnat_projects, cfg)
+    try:
+        index = datman.extract_index.ExtractIndex.for_study(cfg)
+    except Exception as e:
+        logger.error('Failed to open export index, all sessions will be '
+                     'checked. Reason: {}'.format(e))
+
+    with converter_pool, pool:
+        if session:
+            # if session has been provided on the command line, identify which
+            # project it is in
+            with pool.connection() as xnat:
+                xnat_project = xnat.find_session(session, xnat_projects)
+
+            if not xnat_project:
+                logger.error('Failed to find session: {} in xnat.'
+                             ' Ensure it is named correctly with timepoint and repeat.'
+                             .format(session))
+                return
+
+            sessions = [(xnat_project, session)]
+        else:
+            with pool.connection() as xnat:
+                sessions = collect_sessions(xnat, xnat_projects, cfg)
+
+        logger.info('Found {} sessions for study: {}'
+                    .format(len(sessions), study))
+
+        # modification times are only needed to skip unchanged sessions, so
+        # they aren't queried for a named session or with --refresh
+        modified = {}
+        if index and not refresh and not session:
+            with pool.connection() as xnat:
+                modified = get_modified_times(xnat,
+                                              set(s[0] for s in sessions))
+            sessions = [s for s in sessions
+                        if not index.is_current(s[0], s[1], modified.get(s))]
+            logger.info('{} sessions have changed since they were last '
+                        'exported'.format(len(sessions)))
+
+        results = process_sessions(pool, sessions, modified)
+
+    if index:
+        index.close()
+
+    if cache:
+        logger.debug('XNAT response cache: {}'.format(cache.stats()))
+    report_results(results)
+
+def start_converters(workers):
+    """Returns a process pool with all of its workers already forked
+
+    ProcessPoolExecutor only forks its workers when the first task is
+    submitted, so a task is submitted for each one here.
+    """
+    converters = concurrent.futures.ProcessPoolExecutor(workers)
+    concurrent.futures.wait([converters.submit(os.getpid)
+                             for _ in range(workers)])
+    return converters
 
-    logger.info('Found {} sessions for study: {}'
-                .format(len(sessions), study))
+def process_sessions(pool, sessions, modified=None):
+    """Runs process_session for each session on a pool of JOBS threads.
 
-    for session in sessions:
-        process_session(session)
+    modified is an optional dictionary mapping (xnat_project, session_label)
+    to the session's XNAT modification time, which is recorded in the export
+    index when a session is fully exported.
 
-def collect_sessions(xnat_projects, config):
+    Returns a dictionary mapping each session label to True if it was
+    processed, or False if it failed.
+    """
+    if modified is None:
+        modified = {}
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(JOBS) as executor:
+        futures = {executor.submit(run_session, pool, session,
+                                   modified.get(session)): session
+                   for session in sessions}
+        for future in concurrent.futures.as_completed(futures):
+            session_label = futures[future][1]
+            try:
+                results[session_label] = bool(future.result())
+            except Exception:
+                logger.error('An error happened processing session:{}'
+                             .format(session_label), exc_info=True)
+                results[session_label] = False
+    return results
+
+def run_session(pool, session, modified=None):
+    """Processes a session with a connection borrowed from the pool"""
+    with pool.connection() as xnat:
+        success = process_session(xnat, session)
+    if success and index and not DRYRUN:
+        index.mark_current(session[0], session[1], modified)
+    return success
+
+def report_results(results):
+    failed = sorted(label for label, success in results.items()
+                    if not success)
+    logger.info('Processed {} sessions, {} failed'.format(len(results),
+                                                          len(failed)))
+    if failed:
+        logger.error('Failed sessions: {}'.format(', '.join(failed)))
+
+def collect_sessions(xnat, xnat_projects, config):
     sessions = []
 
-    #For each XNAT project send out URL request for list of session records
+    #Request the list of session records of every XNAT project at once
     #Then validate and add (XNAT project, subject ID ['label']) to output list
-    for project in xnat_projects:
-        project_sessions = xnat.get_sessions(project)
+    xnat_projects = list(xnat_projects)
+    results = datman.xnat.gather_queries(xnat,
+            [('get_sessions', (project,)) for project in xnat_projects])
+    for project, project_sessions in zip(xnat_projects, results):
+        if isinstance(project_sessions, Exception):
+            raise project_sessions
         for session in project_sessions:
             try:
                 sub_id = datman.utils.validate_subject_id(session['label'],
@@ -205,7 +354,34 @@ def collect_sessions(xnat_projects, config):
             sessions.append((project, session['label']))
     return sessions
 
-def process_session(session):
+def get_modified_times(xnat, xnat_projects):
+    """Returns a dictionary mapping (xnat_project, session_label) to the time
+    the session's experiment was last modified on XNAT"""
+    modified = {}
+    xnat_projects = list(xnat_projects)
+    results = datman.xnat.gather_queries(xnat,
+            [('get_project_experiments', (project,))
+             for project in xnat_projects])
+    for project, experiments in zip(xnat_projects, results):
+        if isinstance(experiments, Exception):
+            logger.error('Failed getting experiment modification times for '
+                         'project:{}. Reason: {}'.format(project, experiments))
+            continue
+        for experiment in experiments:
+            stamp = datman.extract_index.get_modified(experiment)
+            # the experiment label should match the session label, but fall
+            # back to the subject label if it doesn't
+            for label in [experiment.get('label'),
+                          experiment.get('subject_label')]:
+                if label and (project, label) not in modified:
+                    modified[(project, label)] = stamp
+    return modified
+
+def process_session(xnat, session):
+    """Exports all data for an (xnat_project, session_label) pair. Returns
+    True if everything in the session was exported, False if it was skipped
+    or partly failed due to an error
+    """
     xnat_project = session[0]
     session_label = session[1]
 
@@ -217,8 +393,8 @@ def process_session(session):
         xnat.get_session(xnat_project, session_label)
     except Exception as e:
         logger.error("Error while getting session {} from XNAT. "
-                "Message: {}".format(session_label, e.message))
-        return
+                "Message: {}".format(session_label, e))
+        return False
 
     try:
         #Look into XNAT project --> (subject: session) and get list of experiments
@@ -227,19 +403,19 @@ def process_session(session):
         logger.warning('Failed getting experiments for:{} in project:{}'
                        ' with reason:{}'
                        .format(session_label, xnat_project, e))
-        return
+        return False
 
     #We expect exactly 1 experiment per session. Each experiment contains multiple scans 
     if len(experiments) > 1:
         logger.error('Found more than one experiment for session:{}'
                        'in study:{} Skipping'
                        .format(session_label, xnat_project))
-        return
+        return False
 
     if not experiments:
         logger.error('Session:{} in study:{} has no experiments'
                      .format(session_label, xnat_project))
-        return
+        return False
 
 
     experiment_label = experiments[0]['label']
@@ -248,7 +424,7 @@ def process_session(session):
         ident = datman.scanid.parse(session_label)
     except datman.scanid.ParseException:
         logger.error('Invalid session:{}, skipping'.format(session_label))
-        return
+        return False
 
     # experiment_label should be the same as the session_label
     if not experiment_label == session_label:
@@ -264,35 +440,39 @@ def process_session(session):
     except Exception as e:
         logger.error('Failed getting experiment for session:{} with reason'
                      .format(session_label, e))
-        return
+        return False
 
     if not experiment:
         logger.warning('No experiments found for session:{}'
                        .format(session_label))
-        return
+        return False
 
     if dashboard:
         logger.debug('Adding session:{} to db'.format(session_label))
         try:
             db_session_name = ident.get_full_subjectid_with_timepoint()
-            db_session = dashboard.get_add_session(db_session_name,
-                                                   date=experiment['data_fields']['date'],
-                                                   create=True)
-            if ident.session and int(ident.session) > 1:
-                db_session.is_repeated = True
-                db_session.repeat_count = int(ident.session)
+            with dashboard_lock:
+                db_session = dashboard.get_add_session(db_session_name,
+                                                       date=experiment['data_fields']['date'],
+                                                       create=True)
+                if ident.session and int(ident.session) > 1:
+                    db_session.is_repeated = True
+                    db_session.repeat_count = int(ident.session)
 
         except datman.dashboard.DashboardException as e:
                 logger.error('Failed adding session:{} to dashboard'
                              .format(session_label))
 
 
+    complete = True
     #experiment['children'] is a list of top level folders in XNAT project --> session --> experiments   
     for data in experiment['children']:
         if data['field'] == 'resources/resource':
-            process_resources(xnat_project, session_label, experiment_label, data)
+            complete &= process_resources(xnat, xnat_project, session_label,
+                                          experiment_label, data)
         elif data['field'] == 'scans/scan':
-            process_scans(xnat_project, session_label, experiment_label, data)
+            complete &= process_scans(xnat, xnat_project, session_label,
+                                      experiment_label, data)
         else:
             logger.warning('Unrecognised field type:{} for experiment:{}'
                            'in session:{} from study:{}'
@@ -301,6 +481,40 @@ def process_session(session):
                                    session_label,
                                    xnat_project))
 
+    return complete
+
+def get_scan_info(xnat, xnat_project, session_label, experiment_label, scan):
+    """Returns the scan descriptor for a scan from the experiment document.
+
+    The experiment already holds every field extract needs, so XNAT is only
+    queried for the scan when its ID, description or file content types are
+    missing.
+    """
+    if scan_info_is_complete(scan):
+        return scan
+
+    series_id = scan['data_fields']['ID']
+    logger.debug('Experiment document is missing details for series:{} in '
+                 'session:{}, querying xnat'.format(series_id, session_label))
+    return xnat.get_scan_info(xnat_project, session_label, experiment_label,
+                              series_id)
+
+
+def scan_info_is_complete(scan):
+    """True if a scan descriptor has an ID, a description and the content
+    type of its files"""
+    data_fields = scan.get('data_fields', {})
+    if 'ID' not in data_fields:
+        return False
+    if 'series_description' not in data_fields and 'type' not in data_fields:
+        return False
+    for child in scan.get('children', []):
+        for item in child.get('items', []):
+            if 'content' in item.get('data_fields', {}):
+                return True
+    return False
+
+
 def create_scan_name(export_info, scan_info, session_label):
     """Creates name suitable for a scan including the tags"""
     try:
@@ -338,8 +552,10 @@ def create_scan_name(export_info, scan_info, session_label):
     return(file_stem, tag)
 
 
-def process_resources(xnat_project, session_label, experiment_label, data):
-    """Export any non-dicom resources from the xnat archive"""
+def process_resources(xnat, xnat_project, session_label, experiment_label,
+                      data):
+    """Export any non-dicom resources from the xnat archive. Returns False if
+    any resource could not be exported"""
     global cfg
     logger.info('Extracting {} resources from {}'
                 .format(len(data), session_label))
@@ -351,8 +567,9 @@ def process_resources(xnat_project, session_label, experiment_label, data):
             os.makedirs(base_path)
         except OSError:
             logger.error('Failed creating resources dir:{}.'.format(base_path))
-            return
+            return False
 
+    complete = True
     for item in data['items']:
         try:
             data_type = item['data_fields']['label']
@@ -366,6 +583,7 @@ def process_resources(xnat_project, session_label, experiment_label, data):
         except OSError:
             logger.error('Failed creating target folder:{}'
                          .format(target_path))
+            complete = False
             continue
 
         xnat_resource_id = item['data_fields']['xnat_abstractresource_id']
@@ -381,6 +599,7 @@ def process_resources(xnat_project, session_label, experiment_label, data):
             logger.error('Failed getting resource:{} '
                          'for session:{} in project:{}'
                          .format(xnat_resource_id, session_label, e))
+            complete = False
             continue
 
         for resource in resources:
@@ -391,17 +610,22 @@ def process_resources(xnat_project, session_label, experiment_label, data):
             else:
                 logger.info('Resource:{} not found for session:{}'
                             .format(resource['name'], session_label))
-                _ = get_resource(xnat_project,
-                                 session_label,
-                                 experiment_label,
-                                 xnat_resource_id,
-                                 resource['URI'],
-                                 resource_path)
-
-def get_resource(xnat_project, xnat_session, xnat_experiment,
-                 xnat_resource_id, xnat_resource_uri, target_path):
+                if not get_resource(xnat,
+                                    xnat_project,
+                                    session_label,
+                                    experiment_label,
+                                    xnat_resource_id,
+                                    resource['URI'],
+                                    resource_path,
+                                    md5=resource.get('digest')):
+                    complete = False
+    return complete
+
+def get_resource(xnat, xnat_project, xnat_session, xnat_experiment,
+                 xnat_resource_id, xnat_resource_uri, target_path, md5=None):
     """Download a single resource file from xnat. Target path should be
-    full path to store the file, including filename"""
+    full path to store the file, including filename. If md5 is given the
+    download is checked against it"""
 
     try:
         source = xnat.get_resource(xnat_project,
@@ -409,7 +633,8 @@ def get_resource(xnat_project, xnat_session, xnat_experiment,
                                     xnat_experiment,
                                     xnat_resource_id,
                                     xnat_resource_uri,
-                                    zipped=False)
+                                    zipped=False,
+                                    md5=md5)
     except Exception as e:
         logger.error('Failed downloading resource archive from:{} with reason:{}'
                      .format(xnat_session, e))
@@ -431,6 +656,7 @@ def get_resource(xnat_project, xnat_session, xnat_experiment,
     except:
         logger.error('Failed copying resource:{} to target:{}.'
                      .format(source, target_path))
+        target_path = None
 
     # finally delete the temporary archive
     try:
@@ -441,21 +667,14 @@ def get_resource(xnat_project, xnat_session, xnat_experiment,
     return(target_path)
 
 
-def process_scans(xnat_project, session_label, experiment_label, scans):
+def process_scans(xnat, xnat_project, session_label, experiment_label, scans):
     """Process a set of scans in an xnat experiment
     scanid is a valid datman.scanid object
     Scans is the json output from xnat query representing scans
-    in an experiment"""
+    in an experiment. Returns False if any series could not be exported"""
     logger.info('Processing scans in session:{}'
                 .format(session_label))
 
-    # setup the export functions for each format
-    xporters = {
-        "mnc": export_mnc_command,
-        "nii": export_nii_command,
-        "nrrd": export_nrrd_command,
-        "dcm": export_dcm_command
-    }
     ident = datman.scanid.parse(session_label)
 
     # load the export info from the site config files
@@ -465,18 +684,32 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
     if not exportinfo:
         logger.error('Failed to get exportinfo for study:{} at site:{}'
                      .format(cfg.study_name, ident.site))
-        return
+        return False
+
+    # series already exported according to the local index
+    exported = index.get_exports(session_label) if index else {}
+    # (series_uid, format) pairs found on disk but missing from the index
+    found = []
+    complete = True
 
     # need to keep a list of scans added to dashboard
     # so we can delete any scans that no longer exist
     scans_added = []
+    # series that still need to be downloaded and converted
+    to_export = []
+    series_uids = {}
 
     for scan in scans['items']:
         series_id = scan['data_fields']['ID']
-        scan_info = xnat.get_scan_info(xnat_project,
-                                       session_label,
-                                       experiment_label,
-                                       series_id)
+        series_uid = scan['data_fields'].get('UID')
+        try:
+            scan_info = get_scan_info(xnat, xnat_project, session_label,
+                                      experiment_label, scan)
+        except datman.exceptions.XnatException as e:
+            logger.error('Failed getting info for series:{} in session:{}. '
+                         'Reason: {}'.format(series_id, session_label, e))
+            complete = False
+            continue
 
         file_stem, tag = create_scan_name(exportinfo, scan_info, session_label)
         if not file_stem:
@@ -500,7 +733,8 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
         if dashboard:
             logger.info('Adding scan:{} to dashboard'.format(file_stem))
             try:
-                dashboard.get_add_scan(file_stem, create=True)
+                with dashboard_lock:
+                    dashboard.get_add_scan(file_stem, create=True)
                 scans_added.append(file_stem)
             except datman.dashboard.DashboardException as e:
                 logger.error('Failed adding scan:{} to dashboard with error:{}'
@@ -522,68 +756,259 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
         except KeyError:
             logger.error('Export settings for tag:{} not found for study:{}'
                          .format(tag, cfg.study_name))
+            complete = False
+            continue
+        if series_uid and exported.get(series_uid, set()) >= set(export_formats):
+            logger.info('Scan:{} has been processed, skipping'
+                        .format(file_stem))
             continue
         if series_is_processed(ident, file_stem, export_formats):
             logger.info('Scan:{} has been processed, skipping'
                         .format(file_stem))
+            found.extend((series_uid, f) for f in export_formats)
             continue
 
-        logger.debug('Getting scan from xnat')
+        to_export.append((series_id, file_stem, export_formats))
+        series_uids[series_id] = series_uid
 
-        # scan hasn't been completely processed, get it from xnat
-        with datman.utils.make_temp_directory(prefix='dm_xnat_extract_') as temp_dir:
-            src_dir = get_dicom_archive_from_xnat(xnat_project, session_label,
-                    experiment_label, series_id, temp_dir)
+    results = export_series(xnat, xnat_project, session_label,
+                            experiment_label, ident, to_export,
+                            converter_pool)
 
-            if not src_dir:
-                logger.error('Failed getting series:{}, session:{} from xnat'
-                             .format(series_id, session_label))
-                continue
+    for series_id, file_stem, export_formats in to_export:
+        done = results.get(series_id, [])
+        found.extend((series_uids[series_id], f) for f in done)
+        if set(done) != set(export_formats):
+            complete = False
 
-            for export_format in export_formats:
-                target_base_dir = cfg.get_path(export_format)
-                target_dir = os.path.join(target_base_dir,
-                                          ident.get_full_subjectid_with_timepoint())
-                try:
-                    target_dir = datman.utils.define_folder(target_dir)
-                except OSError as e:
-                    logger.error('Failed creating target folder:{}'
-                                 .format(target_dir))
-                    continue
-
-                try:
-                    exporter = xporters[export_format]
-                except KeyError:
-                    logger.error("Export format {} not defined.".format(export_format))
-
-                logger.info('Exporting scan {} to format {}'.format(file_stem,
-                        export_format))
-                try:
-                    exporter(src_dir, target_dir, file_stem)
-                except:
-                    # The conversion functions dont really ever raise exceptions
-                    # even when they fail so this is a bit useless
-                    logger.error("An error happened exporting {} from scan: {} "
-                            "in session: {}".format(export_format, series_id,
-                            session_label), exc_info=True)
-
-        logger.debug('Completed exports')
+    if index and not DRYRUN:
+        index.add_exports(session_label, found)
 
     # finally delete any extra scans that exist in the dashboard
     if dashboard:
         try:
-            dashboard.delete_extra_scans(session_label, scans_added)
+            with dashboard_lock:
+                dashboard.delete_extra_scans(session_label, scans_added)
         except Exception as e:
             logger.error('Failed deleting extra scans from session:{} with excuse:{}'
                          .format(session_label, e))
 
+    return complete
+
+
+def export_series(xnat, xnat_project, session_label, experiment_label, ident,
+                  series_list, converters):
+    """Downloads and converts each series in series_list
+
+    series_list is a list of (series_id, file_stem, export_formats) tuples.
+    Series are downloaded and unpacked on a pool of DOWNLOAD_WORKERS threads
+    and then converted to every export format on converters, the process pool
+    from start_converters. All bookkeeping happens in the calling thread,
+    which also bounds the number of series held in temporary folders at once.
+
+    Returns a dictionary mapping each series_id to the list of formats it was
+    successfully exported to.
+    """
+    exported = {}
+    if not series_list:
+        return exported
+
+    queued = collections.deque(series_list)
+    max_in_flight = DOWNLOAD_WORKERS + CONVERT_WORKERS
+    # maps each running future to its stage and the series it belongs to
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(DOWNLOAD_WORKERS) as downloaders:
+        while queued or running:
+            while queued and len(running) < max_in_flight:
+                series_id, file_stem, export_formats = queued.popleft()
+                temp_dir = tempfile.mkdtemp(prefix='dm_xnat_extract_')
+                logger.debug('Getting scan {} from xnat'.format(file_stem))
+                future = downloaders.submit(get_dicom_archive_from_xnat, xnat,
+                                            xnat_project, session_label,
+                                            experiment_label, series_id,
+                                            temp_dir)
+                running[future] = ('download', series_id, file_stem,
+                                   export_formats, temp_dir)
+
+            done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                stage, series_id, file_stem, export_formats, temp_dir = \
+                        running.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.error('An error happened during the {} of series:{}'
+                                 ' in session:{}'.format(stage, series_id,
+                                 session_label), exc_info=True)
+                    result = None
+
+                if stage == 'convert':
+                    exported[series_id] = [
+                            f for f in (result or [])
+                            if DRYRUN or series_is_processed(ident, file_stem,
+                                                             [f])]
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    continue
+                elif stage == 'download' and result:
+                    targets = get_export_targets(ident, export_formats)
+                    logger.debug('Converting scan {}'.format(file_stem))
+                    next_stage = ('convert', converters.submit(
+                            run_exporters, result, targets, file_stem,
+                            series_id, session_label, DRYRUN,
+                            EXPORT_TIMEOUT))
+                else:
+                    logger.error('Failed getting series:{}, session:{} '
+                                 'from xnat'.format(series_id, session_label))
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    continue
+
+                running[next_stage[1]] = (next_stage[0], series_id,
+                                          file_stem, export_formats, temp_dir)
+
+    logger.debug('Completed exports')
+    return exported
+
+
+def get_export_targets(ident, export_formats):
+    """Returns a list of (export_format, target_dir) for each format whose
+    output folder exists or could be created"""
+    targets = []
+    for export_format in export_formats:
+        target_base_dir = cfg.get_path(export_format)
+        target_dir = os.path.join(target_base_dir,
+                                  ident.get_full_subjectid_with_timepoint())
+        try:
+            target_dir = datman.utils.define_folder(target_dir)
+        except OSError as e:
+            logger.error('Failed creating target folder:{}'
+                         .format(target_dir))
+            continue
+        targets.append((export_format, target_dir))
+    return targets
+
+
+def run_exporters(dicoms, targets, file_stem, series_id, session_label,
+                  dryrun=False, timeout=None):
+    """Exports a single unpacked series to each (format, target_dir) in targets
+
+    dicoms is the list of dicom files in the series folder. The exporters for
+    all formats run at the same time, each limited to timeout seconds.
+
+    This runs in a worker process, so DRYRUN is set from the argument rather
+    than inherited from main(). Returns the list of formats that were exported
+    without errors.
+    """
+    global DRYRUN
+    DRYRUN = dryrun
+
+    # setup the export functions for each format
+    xporters = {
+        "mnc": export_mnc_command,
+        "nii": export_nii_command,
+        "nrrd": export_nrrd_command,
+        "dcm": export_dcm_command
+    }
+
+    src_dir = os.path.dirname(dicoms[0])
+    exported = []
+    with concurrent.futures.ThreadPoolExecutor(max(len(targets), 1)) as pool:
+        futures = {}
+        for export_format, target_dir in targets:
+            try:
+                exporter = xporters[export_format]
+            except KeyError:
+                logger.error("Export format {} not defined.".format(export_format))
+                continue
+
+            logger.info('Exporting scan {} to format {}'.format(file_stem,
+                    export_format))
+            future = pool.submit(exporter, src_dir, target_dir, file_stem,
+                                 dicoms=dicoms, timeout=timeout)
+            futures[future] = export_format
+
+        for future in concurrent.futures.as_completed(futures):
+            export_format = futures[future]
+            try:
+                success = future.result()
+            except Exception:
+                logger.error("An error happened exporting {} from scan: {} "
+                        "in session: {}".format(export_format, series_id,
+                        session_label), exc_info=True)
+                continue
+            if not success:
+                logger.error("Failed exporting {} from scan: {} in session: {}"
+                             .format(export_format, series_id, session_label))
+                continue
+            exported.append(export_format)
+
+    return exported
+
 
-def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
-                                series, tempdir):
+def get_dicom_archive_from_xnat(xnat, xnat_project, session_label,
+                                experiment_label, series, tempdir):
     """Downloads and extracts a dicom archive from xnat to a local temp folder
-    Returns the path to the tempdir (for later cleanup) as well as the
-    path to the .dcm files inside the tempdir
+    Returns the list of dicom files found in the series folder inside the
+    tempdir, or None
+
+    The zip is unpacked as it is streamed from xnat, so only the extracted
+    files are written to disk. Zips that can't be read that way are
+    downloaded to a temporary file and unpacked afterwards instead.
     """
+    logger.debug('Streaming dicoms for:{}, series:{}.'
+                 .format(session_label, series))
+    try:
+        response = xnat.get_dicom_stream(xnat_project, session_label,
+                                         experiment_label, series)
+    except Exception as e:
+        logger.error('Failed to download dicom archive for:{}, series:{}'
+                     .format(session_label, series))
+        return None
+
+    if response is None:
+        logger.error('No dicoms found on xnat for:{}, series:{}'
+                     .format(session_label, series))
+        return None
+
+    try:
+        with contextlib.closing(response):
+            datman.utils.unzip_stream(response.raw, tempdir)
+    except NotImplementedError as e:
+        logger.info('Cant stream dicom archive for:{}, series:{}, falling '
+                    'back to a full download. Reason: {}'.format(
+                    session_label, series, e))
+        clear_dir(tempdir)
+        dicom_archive = download_dicom_archive(xnat, xnat_project,
+                                               session_label,
+                                               experiment_label, series)
+        if not dicom_archive:
+            return None
+        return unpack_dicom_archive(dicom_archive, session_label, series,
+                                    tempdir)
+    except Exception as e:
+        logger.error('An error occurred unpacking dicom archive for:{}'
+                     ' skipping. Reason: {}'.format(session_label, e))
+        return None
+
+    return find_dicoms(tempdir, session_label, series)
+
+
+def clear_dir(path):
+    """Removes everything inside a folder without removing the folder"""
+    for item in os.listdir(path):
+        item_path = os.path.join(path, item)
+        if os.path.isdir(item_path):
+            shutil.rmtree(item_path)
+        else:
+            os.remove(item_path)
+
+
+def download_dicom_archive(xnat, xnat_project, session_label,
+                           experiment_label, series):
+    """Downloads the zipped dicoms for a series to a temporary file and
+    returns its path, or None if the download failed"""
     # make a copy of the dicom files in a local directory
     logger.debug('Downloading dicoms for:{}, series:{}.'
                  .format(session_label, series))
@@ -596,7 +1021,12 @@ def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
         logger.error('Failed to download dicom archive for:{}, series:{}'
                      .format(session_label, series))
         return None
+    return dicom_archive
+
 
+def unpack_dicom_archive(dicom_archive, session_label, series, tempdir):
+    """Extracts a downloaded dicom archive into tempdir and deletes the
+    archive. Returns the list of dicoms found, or None"""
     logger.debug('Unpacking archive')
 
     try:
@@ -610,30 +1040,31 @@ def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
 
     logger.debug('Deleting archive file')
     os.remove(dicom_archive)
+    return find_dicoms(tempdir, session_label, series)
+
+
+def find_dicoms(tempdir, session_label, series):
+    """Finds the folder holding the first dicom under tempdir and returns a
+    sorted list of every dicom in it, or None if there are no dicoms.
+
+    This list is the only time the series is checked for valid dicoms, the
+    exporters reuse it.
+    """
     # get the root dir for the extracted files
-    archive_files = []
     for root, dirname, filenames in os.walk(tempdir):
-        for filename in filenames:
-            f = os.path.join(root, filename)
-            if is_valid_dicom(f):
-                archive_files.append(f)
+        dicoms = [os.path.join(root, f) for f in sorted(filenames)
+                  if is_valid_dicom(os.path.join(root, f))]
+        if dicoms:
+            return dicoms
 
-    try:
-        base_dir = os.path.dirname(archive_files[0])
-    except IndexError:
-        logger.warning('There were no valid dicom files in xnat session:{}, series:{}'
-                       .format(session_label, series))
-        return None
-    return base_dir
+    logger.warning('There were no valid dicom files in xnat session:{}, series:{}'
+                   .format(session_label, series))
+    return None
 
 def is_valid_dicom(filename):
-    try:
-        dicom.read_file(filename)
-    except IOError:
-        return
-    except dicom.errors.InvalidDicomError:
-        return
-    return True
+    # Only the preamble is checked, parsing the whole file is far too slow
+    # for large series
+    return datman.utils.has_dicom_preamble(filename)
 
 def series_is_processed(ident, file_stem, export_formats):
     """returns true if exported files exist for all specified formats"""
@@ -663,52 +1094,61 @@ def check_create_dir(target):
             logger.error('Failed creating dir:{}.'.format(target))
             raise e
 
-def export_mnc_command(seriesdir, outputdir, stem):
+def export_mnc_command(seriesdir, outputdir, stem, dicoms=None,
+                       timeout=None):
     """
-    Converts a DICOM series to MINC format
+    Converts a DICOM series to MINC format. Returns True if the series was
+    converted (or already had been)
     """
     outputfile = os.path.join(outputdir, stem) + ".mnc"
 
     try:
         check_create_dir(outputdir)
     except:
-        return
+        return False
 
     if os.path.exists(outputfile):
         logger.warn("{}: output {} exists. skipping."
                     .format(seriesdir, outputfile))
-        return
+        return True
 
     logger.debug("Exporting series {} to {}"
                  .format(seriesdir, outputfile))
     cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'.format(stem,
                                                        seriesdir,
                                                        outputdir)
-    datman.utils.run(cmd, DRYRUN)
+    return_code, _ = datman.utils.run(cmd, DRYRUN, timeout=timeout)
+    return not return_code
 
 
-def export_nii_command(seriesdir, outputdir, stem):
+def export_nii_command(seriesdir, outputdir, stem, dicoms=None,
+                       timeout=None):
     """
-    Converts a DICOM series to NifTi format
+    Converts a DICOM series to NifTi format. Returns True if the series was
+    converted (or already had been)
     """
     outputfile = os.path.join(outputdir, stem) + ".nii.gz"
     try:
         check_create_dir(outputdir)
     except:
-        return
+        return False
     if os.path.exists(outputfile):
         logger.warn("{}: output {} exists. skipping."
                     .format(seriesdir, outputfile))
-        return
+        return True
 
     logger.debug("Exporting series {} to {}".format(seriesdir, outputfile))
 
     # convert into tempdir
     with datman.utils.make_temp_directory(prefix="dm_xnat_extract_") as tmpdir:
-        datman.utils.run('dcm2niix -z y -b y -o {} {}'
-                         .format(tmpdir, seriesdir), DRYRUN)
+        return_code, _ = datman.utils.run('dcm2niix -z y -b y -o {} {}'
+                                          .format(tmpdir, seriesdir), DRYRUN,
+                                          timeout=timeout)
+        if return_code:
+            return False
 
         # move nii and accompanying files (BIDS, dirs, etc) from tempdir/ to nii/
+        success = True
         for f in glob.glob("{}/*".format(tmpdir)):
             bn = os.path.basename(f)
             ext = datman.utils.get_extension(f)
@@ -717,62 +1157,67 @@ def export_nii_command(seriesdir, outputdir, stem):
             if return_code:
                 logger.error("Moving dcm2niix output {} to {} has failed.".format(
                         f, outputdir))
+                success = False
                 continue
+    return success
 
-def export_nrrd_command(seriesdir, outputdir, stem):
+def export_nrrd_command(seriesdir, outputdir, stem, dicoms=None,
+                        timeout=None):
     """
-    Converts a DICOM series to NRRD format
+    Converts a DICOM series to NRRD format. Returns True if the series was
+    converted (or already had been)
     """
     outputfile = os.path.join(outputdir, stem) + ".nrrd"
     try:
         check_create_dir(outputdir)
     except:
-        return
+        return False
     if os.path.exists(outputfile):
         logger.warn("{}: output {} exists. skipping."
                     .format(seriesdir, outputfile))
-        return
+        return True
 
     logger.debug("Exporting series {} to {}".format(seriesdir, outputfile))
 
     cmd = 'DWIConvert -i {} --conversionMode DicomToNrrd -o {}.nrrd' \
           ' --outputDirectory {}'.format(seriesdir, stem, outputdir)
 
-    datman.utils.run(cmd, DRYRUN)
+    return_code, _ = datman.utils.run(cmd, DRYRUN, timeout=timeout)
+    return not return_code
 
 
-def export_dcm_command(seriesdir, outputdir, stem):
+def export_dcm_command(seriesdir, outputdir, stem, dicoms=None,
+                       timeout=None):
     """
-    Copies a single DICOM from the series.
+    Copies a single DICOM from the series. dicoms is the list of dicom files
+    already found in seriesdir, if it isn't given the folder is searched.
+    Returns True if a dicom was copied (or already had been)
     """
     outputfile = os.path.join(outputdir, stem) + ".dcm"
     try:
         check_create_dir(outputdir)
     except:
-        return
+        return False
     if os.path.exists(outputfile):
         logger.warn("{}: output {} exists. skipping."
                     .format(seriesdir, outputfile))
-        return
+        return True
 
-    dcmfile = None
-    for path in glob.glob(seriesdir + '/*'):
-        try:
-            dicom.read_file(path)
-            dcmfile = path
-            break
-        except dicom.filereader.InvalidDicomError as e:
-            pass
+    if dicoms is None:
+        dicoms = [path for path in sorted(glob.glob(seriesdir + '/*'))
+                  if is_valid_dicom(path)]
 
-    if not dcmfile:
+    if not dicoms:
         logger.error("No dicom files found in {}".format(seriesdir))
-        return
+        return False
+    dcmfile = dicoms[0]
 
     logger.debug("Exporting a dcm file from {} to {}"
                  .format(seriesdir, outputfile))
     cmd = 'cp {} {}'.format(dcmfile, outputfile)
 
-    datman.utils.run(cmd, DRYRUN)
+    return_code, _ = datman.utils.run(cmd, DRYRUN, timeout=timeout)
+    return not return_code
 
 if __name__ == '__main__':
     main()
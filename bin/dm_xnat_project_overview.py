@@ -33,6 +33,7 @@ Options:
 import os
 import datetime
 import logging
+import concurrent.futures
 
 from docopt import docopt
 import requests
@@ -45,6 +46,9 @@ logging.basicConfig(level=logging.WARN,
         format="[%(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(os.path.basename(__file__))
 
+# the most requests for MR IDs to have in flight at once
+MAX_QUERIES = 8
+
 def main():
     arguments = docopt(__doc__)
     project = arguments['<project>']
@@ -74,12 +78,17 @@ def main():
     logger.debug("Summarizing XNAT projects {}".format(xnat_project_names))
 
     with datman.utils.XNATConnection(xnat_url, username,
-            password) as xnat_connection:
-        overviews = get_session_overviews(xnat_connection, xnat_project_names)
-
-    with requests.Session() as session:
+            password) as xnat_connection, requests.Session() as session:
         session.auth = (username, password)
-        MR_ids = get_MR_ids(session, xnat_url, xnat_project_names)
+        # the overviews and MR IDs don't depend on each other, so they're
+        # fetched at the same time
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            overviews = executor.submit(get_session_overviews,
+                    xnat_connection, xnat_project_names)
+            MR_ids = executor.submit(get_MR_ids, session, xnat_url,
+                    xnat_project_names)
+            overviews = overviews.result()
+            MR_ids = MR_ids.result()
 
     merged_records = merge_overview_and_labels(overviews, MR_ids)
     write_overview_csv(merged_records, output_file)
@@ -128,9 +137,16 @@ def select_project_data(xnat, project, retry=3):
     return result.data
 
 def get_MR_ids(xnat_session, xnat_url, xnat_projects):
+    """Returns the MR ID records of every project, requesting up to
+    MAX_QUERIES projects' records at once"""
     MR_ids = []
-    for project in xnat_projects:
-        response = select_MR_summary(xnat_session, xnat_url, project)
+    workers = max(1, min(MAX_QUERIES, len(xnat_projects)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        responses = list(executor.map(
+                lambda project: select_MR_summary(xnat_session, xnat_url,
+                                                  project),
+                xnat_projects))
+    for project, response in zip(xnat_projects, responses):
         if not response or response.status_code != 200:
             logger.error("Failed to get MR IDs for project {} with status "
                     "code {}".format(project, response.status_code))
@@ -13,16 +13,37 @@ Arguments:
 Options:
     --server URL          XNAT server to connect to, overrides the server defined in the site config file.
     -u --username USER    XNAT username. If specified then the credentials file is ignored and you are prompted for password.
+    --jobs N              Number of archives to upload at once [default: 1]
+    --max-per-project N   Maximum number of archives to upload to the same XNAT project at once [default: 2]
+    --manifest-batch N    Number of finished archives to collect before rewriting manifest.csv [default: 20]
+    --cache               Cache XNAT metadata responses (e.g. project details) in memory for the rest of the run
     -v --verbose          Be chatty
     -d --debug            Be very chatty
     -q --quiet            Be quiet
+
+RESOURCES
+    Non-dicom files smaller than 10MB are zipped together and uploaded in
+    batches of up to 500 files (or 100MB), which XNAT unpacks into the
+    session's MISC resource folder. Larger files are streamed from disk one at
+    a time.
+
+UPLOAD STATE
+    The outcome of each archive is appended to xnat_upload_state.csv in the
+    metadata folder as soon as it is known, and copied into manifest.csv in
+    batches. If a run is killed, the next run first copies any outcomes still
+    in xnat_upload_state.csv into the manifest. Archives that were not finished
+    are still in the dicom folder and are checked against XNAT again.
 """
 
 import logging
 import sys
 import os
+import shutil
 import zipfile
 import urllib
+import threading
+import collections
+import concurrent.futures
 import pandas as pd
 
 from docopt import docopt
@@ -31,6 +52,8 @@ import datman.config
 import datman.utils
 import datman.scanid
 import datman.xnat
+import datman.xnat_cache
+import datman.header_cache
 import datman.exceptions
 
 logger = logging.getLogger(os.path.basename(__file__))
@@ -41,6 +64,13 @@ password = None
 server = None
 XNAT = None
 CFG = None
+JOBS = 1
+MAX_PER_PROJECT = 2
+
+# Resource files up to this size are batched into zipped uploads
+SMALL_RESOURCE_SIZE = 10 * 1024 * 1024
+RESOURCE_BATCH_FILES = 500
+RESOURCE_BATCH_SIZE = 100 * 1024 * 1024
 
 dtypes = {'source_name':'object',
         'PatientID':'object',
@@ -60,6 +90,8 @@ def main():
     global password
     global XNAT
     global CFG
+    global JOBS
+    global MAX_PER_PROJECT
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -69,6 +101,12 @@ def main():
     server = arguments['--server']
     username = arguments['--username']
     archive = arguments['<archive>']
+    JOBS = int(arguments['--jobs'])
+    MAX_PER_PROJECT = int(arguments['--max-per-project'])
+    manifest_batch = int(arguments['--manifest-batch'])
+    if JOBS < 1 or MAX_PER_PROJECT < 1:
+        sys.exit('--jobs and --max-per-project must be at least 1')
+    use_cache = arguments['--cache']
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -105,10 +143,17 @@ def main():
 
     server = datman.xnat.get_server(CFG, url=server)
     username, password = datman.xnat.get_auth(username)
-    XNAT = datman.xnat.xnat(server, username, password)
+    # the connection is shared by all upload threads
+    settings = datman.xnat.get_connection_settings(CFG)
+    settings['pool_size'] = max(settings.get('pool_size', 10), JOBS)
+    if use_cache:
+        # every archive checks the same projects, so keep their metadata
+        settings['cache'] = datman.xnat_cache.ResponseCache()
+    XNAT = datman.xnat.xnat(server, username, password, **settings)
 
     manifest_file = os.path.join(CFG.get_path('meta'), 'manifest.csv')
-    mf = pd.read_csv(manifest_file, dtype=dtypes)
+    state_file = os.path.join(CFG.get_path('meta'), 'xnat_upload_state.csv')
+    manifest = UploadManifest(manifest_file, state_file, manifest_batch)
 
     dicom_dir = CFG.get_path('dicom', study)
     zips_dir = CFG.get_path('zips', study)
@@ -130,29 +175,147 @@ def main():
 
     logger.info('Processing files in:{}'.format(dicom_dir))
     logger.info('Processing {} files'.format(len(archives)))
-    for archivefile in archives:
-        uploaded = process_archive(os.path.join(dicom_dir, archivefile))
-        
-        if uploaded:
-            # Update manifest
-            logger.info('Updating manifest {}'.format(manifest_file))
-            mf.at[mf['target_name'] == archivefile.strip('.zip'), 'uploaded'] = 'yes'
-            mf.to_csv(manifest_file, index=False)
-
-            # delete symlink and source
-            symlink_path = os.path.join(dicom_dir, archivefile)
-            source_path = os.path.join(zips_dir, os.path.basename(os.readlink(symlink_path)))
-
-            logger.info('Deleting source file {}'.format(source_path))
-            os.remove(source_path)
-
-            logger.info('Deleting symlink {}'.format(symlink_path))
-            os.remove(symlink_path)
-        else:
-            logger.info('Updating manifest {}'.format(manifest_file))
-            mf.at[mf['target_name'] == archivefile.strip('.zip'), 'uploaded'] = 'error'
-            mf.to_csv(manifest_file, index=False)
-    
+    try:
+        upload_archives(dicom_dir, zips_dir, archives, manifest)
+    finally:
+        manifest.flush()
+
+    if XNAT.cache:
+        logger.debug('XNAT response cache: {}'.format(XNAT.cache.stats()))
+
+
+class UploadManifest(object):
+    """Records the upload status of each archive in manifest.csv.
+
+    Statuses are appended to a state file as soon as they are recorded and
+    written to the manifest every batch_size records (and on flush()), so a
+    killed run loses nothing. Any statuses left in the state file by a
+    previous run are written to the manifest on creation. Safe to share
+    between threads.
+    """
+
+    def __init__(self, manifest_file, state_file, batch_size=20):
+        self.manifest_file = manifest_file
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.manifest = pd.read_csv(manifest_file, dtype=dtypes)
+        self.pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        if os.path.exists(state_file):
+            with open(state_file) as state:
+                for line in state:
+                    archivefile, _, status = line.strip().rpartition(',')
+                    if archivefile:
+                        self.pending[archivefile] = status
+            if self.pending:
+                logger.info('Recovered {} upload results from {}'.format(
+                        len(self.pending), state_file))
+            self.flush()
+
+    def record(self, archivefile, status):
+        with self._lock:
+            with open(self.state_file, 'a') as state:
+                state.write('{},{}\n'.format(archivefile, status))
+                state.flush()
+                os.fsync(state.fileno())
+            self.pending[archivefile] = status
+            if len(self.pending) >= self.batch_size:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if not self.pending:
+            return
+        logger.info('Updating manifest {}'.format(self.manifest_file))
+        mf = self.manifest
+        for archivefile, status in self.pending.items():
+            mf.loc[mf['target_name'] == archivefile.strip('.zip'),
+                   'uploaded'] = status
+        mf.to_csv(self.manifest_file, index=False)
+        self.pending.clear()
+        # every status is in the manifest now
+        os.remove(self.state_file)
+
+
+def upload_archives(dicom_dir, zips_dir, archives, manifest):
+    """Uploads archives on a pool of JOBS threads, with no more than
+    MAX_PER_PROJECT archives going to the same xnat project at once"""
+    queued = collections.deque((archivefile, get_archive_project(archivefile))
+                               for archivefile in archives)
+    running = {}
+    per_project = collections.Counter()
+    # with a limit below 1 nothing would ever start
+    max_per_project = max(1, MAX_PER_PROJECT)
+
+    with concurrent.futures.ThreadPoolExecutor(JOBS) as executor:
+        while queued or running:
+            # start archives in order, skipping past any whose project is busy
+            for _ in range(len(queued)):
+                if len(running) >= JOBS:
+                    break
+                archivefile, project = queued.popleft()
+                if per_project[project] >= max_per_project:
+                    queued.append((archivefile, project))
+                    continue
+                per_project[project] += 1
+                future = executor.submit(upload_archive, dicom_dir, zips_dir,
+                                         archivefile, manifest)
+                running[future] = (archivefile, project)
+
+            done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                archivefile, project = running.pop(future)
+                per_project[project] -= 1
+                try:
+                    future.result()
+                except Exception:
+                    logger.error('An error happened uploading {}'.format(
+                            archivefile), exc_info=True)
+                    manifest.record(archivefile, 'error')
+
+
+def get_archive_project(archivefile):
+    """Returns the xnat project an archive will be uploaded to, or None if
+    it can't be found"""
+    ident = get_scanid(archivefile)
+    if not ident:
+        return None
+    try:
+        return CFG.get_key(['XNAT_Archive'], site=ident.site)
+    except:
+        return None
+
+
+def upload_archive(dicom_dir, zips_dir, archivefile, manifest):
+    uploaded = process_archive(os.path.join(dicom_dir, archivefile))
+
+    if not uploaded:
+        manifest.record(archivefile, 'error')
+        return
+
+    manifest.record(archivefile, 'yes')
+
+    # delete symlink and source. The archive is uploaded by now, so failing
+    # to clean up must not get it recorded as an error (and uploaded again)
+    symlink_path = os.path.join(dicom_dir, archivefile)
+    try:
+        source_path = os.path.join(zips_dir,
+                                   os.path.basename(os.readlink(symlink_path)))
+
+        logger.info('Deleting source file {}'.format(source_path))
+        os.remove(source_path)
+
+        logger.info('Deleting symlink {}'.format(symlink_path))
+        os.remove(symlink_path)
+    except OSError as e:
+        logger.error('Failed to clean up uploaded archive {}. Reason: {}'
+                     .format(archivefile, e))
+
 
 def is_datman_id(archive):
     # scanid.is_scanid() isnt used because a complete id is needed (either
@@ -173,7 +336,10 @@ def process_archive(archivefile):
         return False
 
     try:
-        data_exists, resource_exists = check_files_exist(archivefile, xnat_session)
+        resources = get_local_resources(archivefile)
+        data_exists, resource_exists = check_files_exist(archivefile,
+                                                         xnat_session,
+                                                         resources)
     except Exception as e:
         logger.error('Failed checking xnat for session: {}'.format(scanid))
         return False
@@ -192,7 +358,8 @@ def process_archive(archivefile):
     if not resource_exists:
         logger.info('Uploading resource from: {}'.format(archivefile))
         try:
-            upload_non_dicom_data(archivefile, xnat_session.project, xnat_session.name, str(scanid))
+            upload_non_dicom_data(archivefile, xnat_session.project,
+                                  xnat_session.name, str(scanid), resources)
         except Exception as e:
             logger.error('An exception occurred: {}'.format(e))
             pass
@@ -255,16 +422,23 @@ def get_scanid(archivefile):
     return(ident)  
 
 
-def resource_data_exists(xnat_session, archive):
-    xnat_resources = xnat_session.get_resources(XNAT)
+def get_local_resources(archive):
+    """Returns the ZipInfo of each non-empty, non-dicom file in archive"""
     with zipfile.ZipFile(archive) as zf:
-        local_resources = datman.utils.get_resources(zf)
-        local_resources_mod = [item for item in local_resources if zf.read(item)]
-    empty_files = list(set(local_resources) - set(local_resources_mod))
+        resources, empty_files = datman.utils.classify_resources(zf)
     if empty_files:
-        logger.warn("Cannot upload empty resource files {}, omitting.".format(', '.join(empty_files)))
+        logger.warn("Cannot upload empty resource files {}, omitting.".format(
+                ', '.join(info.filename for info in empty_files)))
+    return resources
+
+
+def resource_data_exists(xnat_session, archive, resources=None):
+    xnat_resources = xnat_session.get_resources(XNAT)
+    if resources is None:
+        resources = get_local_resources(archive)
     # paths in xnat are url encoded. Need to fix local paths to match
-    local_resources_mod = [urllib.request.pathname2url(p) for p in local_resources_mod]
+    local_resources_mod = [urllib.request.pathname2url(info.filename)
+                           for info in resources]
     if not set(local_resources_mod).issubset(set(xnat_resources)):
         return False
     return True
@@ -290,14 +464,15 @@ def scan_data_exists(xnat_session, local_headers):
     return True
 
 
-def check_files_exist(archive, xnat_session):
+def check_files_exist(archive, xnat_session, resources=None):
     """Check to see if the dicom files in the local archive have
     been uploaded to xnat
     Returns True if all files exist, otherwise False
     If the session UIDs don't match raises a warning"""
     logger.info('Checking {} contents on xnat'.format(xnat_session.name))
     try:
-        local_headers = datman.utils.get_archive_headers(archive)
+        local_headers = datman.header_cache.get_archive_headers(
+                archive, tags=datman.utils.UID_TAGS)
     except:
         logger.error('Failed getting zip file headers for: {}'.format(archive))
         return False, False
@@ -312,31 +487,93 @@ def check_files_exist(archive, xnat_session):
         # Return true for both to prevent XNAT being modified
         return True, True
 
-    resources_exist = resource_data_exists(xnat_session, archive)
+    resources_exist = resource_data_exists(xnat_session, archive, resources)
 
     return scans_exist, resources_exist
 
 
-def upload_non_dicom_data(archive, xnat_project, subjectid, scanid):
-
-    with zipfile.ZipFile(archive) as zf:
-        resource_files = datman.utils.get_resources(zf)
-        logger.info("Uploading {} files of non-dicom data..."
-                    .format(len(resource_files)))
-        uploaded_files = []
-        for item in resource_files:
-            # convert to HTTP language
-            try:
-                contents = zf.read(item)
-                # By default files are placed in a MISC subfolder
-                # if this is changed it may require changes to
-                # check_duplicate_resources()
-                XNAT.put_resource(xnat_project, subjectid, scanid, item, contents, 'MISC')
-                uploaded_files.append(item)
-            except Exception as e:
-                logger.error("Failed uploading file {} with error:{}"
-                             .format(item, str(e)))
-        return uploaded_files
+def upload_non_dicom_data(archive, xnat_project, subjectid, scanid,
+                          resources=None):
+    if resources is None:
+        resources = get_local_resources(archive)
+    logger.info("Uploading {} files of non-dicom data..."
+                .format(len(resources)))
+
+    uploaded_files = []
+    with zipfile.ZipFile(archive) as zf, \
+            datman.utils.make_temp_directory() as temp:
+        for batch in batch_resources(resources):
+            if len(batch) > 1:
+                try:
+                    upload_resource_batch(zf, batch, temp, xnat_project,
+                                          subjectid, scanid)
+                    uploaded_files.extend(info.filename for info in batch)
+                    continue
+                except Exception as e:
+                    logger.error("Failed uploading batch of {} files with "
+                                 "error:{}. Uploading them one at a time."
+                                 .format(len(batch), str(e)))
+            for info in batch:
+                try:
+                    upload_resource(zf, info, temp, xnat_project, subjectid,
+                                    scanid)
+                    uploaded_files.append(info.filename)
+                except Exception as e:
+                    logger.error("Failed uploading file {} with error:{}"
+                                 .format(info.filename, str(e)))
+    return uploaded_files
+
+
+def batch_resources(resources):
+    """Groups small resource files into batches to upload as one zip. Each
+    large file is returned in a batch of its own"""
+    batch = []
+    batch_size = 0
+    for info in resources:
+        if info.file_size > SMALL_RESOURCE_SIZE:
+            yield [info]
+            continue
+        if batch and (len(batch) >= RESOURCE_BATCH_FILES or
+                      batch_size + info.file_size > RESOURCE_BATCH_SIZE):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(info)
+        batch_size += info.file_size
+    if batch:
+        yield batch
+
+
+def upload_resource_batch(zf, batch, temp, xnat_project, subjectid, scanid):
+    """Zips a batch of resource files, keeping their paths, and uploads it to
+    be extracted into the MISC resource folder"""
+    batch_zip = os.path.join(temp, '{}_resources.zip'.format(scanid))
+    with zipfile.ZipFile(batch_zip, 'w', zipfile.ZIP_DEFLATED) as out:
+        for info in batch:
+            with zf.open(info) as src, out.open(info.filename, 'w') as dest:
+                shutil.copyfileobj(src, dest)
+    try:
+        XNAT.put_resource_archive(xnat_project, subjectid, scanid, batch_zip,
+                                  'MISC')
+    finally:
+        os.remove(batch_zip)
+
+
+def upload_resource(zf, info, temp, xnat_project, subjectid, scanid):
+    """Uploads a single resource file, streamed from a temporary copy so it
+    never has to be held in memory"""
+    local_copy = os.path.join(temp, 'resource')
+    with zf.open(info) as src, open(local_copy, 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    try:
+        with open(local_copy, 'rb') as contents:
+            # By default files are placed in a MISC subfolder
+            # if this is changed it may require changes to
+            # check_duplicate_resources()
+            XNAT.put_resource(xnat_project, subjectid, scanid, info.filename,
+                              contents, 'MISC')
+    finally:
+        os.remove(local_copy)
 
 
 def upload_dicom_data(archive, xnat_project, subjectid, scanid):
@@ -5,10 +5,11 @@ import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageFont
 import numpy as np
-import nibabel as nib
 from future.utils import viewitems
 import argparse
 
+import datman.montage
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -190,11 +191,13 @@ def load_nifti(fname, reorient=True):
     """
     Loads a nifti image,
     returns a ndarray()
+
+    Only the first volume of a 4D image is returned (earlier versions returned
+    every volume), so a 4D t1 or mask is compared and drawn by its first
+    volume.
     """
-    img = nib.load(fname)
-    if reorient:
-        img = nib.as_closest_canonical(img)
-    return(img.get_data())
+    data, _ = datman.montage.load_volume(fname, reorient=reorient)
+    return(data)
 
 
 def map_label_colors(array, ignore_vals=[0]):
@@ -291,10 +294,7 @@ def normalise_slice(slice, max_val=255):
     """
     Normalises values to between 0 & max_val
     """
-    slice = slice - slice.min()
-    slice = slice / np.float(slice.max())
-    slice = slice * max_val
-    return(slice)
+    return(datman.montage.rescale(slice, max_val=max_val))
 
 
 def add_text(img, text, type):
@@ -6,6 +6,8 @@ Arguments:
     <study>             Name of the study to process
 
 Options:
+    --jobs N                 Number of processes to read archive headers
+                             with [default: 1]
     -v --verbose             Verbose logger
     -d --debug                  Debug logger
     -q --quiet             Less debuggering
@@ -13,10 +15,11 @@ Options:
 """
 
 from docopt import docopt
-import sys, os, glob, logging, io, zipfile
-import pydicom
+import sys, os, glob, logging
 import pandas as pd
 import datman.config
+import datman.utils
+import datman.header_cache
 
 
 logger = logging.getLogger(os.path.basename(__file__))
@@ -47,59 +50,69 @@ def create_manifest(filename):
     mf = pd.DataFrame(columns=columns)
     mf.to_csv(filename, index=False)
 
-def get_headers(archive):
-    # Get dicom header
-    zf = zipfile.ZipFile(archive)
-    for f in zf.namelist():
-        try:
-            header = pydicom.dcmread(io.BytesIO(zf.read(f)))    
+def get_headers(archives, jobs=1):
+    # Get the dicom header of the first dicom in each archive, or None if
+    # there isn't one
+    scans = datman.utils.scan_archives(
+            archives, workers=jobs, stop_after_first=True,
+            tags=['PatientID', 'PatientName', 'StudyDate', 'StudyTime'],
+            reader=datman.header_cache.get_archive_headers)
+    headers = {}
+    for scan in scans:
+        if scan.error:
+            logger.error('Failed reading headers from {}: {}'.format(
+                    scan.path, scan.error))
+        headers[scan.path] = None
+        for header in (scan.headers or {}).values():
+            headers[scan.path] = header
             break
-        except pydicom.filereader.InvalidDicomError:
-            logger.debug('Invalid Dicom:{}'.format(f))
-            continue
-        except zipfile.BadZipfile:
-            logger.warning('Error in zipfile:{}'.format(f))
-            break    # Should be Return None, then maybe I don't need to del in main()
-        #Or something like this: 
-        #else: if no header, header = Null
-    return header
+    return headers
 
 def reindex_visits(dataframe):
-    for index, row in dataframe.iterrows():
-        if index == 0:
-            continue
-        prev_row = dataframe.iloc[index-1]
-
-        if row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] > prev_row['StudyDate']:
-            dataframe.at[index, 'visit'] = prev_row['visit'] + 1
-        elif row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate']:
-            dataframe.at[index, 'visit'] = prev_row['visit']
+    # Number each patient's visits (study dates) consecutively, counting on
+    # from the visit number already recorded for their first row
+    same_patient = dataframe['PatientName'].eq(dataframe['PatientName'].shift())
+    dataframe['visit'] = renumber(dataframe['visit'], same_patient,
+                                  dataframe['StudyDate'])
     return dataframe
 
 def reindex_sessions(dataframe):
-    for index, row in dataframe.iterrows():
-        if index == 0:
-            continue
-        prev_row = dataframe.iloc[index-1]
-
-        if row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate'] and row['StudyTime'] > prev_row['StudyTime']:
-            dataframe.at[index, 'session'] = prev_row['session'] + 1
-        elif row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate'] and row['StudyTime'] == prev_row['StudyTime']:
-            dataframe.at[index, 'session'] = prev_row['session']
+    # Number the sessions (study times) on each patient's visit date
+    # consecutively, counting on from the session number already recorded
+    # for the first one
+    same_visit = (dataframe['PatientName'].eq(dataframe['PatientName'].shift())
+                  & dataframe['StudyDate'].eq(dataframe['StudyDate'].shift()))
+    dataframe['session'] = renumber(dataframe['session'], same_visit,
+                                    dataframe['StudyTime'])
     return dataframe
 
+def renumber(numbers, same_group, values):
+    """
+    Renumbers a sorted manifest. Where a row belongs to the same group as
+    the row before it, its number is the previous row's number, plus one if
+    'values' increased. Every other row keeps its number and starts a new run.
+    """
+    prev_values = values.shift()
+    keep = ~(same_group & (values >= prev_values))
+    step = (same_group & (values > prev_values)).astype('int64')
+    start = numbers.where(keep).ffill()
+    numbered = start + step.groupby(keep.cumsum()).cumsum()
+    return numbered.astype(numbers.dtype)
+
 def generate_xnat_sessionIDs(study, dataframe):
-    for index, row in dataframe.iterrows():
-        if row['target_name'] == '<ignore>':
-            continue
-        subjectid = get_subjectid(study, row['PatientName'])
-        uid = (study + '_'
-                + 'CMH_'
-                + subjectid + '_'
-                + str(row['visit']).zfill(2) + '_'
-                + 'SE' + str(row['session']).zfill(2) + '_'
-                + 'MR')
-        dataframe.at[index, 'target_name'] = uid
+    named = dataframe['target_name'] != '<ignore>'
+    if not named.any():
+        return dataframe
+    rows = dataframe[named]
+    subjectids = rows['PatientName'].map(
+            lambda patientid: get_subjectid(study, patientid))
+    uids = (study + '_'
+            + 'CMH_'
+            + subjectids + '_'
+            + rows['visit'].astype(str).str.zfill(2) + '_'
+            + 'SE' + rows['session'].astype(str).str.zfill(2) + '_'
+            + 'MR')
+    dataframe.loc[named, 'target_name'] = uids
     return dataframe
 
 def get_subjectid(study, patientid):
@@ -125,6 +138,7 @@ def main():
     debug = arguments['--debug']
     quiet = arguments['--quiet']
     study = arguments['<study>']
+    jobs = int(arguments['--jobs'])
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -162,28 +176,36 @@ def main():
 
     # Update manifest: for archive: if it's in manifest, skip, otherwise write.
     archive_list = [os.path.join(zips_path, a) for a in os.listdir(zips_path) if a.endswith('.zip')]
+    new_archives = []
     for archive in archive_list:
         archive_basename = os.path.basename(archive).strip('.zip')
         if archive_basename in mf.source_name.values:
             logger.debug('Archive {} already in manifest, skipping...'.format(archive))
         else:
-            logger.info('Adding archive {}'.format(archive))
-            try:
-                # Get dicom header from an archive.
-                dh = get_headers(archive) 
-                archive = str(archive_basename)
-                patient_id = str(getattr(dh, 'PatientID', ''))
-                patient_name = str(getattr(dh, 'PatientName', ''))
-                study_date = int(getattr(dh, 'StudyDate', '0'))
-                study_time = int(getattr(dh, 'StudyTime', '0'))
-                # Append row to dataframe.
-                row = pd.DataFrame([[archive, patient_id, patient_name, study_date, study_time, 1, 1, '', '']], columns=columns)
-                mf = mf.append(row)
-                logger.debug('Success')
-            except NameError:
-                logger.error('No headers for archive {} - skipping...'.format(archive))
-                continue
-    
+            new_archives.append(archive)
+
+    # Get dicom headers from the new archives.
+    headers = get_headers(new_archives, jobs)
+    new_rows = []
+    for archive in new_archives:
+        archive_basename = os.path.basename(archive).strip('.zip')
+        logger.info('Adding archive {}'.format(archive))
+        dh = headers[archive]
+        if dh is None:
+            logger.error('No headers for archive {} - skipping...'.format(archive))
+            continue
+        archive = str(archive_basename)
+        patient_id = str(getattr(dh, 'PatientID', ''))
+        patient_name = str(getattr(dh, 'PatientName', ''))
+        study_date = int(getattr(dh, 'StudyDate', '0'))
+        study_time = int(getattr(dh, 'StudyTime', '0'))
+        new_rows.append([archive, patient_id, patient_name, study_date, study_time, 1, 1, '', ''])
+        logger.debug('Success')
+
+    # Append new rows to dataframe.
+    if new_rows:
+        mf = pd.concat([mf, pd.DataFrame(new_rows, columns=columns)])
+
     logger.info('Reindexing visits and sessions')
 
     mf.sort_values(['PatientName', 'StudyDate', 'StudyTime'], inplace=True)
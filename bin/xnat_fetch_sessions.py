@@ -103,7 +103,8 @@ def main():
             logger.error("{}".format(e.message))
             continue
         username, password = get_credentials(credentials_file)
-        with datman.xnat.xnat(server, username, password) as xnat:
+        with datman.xnat.xnat(server, username, password,
+                **datman.xnat.get_connection_settings(config)) as xnat:
             get_sessions(xnat, project, destination)
 
 def get_sessions(xnat, xnat_project, destination):
@@ -148,7 +149,8 @@ def update_needed(zip_file, session, xnat):
     does not get noticed. Both of them need an update at some later date,
     preferably to use XNAT's metadata on num of files and file size or something.
     """
-    zip_headers = datman.utils.get_archive_headers(zip_file)
+    zip_headers = datman.header_cache.get_archive_headers(
+            zip_file, tags=datman.utils.UID_TAGS)
 
     if not session.experiment:
         logger.error("{} does not have any experiments.".format(session.name))
@@ -1,6 +1,8 @@
 import collections
 import yaml
 
+from datman.yamltools import parse_yaml
+
 #python 2 - 3 compatibility hack
 try:
     basestring
@@ -55,7 +57,7 @@ class Checklist:
         if not stream:
             self.data = tree()
         else:
-            self.data = yaml.load(stream) or tree()
+            self.data = parse_yaml(stream) or tree()
 
         try:
             self._blacklist = self.data['blacklist']
@@ -5,14 +5,28 @@ environment variable os.environ['DM_CONFIG']
 The system is identified from os.environ['DM_SYSTEM']
 
 These can both be overridden at __init__
+
+Parsed config files are cached for the life of the process, and re-read
+whenever their modification time or size changes, so constructing many config
+objects is cheap. A study's settings file is only read once something needs
+it. The dictionaries returned (e.g. by get_key()) are shared
+between config objects and must not be modified.
 """
 import logging
-import yaml
+import threading
 import os
+import datman.metadata
 import datman.scanid
+from datman.yamltools import parse_yaml
 
 logger = logging.getLogger(__name__)
 
+# realpath -> (file key, parsed yaml)
+_yaml_cache = {}
+# (name, file keys..., args...) -> objects derived from the parsed yaml
+_derived_cache = {}
+_cache_lock = threading.Lock()
+
 #python 2 - 3 compatibility hack
 try:
     basestring
@@ -20,12 +34,65 @@ except NameError:
     basestring = str
 
 
+def _load_yaml(filename):
+    """
+    Returns a key identifying the current version of a yaml file and its
+    parsed contents, reading the file only if it has changed since it was
+    last read.
+    """
+    ## Read in the configuration yaml file
+    if not os.path.isfile(filename):
+        raise ValueError("configuration file {} not found. Try again."
+                         .format(filename))
+
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    # python 2 has no st_mtime_ns
+    key = (path, getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+    with _cache_lock:
+        cached = _yaml_cache.get(path)
+    if cached and cached[0] == key:
+        return cached
+
+    ## load the yml file
+    with open(filename, 'r') as stream:
+        config_yaml = parse_yaml(stream)
+
+    with _cache_lock:
+        if path in _yaml_cache:
+            # objects derived from the old version are no longer needed
+            logger.debug('Re-reading changed config file {}'.format(path))
+            _derived_cache.clear()
+        _yaml_cache[path] = (key, config_yaml)
+    return key, config_yaml
+
+
+def _get_derived(key):
+    with _cache_lock:
+        return _derived_cache.get(key)
+
+
+def _set_derived(key, value):
+    with _cache_lock:
+        return _derived_cache.setdefault(key, value)
+
+
+def clear_cache():
+    """Forgets every parsed config file, forcing them to be read again"""
+    with _cache_lock:
+        _yaml_cache.clear()
+        _derived_cache.clear()
+
+
 class config(object):
     site_config = None
-    study_config = None
     system_config = None
     study_name = None
     study_config_file = None
+    study_config_name = None
+    _study_config = None
+    _site_key = None
+    _study_key = None
 
     def __init__(self, filename=None, system=None, study=None):
         """Class object representing the site-wide configuration files.
@@ -46,7 +113,7 @@ class config(object):
                 logger.critical('Failed to find site_config file')
                 raise
 
-        self.site_config = self.load_yaml(filename)
+        self._site_key, self.site_config = _load_yaml(filename)
 
         if not system:
             try:
@@ -61,16 +128,22 @@ class config(object):
             self.set_study(study)
 
     def load_yaml(self, filename):
-        ## Read in the configuration yaml file
-        if not os.path.isfile(filename):
-            raise ValueError("configuration file {} not found. Try again."
-                             .format(filename))
+        return _load_yaml(filename)[1]
 
-        ## load the yml file
-        with open(filename, 'r') as stream:
-            config_yaml = yaml.load(stream)
+    @property
+    def study_config(self):
+        """
+        The settings of the current study. These are only read from disk the
+        first time they're needed after set_study() is called.
+        """
+        if self._study_config is None and self.study_config_name:
+            self._study_key, self._study_config = _load_yaml(
+                    self.study_config_name)
+        return self._study_config
 
-        return config_yaml
+    @study_config.setter
+    def study_config(self, value):
+        self._study_config = value
 
     def set_system(self, system):
         if not self.site_config:
@@ -104,9 +177,42 @@ class config(object):
         project_settings_file = os.path.join(config_path,
                 self.site_config['Projects'][study_name])
 
-        self.study_config = self.load_yaml(project_settings_file)
+        if not os.path.isfile(project_settings_file):
+            raise ValueError("configuration file {} not found. Try again."
+                             .format(project_settings_file))
+
+        self._study_config = None
+        self._study_key = None
         self.study_config_name = project_settings_file
 
+    def _get_project_tags(self, project):
+        """
+        Returns the lower case study tag and site tags of a project, without
+        making it the current study. Projects with no sites defined have no
+        tags.
+        """
+        settings_file = os.path.join(self.system_config['CONFIG_DIR'],
+                                     self.site_config['Projects'][project])
+        key, study_config = _load_yaml(settings_file)
+        site_tags = _get_derived(('project_tags', key))
+        if site_tags is not None:
+            return site_tags
+
+        site_tags = []
+        if 'Sites' not in study_config.keys():
+            logger.debug("No sites defined for {}".format(project))
+            return _set_derived(('project_tags', key), site_tags)
+
+        for site, site_config in study_config['Sites'].items():
+            try:
+                add_tags = [t.lower() for t in site_config['SITE_TAGS']]
+            except KeyError:
+                add_tags = []
+            site_tags.extend(add_tags)
+
+        site_tags.append(study_config['STUDY_TAG'].lower())
+        return _set_derived(('project_tags', key), site_tags)
+
     def get_study_base(self, study=None):
         """Return the base directory for a study"""
 
@@ -166,32 +272,13 @@ class config(object):
             # this loop exits as soon as a match is found.
             logger.debug('Searching project: {}'.format(project))
 
-            self.set_study(project)
-            site_tags = []
-
-            if 'Sites' not in self.study_config.keys():
-                logger.debug("No sites defined for {}".format(project))
-                continue
-
-            for key, site_config in self.study_config['Sites'].items():
-                try:
-                    add_tags = [t.lower() for t in site_config['SITE_TAGS']]
-                except KeyError:
-                    add_tags = []
-                site_tags.extend(add_tags)
-
-            site_tags.append(self.study_config['STUDY_TAG'].lower())
-
-            if tag.lower() in site_tags:
+            if tag.lower() in self._get_project_tags(project):
                 # Hack to deal with DTI not being a unique tag :(
                 if project.upper() == 'DTI15T' or project.upper() == 'DTI3T':
                     if parts.site == 'TGH':
                         project = 'DTI15T'
                     else:
                         project = 'DTI3T'
-                # Needs to be set here in addition to at the top of the loop in
-                # case the wrong DTI study settings were encountered
-                # for the last set_study call. Ugh.
                 self.set_study(project)
                 return project
         # didn't find a match throw a warning
@@ -322,6 +409,15 @@ class config(object):
             if not self.study_config:
                 logger.error("Cannot return site tags, study not set.")
                 raise KeyError
+            key = ('tags', self._site_key, self._study_key, site)
+        else:
+            key = ('tags', self._site_key)
+
+        tags = _get_derived(key)
+        if tags is not None:
+            return tags
+
+        if site:
             export_info = self.get_key(['ExportInfo'], site=site)
         else:
             export_info = {}
@@ -333,7 +429,7 @@ class config(object):
                     "configuration file.")
             raise KeyError
 
-        return TagInfo(export_settings, export_info)
+        return _set_derived(key, TagInfo(export_settings, export_info))
 
     def get_xnat_projects(self, study=None):
         if study:
@@ -375,16 +471,8 @@ class config(object):
         if not os.path.isfile(checklist_path):
             raise ValueError("Checklist {} not found".format(checklist_path))
 
-        qced_subjects = {}
-        with open(checklist_path, 'r') as checklist:
-            for entry in checklist:
-                fields = entry.split(None, 1)
-                if len(fields) < 2:
-                    continue
-                subid, _ = os.path.splitext(fields[0].strip('qc_'))
-                qced_subjects[subid] = []
-
-        return qced_subjects
+        checklist = datman.metadata.get_checklist(checklist_path)
+        return {subid: [] for subid in checklist.get_signed_off()}
 
     def get_blacklist(self):
         """
@@ -399,23 +487,7 @@ class config(object):
         if not os.path.isfile(blacklist_path):
             raise ValueError("Blacklist {} not found.".format(blacklist_path))
 
-        blacklist = {}
-        with open(blacklist_path, 'r') as blacklist_file:
-            header_line = blacklist_file.readline()
-            for entry in blacklist_file:
-                fields = entry.split(None, 1)
-                try:
-                    ident, _, _, _ = datman.scanid.parse_filename(fields[0])
-                except datman.scanid.ParseException:
-                    logger.warn("Bad subject id in series. Ignoring "
-                            "blacklist entry {}".format(entry))
-                    continue
-                except IndexError:
-                    # Empty line present in blacklist. Skip it.
-                    continue
-                subid = ident.get_full_subjectid_with_timepoint()
-                blacklist.setdefault(subid, []).append(fields[0])
-        return blacklist
+        return datman.metadata.get_blacklist(blacklist_path).get_subjects()
 
     def get_subject_metadata(self):
         """
@@ -446,6 +518,11 @@ class config(object):
         if not self.study_config:
             raise RuntimeError("Study tags cannot be returned, a study hasn't been set")
 
+        key = ('study_tags', self._study_key)
+        tags = _get_derived(key)
+        if tags is not None:
+            return tags
+
         try:
             default_tag = self.study_config['STUDY_TAG']
         except KeyError:
@@ -471,11 +548,13 @@ class config(object):
             for tag_name in site_tags:
                 tags.setdefault(tag_name, []).append(site)
 
-        return tags
+        return _set_derived(key, tags)
 
     
 class TagInfo(object):
 
+    _series_map = None
+
     def __init__(self, export_settings, site_settings=None):
         if not site_settings:
             self.tags = export_settings
@@ -504,7 +583,11 @@ class TagInfo(object):
         """
         Maps the 'pattern' fields onto the expected tags. If multiple patterns
         exist, they're joined with '|'.
+
+        The map is built once per TagInfo, it must not be modified.
         """
+        if self._series_map is not None:
+            return self._series_map
         series_map = {}
         for tag in self:
             try:
@@ -515,6 +598,7 @@ class TagInfo(object):
             if type(pattern) is list:
                 pattern = "|".join(pattern)
             series_map[pattern] = tag
+        self._series_map = series_map
         return series_map
 
     def keys(self):
@@ -0,0 +1,132 @@
+"""
+A local record of what dm_xnat_extract.py has already exported.
+
+The index is a small SQLite database kept in the study's metadata folder. It
+stores the XNAT modification time of each session that was fully exported and
+the series UIDs that have been exported to each format, so that unchanged
+sessions can be skipped without querying XNAT for their contents.
+
+    index = datman.extract_index.ExtractIndex.for_study(config)
+    if index.is_current(project, session, modified):
+        ...
+    index.add_exports(session, [(series_uid, 'nii'), (series_uid, 'dcm')])
+    index.mark_current(project, session, modified)
+"""
+import os
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'xnat_extract_index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    project TEXT NOT NULL,
+    session TEXT NOT NULL,
+    modified TEXT NOT NULL,
+    PRIMARY KEY (project, session)
+);
+CREATE TABLE IF NOT EXISTS exports (
+    session TEXT NOT NULL,
+    series_uid TEXT NOT NULL,
+    format TEXT NOT NULL,
+    PRIMARY KEY (session, series_uid, format)
+);
+"""
+
+
+def get_modified(experiment):
+    """Returns the XNAT modification stamp of an experiment record
+
+    Accepts either a row from an experiment listing or the data_fields of a
+    full experiment. The last_modified field is preferred, insert_date is used
+    when it is missing (i.e. the experiment was never modified after upload).
+    Returns None if neither is present.
+    """
+    for field in ['last_modified', 'insert_date']:
+        value = experiment.get(field)
+        if value:
+            return str(value)
+    return None
+
+
+class ExtractIndex(object):
+    """Tracks sessions and series exported by dm_xnat_extract.py
+
+    A single instance can be shared between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    @classmethod
+    def for_study(cls, config):
+        """Opens (or creates) the index in a study's metadata folder"""
+        return cls(os.path.join(config.get_path('meta'), INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def is_current(self, project, session, modified):
+        """True if session was fully exported when it last had this modified
+        stamp on XNAT"""
+        if not modified:
+            return False
+        with self._lock:
+            row = self._db.execute(
+                    'SELECT modified FROM sessions '
+                    'WHERE project = ? AND session = ?',
+                    (project, session)).fetchone()
+        return row is not None and row[0] == modified
+
+    def mark_current(self, project, session, modified):
+        """Records that everything in session has been exported"""
+        if not modified:
+            return
+        with self._lock, self._db:
+            self._db.execute(
+                    'INSERT OR REPLACE INTO sessions (project, session, '
+                    'modified) VALUES (?, ?, ?)',
+                    (project, session, modified))
+
+    def forget(self, project, session):
+        """Removes a session so that it will be fully checked next time"""
+        with self._lock, self._db:
+            self._db.execute(
+                    'DELETE FROM sessions WHERE project = ? AND session = ?',
+                    (project, session))
+
+    def get_exports(self, session):
+        """Returns a dictionary mapping each exported series UID in session to
+        the set of formats it has been exported to"""
+        with self._lock:
+            rows = self._db.execute(
+                    'SELECT series_uid, format FROM exports WHERE session = ?',
+                    (session,)).fetchall()
+        exports = {}
+        for series_uid, export_format in rows:
+            exports.setdefault(series_uid, set()).add(export_format)
+        return exports
+
+    def add_exports(self, session, exports):
+        """Records a list of (series_uid, format) pairs as exported"""
+        exports = [(session, str(uid), fmt) for uid, fmt in exports if uid]
+        if not exports:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                    'INSERT OR IGNORE INTO exports (session, series_uid, '
+                    'format) VALUES (?, ?, ?)', exports)
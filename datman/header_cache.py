@@ -0,0 +1,256 @@
+"""
+A persistent cache of the dicom headers found in exam archives.
+
+Several scripts in the nightly pipeline (write_manifest.py, dm_link.py,
+dm_xnat_upload.py, xnat_fetch_sessions.py...) scan the same zip files for
+their headers. This module keeps a small summary of each series in an archive
+(the FIELDS below) in a SQLite file, keyed by the archive's real path, size and
+modification time, so an archive is only read again after it changes. The
+least recently used archives are dropped once the cache holds more than
+max_entries of them.
+
+    headers = datman.header_cache.get_archive_headers(path,
+                                                      tags=['PatientName'])
+
+The cache file is set by the DM_HEADER_CACHE environment variable, and
+defaults to ~/.cache/datman/archive_headers.sqlite. Setting DM_HEADER_CACHE to
+an empty string disables it. Folders, and requests for fields that aren't
+cached, are always read directly with datman.utils.get_archive_headers.
+"""
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+import collections
+
+import datman.utils
+
+#python 2 - 3 compatibility hack
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+try:
+    basestring
+except NameError:
+    basestring = str
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join('~', '.cache', 'datman', 'archive_headers.sqlite')
+MAX_ENTRIES = 20000
+
+# The header fields stored for each series
+FIELDS = ['StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber',
+          'SeriesDescription', 'StudyDescription', 'StudyID', 'PatientName',
+          'PatientID', 'StudyDate', 'StudyTime', 'SeriesDate', 'SeriesTime',
+          'AcquisitionDate', 'Modality']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archives_last_used ON archives (last_used);
+"""
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+class CachedHeader(dict):
+    """The cached fields of one series' headers.
+
+    Supports the parts of the pydicom Dataset interface the datman scripts
+    use: get(), 'in' and attribute access.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def dir(self):
+        return sorted(self)
+
+
+class HeaderCache(object):
+    """Archive headers stored in a SQLite file. Safe to share between
+    threads, but not between processes (each should open its own)."""
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.pid = os.getpid()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            datman.utils.define_folder(os.path.dirname(path))
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute(
+                    'SELECT COUNT(*) FROM archives').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def get_archive_headers(self, path, stop_after_first=False, tags=None):
+        """Returns the same dictionary as datman.utils.get_archive_headers,
+        with a CachedHeader for each series. Reads the archive if its
+        headers aren't cached or the archive has changed since they were."""
+        if os.path.isdir(path) or (tags and set(tags) - set(FIELDS)):
+            return datman.utils.get_archive_headers(path, stop_after_first,
+                                                    tags)
+
+        key = get_key(path)
+        headers = self.lookup(key)
+        if headers is None:
+            headers = datman.utils.get_archive_headers(path, tags=FIELDS)
+            headers = self.store(key, headers)
+
+        if stop_after_first:
+            return collections.OrderedDict(list(headers.items())[:1])
+        return headers
+
+    def lookup(self, key):
+        """Returns the cached headers for a key from get_key() or None"""
+        path, size, mtime = key
+        with self._lock, self._db:
+            row = self._db.execute(
+                    'SELECT headers FROM archives WHERE path = ? AND '
+                    'size = ? AND mtime = ?', (path, size, mtime)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE archives SET last_used = ? '
+                             'WHERE path = ?', (time.time(), path))
+        return _decode(row[0])
+
+    def store(self, key, headers):
+        """Caches the headers read from an archive and returns them in the
+        form lookup() will"""
+        path, size, mtime = key
+        series = [(folder, summarize(header))
+                  for folder, header in headers.items()]
+        with self._lock, self._db:
+            self._db.execute(
+                    'INSERT OR REPLACE INTO archives (path, size, mtime, '
+                    'headers, last_used) VALUES (?, ?, ?, ?, ?)',
+                    (path, size, mtime, json.dumps(series), time.time()))
+            self._evict()
+        return _decode(json.dumps(series))
+
+    def _evict(self):
+        self._db.execute(
+                'DELETE FROM archives WHERE path IN (SELECT path FROM '
+                'archives ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def forget(self, path):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM archives WHERE path = ?',
+                             (os.path.realpath(path),))
+
+    def prune(self):
+        """Removes entries for archives that no longer exist. Returns the
+        number removed"""
+        with self._lock:
+            paths = [row[0] for row in self._db.execute(
+                    'SELECT path FROM archives')]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM archives WHERE path = ?',
+                                 missing)
+        return len(missing)
+
+
+def get_key(path):
+    """Returns the (realpath, size, mtime) an archive's headers are stored
+    under"""
+    path = os.path.realpath(path)
+    info = os.stat(path)
+    # python 2 has no st_mtime_ns
+    return (path, info.st_size, getattr(info, 'st_mtime_ns', info.st_mtime))
+
+
+def summarize(header):
+    """Returns the cached FIELDS of a pydicom dataset as a dictionary of
+    values json can store"""
+    summary = {}
+    for field in FIELDS:
+        if field in header:
+            summary[field] = _to_json(header.get(field))
+    return summary
+
+
+def _to_json(value):
+    if isinstance(value, (int, float, basestring)) or value is None:
+        return value
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace')
+    if isinstance(value, Sequence):
+        return [_to_json(item) for item in value]
+    return str(value)
+
+
+def _decode(text):
+    return collections.OrderedDict((folder, CachedHeader(header))
+                                   for folder, header in json.loads(text))
+
+
+def get_cache_path():
+    """Returns the cache file set by DM_HEADER_CACHE, or None if caching is
+    turned off"""
+    path = os.environ.get('DM_HEADER_CACHE', DEFAULT_PATH)
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+
+def get_default_cache():
+    """Returns the cache shared by this process, or None if it's turned off
+    or can't be opened"""
+    global _default_cache
+    path = get_cache_path()
+    if not path:
+        return None
+    with _default_lock:
+        # worker processes forked from a process that already had the cache
+        # open need their own connection
+        if (_default_cache is None or _default_cache.path != path or
+                _default_cache.pid != os.getpid()):
+            try:
+                _default_cache = HeaderCache(path)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning('Cant open header cache {}, archives will be '
+                               'read directly. Reason: {}'.format(path, e))
+                return None
+    return _default_cache
+
+
+def get_archive_headers(path, stop_after_first=False, tags=None):
+    """A drop in replacement for datman.utils.get_archive_headers that reads
+    through the default cache"""
+    cache = get_default_cache()
+    if cache is None:
+        return datman.utils.get_archive_headers(path, stop_after_first, tags)
+    try:
+        return cache.get_archive_headers(path, stop_after_first, tags)
+    except sqlite3.Error as e:
+        logger.warning('Header cache failed for {}, reading it directly. '
+                       'Reason: {}'.format(path, e))
+        return datman.utils.get_archive_headers(path, stop_after_first, tags)
@@ -0,0 +1,211 @@
+"""
+Compares the dicom headers of a series against a gold standard, in process.
+
+This replaces running qcmon's qc-headers once for each dicom. Headers are
+reduced to compact maps of field name to value, and the maps of standards are
+cached (keyed by path, size and modification time), so each standard is only
+parsed once per process no matter how many sessions are compared against it.
+The map of a site's standards is cached too, until its directory changes.
+
+    diffs = datman.header_checks.compare_files(dicom_path, standard_path,
+                                               dti=True)
+    datman.header_checks.write_diffs(log_file, dicom_path, diffs)
+
+Each difference is reported the way qc-headers reports it, as one line of
+'<dicom path>: <message>' in the session's header-diff.log.
+"""
+import os
+import logging
+import threading
+import collections
+
+import pydicom as dcm
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+# Fields that are expected to differ between sessions
+IGNORED_HEADERS = frozenset([
+    'AccessionNumber', 'AcquisitionDate', 'AcquisitionMatrix',
+    'AcquisitionNumber', 'AcquisitionTime', 'ContentDate', 'ContentTime',
+    'DataSetTrailingPadding', 'DeidentificationMethod',
+    'DeidentificationMethodCodeSequence', 'FrameOfReferenceUID', 'HighBit',
+    'ImageOrientationPatient', 'ImagePositionPatient',
+    'ImagesInAcquisition', 'ImageType', 'InstanceCreationDate',
+    'InstanceCreationTime', 'InstanceNumber', 'LargestImagePixelValue',
+    'OperatorsName', 'PatientAge', 'PatientBirthDate', 'PatientID',
+    'PatientName', 'PatientSex', 'PatientSize', 'PatientWeight',
+    'PerformedProcedureStepID', 'PerformedProcedureStepStartDate',
+    'PerformedProcedureStepStartTime', 'PixelData', 'ReferencedImageSequence',
+    'RequestAttributesSequence', 'RequestedProcedureID', 'SAR',
+    'SeriesDate', 'SeriesDescription', 'SeriesInstanceUID', 'SeriesNumber',
+    'SeriesTime', 'SliceLocation', 'SmallestImagePixelValue',
+    'SOPInstanceUID', 'StudyDate', 'StudyDescription', 'StudyID',
+    'StudyInstanceUID', 'StudyTime', 'TemporalPositionIdentifier',
+    'TriggerTime', 'WindowCenter', 'WindowWidth'])
+
+# Numeric fields that may differ from the standard by up to this much
+TOLERANCES = {
+    'EchoTime': 0.005,
+    'ImagingFrequency': 0.001,
+    'RepetitionTime': 1,
+    'SpacingBetweenSlices': 0.001}
+
+# GE private field whose first value is the b-value of a diffusion series
+BVAL_TAG = (0x0043, 0x1039)
+
+Header = collections.namedtuple('Header', ['path', 'values', 'bval'])
+
+_standards = {}
+_standard_maps = {}
+_standards_lock = threading.Lock()
+
+
+def read_header(path):
+    """Reads a dicom's header into a Header of comparable values"""
+    with open(path, 'rb') as dicom:
+        dataset = datman.utils.read_dicom_header(dicom)
+    return make_header(dataset, path)
+
+
+def make_header(dataset, path=None):
+    values = {}
+    for name in dataset.dir():
+        try:
+            value = dataset.data_element(name).value
+        except (AttributeError, KeyError):
+            continue
+        if isinstance(value, dcm.sequence.Sequence):
+            continue
+        values[name] = _to_python(value)
+
+    try:
+        bval = _to_python(dataset[BVAL_TAG].value[0])
+    except (KeyError, IndexError, TypeError):
+        bval = None
+    return Header(path, values, bval)
+
+
+def _to_python(value):
+    if isinstance(value, (list, tuple, dcm.multival.MultiValue)):
+        return tuple(_to_python(item) for item in value)
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+
+
+def get_standard(path):
+    """Returns the Header of a standard, parsing it only if it has changed"""
+    path = os.path.realpath(path)
+    info = os.stat(path)
+    key = (info.st_size, _get_mtime(info))
+    with _standards_lock:
+        cached = _standards.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    logger.debug('Reading standard {}'.format(path))
+    header = read_header(path)
+    with _standards_lock:
+        _standards[path] = (key, header)
+    return header
+
+
+def get_standard_map(standard_dir, site, read_standards):
+    """
+    Returns read_standards(standard_dir, site), a site's map of standards,
+    only calling it again once the modification time of standard_dir changes
+    (as it does when a standard is added, removed or renamed). Nothing is
+    cached if standard_dir can't be found.
+    """
+    try:
+        mtime = _get_mtime(os.stat(standard_dir))
+    except OSError:
+        return read_standards(standard_dir, site)
+    key = (os.path.realpath(standard_dir), site)
+    with _standards_lock:
+        cached = _standard_maps.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    standards = read_standards(standard_dir, site)
+    with _standards_lock:
+        _standard_maps[key] = (mtime, standards)
+    return standards
+
+
+def _get_mtime(info):
+    # python 2 has no st_mtime_ns
+    return getattr(info, 'st_mtime_ns', info.st_mtime)
+
+
+def clear_cache():
+    with _standards_lock:
+        _standards.clear()
+        _standard_maps.clear()
+
+
+def compare_headers(header, standard, ignore=IGNORED_HEADERS,
+                    tolerances=TOLERANCES, dti=False):
+    """
+    Returns a list of messages describing how a Header differs from its
+    standard. Fields in 'ignore' are skipped and fields in 'tolerances' may
+    differ by up to the given amount. If dti is set the b-values are also
+    compared.
+    """
+    diffs = []
+    fields = set(standard.values) - set(ignore)
+    for name in sorted(fields - set(header.values)):
+        diffs.append('header {} missing'.format(name))
+
+    for name in sorted(fields & set(header.values)):
+        expected = standard.values[name]
+        actual = header.values[name]
+        if name in tolerances:
+            tolerance = tolerances[name]
+            try:
+                differs = abs(float(actual) - float(expected)) > tolerance
+            except (TypeError, ValueError):
+                differs = actual != expected
+            if differs:
+                diffs.append('header {}, expected = {}, actual = {} '
+                             '[tolerance = {}]'.format(name, expected, actual,
+                                                       tolerance))
+        elif actual != expected:
+            diffs.append('header {}, expected = {}, actual = {}'.format(
+                    name, expected, actual))
+
+    if dti:
+        diffs.extend(compare_bvals(header, standard))
+    return diffs
+
+
+def compare_bvals(header, standard):
+    if header.bval is None or standard.bval is None:
+        return ['No bval found in dicom headers']
+    if header.bval != standard.bval:
+        return ['Bval mismatch: expected = {}, actual = {}'.format(
+                standard.bval, header.bval)]
+    return []
+
+
+def compare_files(dicom, standard, dti=False, **kwargs):
+    """
+    Returns the differences between the headers of a dicom and its standard
+    (see compare_headers)
+    """
+    return compare_headers(read_header(dicom), get_standard(standard),
+                           dti=dti, **kwargs)
+
+
+def write_diffs(log_file, dicom, diffs):
+    """
+    Appends differences for a dicom to a header-diff.log. The log is created
+    even when there are none, to record that the dicom was checked.
+    """
+    with open(log_file, 'a') as log:
+        for diff in diffs:
+            log.write('{}: {}\n'.format(dicom, diff))
@@ -0,0 +1,282 @@
+"""
+Indexes of the checklist.csv and blacklist.csv files in a study's metadata
+folder.
+
+Each file is read once per process into dictionaries keyed by the parsed scan
+id of each entry, and read again only when its modification time or size
+changes. Entries are matched on every part of the id (and the tag and series
+number, for the blacklist) rather than by searching the text of each line,
+so e.g. series 1 no longer matches an entry for series 11.
+
+    blacklist = datman.metadata.get_blacklist(path)
+    comment = blacklist.get_comment('STUDY_CMH_0001_01_01_MR_T1_02_SagT1')
+
+The index objects are shared by everything in a process that asks for the
+same file, and can be used from several threads. When a file has only been
+appended to since it was read, just the new lines are read.
+
+add_to_checklist() adds QC pages to a checklist while holding a lock on it, so
+that concurrent QC jobs can't write duplicate or interleaved lines.
+"""
+import os
+import fcntl
+import logging
+import threading
+
+import datman.scanid
+
+logger = logging.getLogger(__name__)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_checklist(path):
+    """Returns the shared ChecklistIndex for a checklist.csv file"""
+    return _get_index(ChecklistIndex, path)
+
+
+def get_blacklist(path):
+    """Returns the shared BlacklistIndex for a blacklist.csv file"""
+    return _get_index(BlacklistIndex, path)
+
+
+def _get_index(index_type, path):
+    key = (index_type, os.path.realpath(path))
+    with _indexes_lock:
+        try:
+            return _indexes[key]
+        except KeyError:
+            index = _indexes[key] = index_type(path)
+            return index
+
+
+def _get_ident_key(ident):
+    return (ident.study, ident.site, ident.subject, ident.timepoint,
+            ident.session, ident.modality)
+
+
+class MetadataIndex(object):
+    """
+    The parsed contents of a metadata file. Subclasses define _clear() and
+    _parse(lines, start), where start is the number of lines already parsed.
+    """
+
+    # Bytes from the end of the file that must be unchanged for new lines to
+    # be treated as appended
+    TAIL_SIZE = 256
+
+    def __init__(self, path):
+        self.path = path
+        self._version = None
+        self._tail = b''
+        self._num_lines = 0
+        self._lock = threading.RLock()
+        self._clear()
+
+    def refresh(self):
+        """
+        Re-reads the file if it changed since it was last read. Raises IOError
+        if the file can't be read.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            # only python 2 tells OSError and IOError apart
+            raise IOError(e.errno, e.strerror, self.path)
+        version = (stat.st_ino, _get_mtime(stat), stat.st_size)
+        with self._lock:
+            if version == self._version:
+                return
+            with open(self.path, 'rb') as metadata:
+                stat = os.fstat(metadata.fileno())
+                offset = self._find_append_offset(metadata, stat)
+                metadata.seek(offset)
+                data = metadata.read()
+            if not offset:
+                self._clear()
+                self._num_lines = 0
+            lines = data.decode('utf-8', 'replace').splitlines(True)
+            self._parse(lines, self._num_lines)
+            self._num_lines += len(lines)
+            size = offset + len(data)
+            self._tail = (self._tail + data)[-self.TAIL_SIZE:]
+            self._version = (stat.st_ino, _get_mtime(stat), size)
+
+    def _find_append_offset(self, metadata, stat):
+        """
+        Returns the size of the file when it was last read if it has only been
+        appended to since, or 0 if it has to be read from the start.
+        """
+        if self._version is None or not self._tail.endswith(b'\n'):
+            return 0
+        ino, _, size = self._version
+        if ino != stat.st_ino or stat.st_size <= size:
+            return 0
+        metadata.seek(size - len(self._tail))
+        if metadata.read(len(self._tail)) != self._tail:
+            return 0
+        return size
+
+
+def _get_mtime(stat):
+    # python 2 has no st_mtime_ns
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+
+class ChecklistIndex(MetadataIndex):
+    """
+    A QC checklist, where each line holds the name of a session's QC page
+    (e.g. qc_STUDY_CMH_0001_01_01.html) followed by the reviewer's comment.
+    """
+
+    def _clear(self):
+        self._comments = {}
+        self._signed_off = []
+        self._signed_off_names = set()
+
+    def _parse(self, lines, start):
+        for line in lines:
+            parts = line.split(None, 1)
+            if not parts:  # fix for empty lines
+                continue
+            name = get_session_name(parts[0])
+            try:
+                comment = parts[1].strip()
+            except IndexError:
+                comment = ''
+            # the first entry for a session wins
+            self._comments.setdefault(self._get_key(name), comment)
+            if comment and name not in self._signed_off_names:
+                self._signed_off_names.add(name)
+                self._signed_off.append(name)
+
+    def _get_key(self, session_name):
+        try:
+            return _get_ident_key(datman.scanid.parse(session_name))
+        except (datman.scanid.ParseException, IndexError):
+            # Phantom ids (which have no modality group) and names that
+            # aren't scan ids are matched exactly
+            return session_name
+
+    def get_comment(self, session_name):
+        """
+        Returns the comment for a session, an empty string if its entry has
+        no comment, or None if it has no entry.
+        """
+        with self._lock:
+            self.refresh()
+            return self._comments.get(self._get_key(session_name))
+
+    def get_signed_off(self):
+        """
+        Returns the names of the sessions that have a comment (i.e. have been
+        reviewed), in the order they appear.
+        """
+        with self._lock:
+            self.refresh()
+            return list(self._signed_off)
+
+
+class BlacklistIndex(MetadataIndex):
+    """
+    A blacklist, where each line holds the file name of a series that should
+    be ignored followed by the reason. The first line may be a header.
+    """
+
+    def _clear(self):
+        self._comments = {}
+        self._subjects = {}
+
+    def _parse(self, lines, start):
+        for num, line in enumerate(lines, start):
+            parts = line.split(None, 1)
+            if not parts:
+                # Empty line present in blacklist. Skip it.
+                continue
+            try:
+                ident, tag, series, _ = datman.scanid.parse_filename(parts[0])
+            except (datman.scanid.ParseException, IndexError):
+                # The first line is usually a header
+                if num:
+                    logger.warn("Bad subject id in series. Ignoring "
+                                "blacklist entry {}".format(line))
+                continue
+            try:
+                comment = parts[1].strip()
+            except IndexError:
+                comment = None
+            key = _get_ident_key(ident) + (tag, series)
+            # the first entry for a series wins
+            self._comments.setdefault(key, comment)
+            subid = ident.get_full_subjectid_with_timepoint()
+            self._subjects.setdefault(subid, []).append(parts[0])
+
+    def get_comment(self, scan_name):
+        """
+        Returns the comment for a series or None if it isn't blacklisted (or
+        was blacklisted without a comment). Raises ParseException if
+        scan_name isn't a valid datman file name.
+        """
+        ident, tag, series, _ = datman.scanid.parse_filename(scan_name)
+        with self._lock:
+            self.refresh()
+            return self._comments.get(_get_ident_key(ident) + (tag, series))
+
+    def get_subjects(self):
+        """
+        Returns a dictionary mapping each subject id (with timepoint) to the
+        blacklist entries for its series.
+        """
+        with self._lock:
+            self.refresh()
+            return {subid: list(entries)
+                    for subid, entries in self._subjects.items()}
+
+
+def add_to_checklist(path, qc_pages):
+    """
+    Adds QC pages (e.g. qc_STUDY_CMH_0001_01.html) to a checklist in one
+    write, skipping sessions that already have an entry. The checklist is
+    created if it doesn't exist, and is locked while it's checked and written.
+    Returns the names of the pages that were added.
+    """
+    checklist = get_checklist(path)
+    added = []
+    with open(path, 'ab+') as stream:
+        fcntl.lockf(stream, fcntl.LOCK_EX)
+        try:
+            with checklist._lock:
+                checklist.refresh()
+                seen = set()
+                for page in qc_pages:
+                    session = get_session_name(page)
+                    if (session in seen or
+                            checklist.get_comment(session) is not None):
+                        continue
+                    seen.add(session)
+                    added.append(os.path.basename(page))
+            if not added:
+                return added
+
+            lines = ''.join(page + '\n' for page in added)
+            stream.seek(0, os.SEEK_END)
+            if stream.tell():
+                # Don't join the first new entry onto an unfinished last line
+                stream.seek(-1, os.SEEK_END)
+                if stream.read(1) != b'\n':
+                    lines = '\n' + lines
+            stream.write(lines.encode('utf-8'))
+            stream.flush()
+            os.fsync(stream.fileno())
+        finally:
+            fcntl.lockf(stream, fcntl.LOCK_UN)
+    return added
+
+
+def get_session_name(qc_page):
+    """Returns the session name from the name of its QC page"""
+    name = os.path.splitext(os.path.basename(qc_page))[0]
+    if name.startswith('qc_'):
+        name = name[len('qc_'):]
+    return name
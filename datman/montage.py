@@ -0,0 +1,130 @@
+"""
+Renders montages of axial slices from nifti images, like FSL's
+'slicer <image> -S <gap> <width> <png>', without starting a new process for
+each image.
+
+    datman.montage.slicer('STUDY_CMH_0001_01_01_MR_T1_02_SagT1.nii.gz',
+                          't1.png', 2, 1600)
+
+Images are read with nibabel. Uncompressed images are memory mapped, and only
+the first volume of a 4D image is read. Slices are scaled so that voxels are
+square, tiled as many to a row as fit in the requested width, and the finished
+montage is resized to exactly that width. Intensities are windowed to the
+2nd - 98th percentile of the volume, as FSL's robust range does.
+"""
+import logging
+
+import numpy as np
+import nibabel as nib
+import matplotlib.image
+
+logger = logging.getLogger(__name__)
+
+ROBUST_RANGE = (2, 98)
+
+
+def load_volume(image, volume=0, reorient=True):
+    """
+    Returns the data of one volume of a nifti image (a file name or a loaded
+    nibabel image) as a 3D array, and its voxel sizes.
+
+    Only the requested volume is read from disk. If reorient is set, the axes
+    are flipped and swapped into the closest canonical (RAS+) orientation.
+    """
+    if not isinstance(image, nib.spatialimages.SpatialImage):
+        image = nib.load(image)
+
+    if len(image.shape) > 3:
+        index = (Ellipsis,) + (volume,) + (0,) * (len(image.shape) - 4)
+        data = np.asanyarray(image.dataobj[index])
+    else:
+        data = np.asanyarray(image.dataobj)
+    zooms = image.header.get_zooms()[:3]
+
+    if reorient:
+        ornt = nib.orientations.io_orientation(image.affine)
+        data = nib.orientations.apply_orientation(data, ornt)
+        zooms = tuple(zooms[int(axis)] for axis in ornt[:, 0])
+    return data, zooms
+
+
+def rescale(data, low=None, high=None, max_val=255):
+    """
+    Linearly maps data onto 0 - max_val (clipping values outside of low to
+    high) and returns it as uint8. low and high default to the data's
+    minimum and maximum.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if low is None:
+        low = data.min() if data.size else 0
+    if high is None:
+        high = data.max() if data.size else 0
+    if high <= low:
+        return np.zeros(data.shape, dtype=np.uint8)
+    scaled = (np.clip(data, low, high) - low) * (max_val / float(high - low))
+    return np.round(scaled).astype(np.uint8)
+
+
+def get_axial_slices(data, gap):
+    """
+    Returns every gap'th axial slice of a RAS+ oriented volume, with
+    anterior at the top.
+    """
+    return [np.rot90(data[:, :, num]) for num in range(0, data.shape[2], gap)]
+
+
+def resize(image, shape):
+    """Resizes a 2D array to shape with nearest neighbour sampling"""
+    rows = _sample_indices(image.shape[0], shape[0])
+    cols = _sample_indices(image.shape[1], shape[1])
+    return image[np.ix_(rows, cols)]
+
+
+def _sample_indices(old_size, new_size):
+    indices = (np.arange(new_size) + 0.5) * (old_size / float(new_size))
+    return np.minimum(indices.astype(int), old_size - 1)
+
+
+def make_montage(data, gap, width, zooms=(1, 1, 1)):
+    """
+    Returns a montage (a uint8 array) of every gap'th axial slice of a RAS+
+    oriented volume, width pixels wide.
+    """
+    data = rescale(data, *np.percentile(data, ROBUST_RANGE))
+    slices = get_axial_slices(data, max(1, int(gap)))
+
+    # Scale slices so each pixel covers the same distance in x and y
+    x_size, y_size = float(zooms[0]), float(zooms[1])
+    smallest = min(x_size, y_size)
+    slice_shape = (int(round(data.shape[1] * y_size / smallest)),
+                   int(round(data.shape[0] * x_size / smallest)))
+    slices = [resize(axial, slice_shape) for axial in slices]
+
+    per_row = max(1, min(len(slices), width // slice_shape[1]))
+    num_rows = int(np.ceil(len(slices) / float(per_row)))
+    montage = np.zeros((num_rows * slice_shape[0], per_row * slice_shape[1]),
+                       dtype=np.uint8)
+    for num, axial in enumerate(slices):
+        row, col = divmod(num, per_row)
+        montage[row * slice_shape[0]:(row + 1) * slice_shape[0],
+                col * slice_shape[1]:(col + 1) * slice_shape[1]] = axial
+
+    height = max(1, int(round(montage.shape[0] * width /
+                              float(montage.shape[1]))))
+    return resize(montage, (height, width))
+
+
+def write_png(image, output):
+    """Writes a 2D uint8 array to a greyscale png"""
+    matplotlib.image.imsave(output, image, cmap='gray', vmin=0, vmax=255,
+                            format='png')
+
+
+def slicer(image, output, gap, width):
+    """
+    Writes a png montage of every gap'th axial slice of a nifti image (a file
+    name or loaded nibabel image), width pixels wide.
+    """
+    logger.debug('Writing montage of {} to {}'.format(image, output))
+    data, zooms = load_volume(image)
+    write_png(make_montage(data, gap, width, zooms), output)
@@ -10,6 +10,7 @@ import logging
 
 import pandas as pd
 
+import datman.metadata
 import datman.utils
 
 logger = logging.getLogger(__name__)
@@ -45,22 +46,11 @@ def get_qced_subjects(qc_list):
     """
     reads the QC_list and returns a list of all subjects who have passed QC
     """
-    qced_subs = []
-
     if not os.path.isfile(qc_list):
         logger.error("QC file for transfer not found.", exc_info=True)
         sys.exit(1)
 
-    with open(qc_list) as f:
-        for line in f:
-            line = line.strip()
-            fields = line.split(' ')
-            if len(fields) > 1:
-                qc_file_name = fields[0]
-                subid = get_qced_subid(qc_file_name)
-                qced_subs.append(subid)
-
-    return qced_subs
+    return datman.metadata.get_checklist(qc_list).get_signed_off()
 
 def get_qced_subid(qc_file_name):
     subid = qc_file_name.replace('.pdf','')
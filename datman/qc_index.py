@@ -0,0 +1,242 @@
+"""
+An index of the QC state of every session in a study, stored as json in the
+study's metadata folder.
+
+For each session folder in the nii folder the index keeps the time data was
+last exported to it, the time its QC page was written (if it has been), whether
+its qc folder holds anything and its checklist status. Updating the index reads
+the nii and qc folders with one os.scandir pass each, and only looks inside a
+session's folder when the folder's own modification time has changed. This
+makes finding new or out of date sessions cheap even on network file systems,
+where globbing a large study can take minutes.
+
+    index = datman.qc_index.get_index(config)
+    for subject in index.get_new_subjects():
+        ...
+
+Because changes are found through folder modification times, a file that is
+rewritten in place (rather than replaced) won't be noticed. Use
+update(full=True) to read every folder again.
+"""
+import os
+import json
+import logging
+import tempfile
+
+import datman.metadata
+
+logger = logging.getLogger(__name__)
+
+#python 2 - 3 compatibility hack
+try:
+    _replace = os.replace
+except AttributeError:
+    # os.rename also replaces the destination in one step on posix
+    _replace = os.rename
+
+INDEX_NAME = 'qc_index.json'
+VERSION = 1
+
+
+def get_index(config, update=True):
+    """
+    Returns the QCIndex for a study, brought up to date (and saved) if update
+    is set
+    """
+    meta = config.get_path('meta')
+    index = QCIndex(os.path.join(meta, INDEX_NAME), config.get_path('nii'),
+                    config.get_path('qc'), os.path.join(meta, 'checklist.csv'))
+    if update:
+        index.update()
+        index.save()
+    return index
+
+
+class QCIndex(object):
+    """
+    The QC state of each session folder in nii_dir. Each entry in 'subjects'
+    is a dictionary with the keys:
+        nii_mtime       modification time of the session's nii folder
+        data_mtime      latest modification time of the folder and its
+                        .nii.gz files
+        qc_mtime        modification time of the session's qc folder (None
+                        if it doesn't exist)
+        report_mtime    modification time of qc_<session>.html (or None)
+        has_report      whether the qc folder holds any html page
+        qc_files        whether the qc folder holds anything at all
+        checklist       the checklist comment: None if the session has no
+                        entry, an empty string if it hasn't been signed off
+    """
+
+    def __init__(self, path, nii_dir, qc_dir, checklist_path=None):
+        self.path = path
+        self.nii_dir = nii_dir
+        self.qc_dir = qc_dir
+        self.checklist_path = checklist_path
+        self.subjects = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as index_file:
+                contents = json.load(index_file)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                logger.warning('Ignoring unreadable QC index {}. Reason: '
+                               '{}'.format(self.path, e))
+            return
+        if contents.get('version') != VERSION:
+            return
+        self.subjects = contents.get('subjects', {})
+
+    def save(self):
+        """
+        Writes the index, replacing the old one in a single step. Failure is
+        only logged, since the index can always be rebuilt.
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                            prefix='.' + INDEX_NAME)
+        except (IOError, OSError) as e:
+            logger.debug('Cant write QC index {}. Reason: {}'.format(
+                    self.path, e))
+            return
+        try:
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump({'version': VERSION, 'subjects': self.subjects},
+                          index_file, sort_keys=True)
+            os.chmod(tmp_path, 0o664)
+            _replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.debug('Cant write QC index {}. Reason: {}'.format(
+                    self.path, e))
+            os.remove(tmp_path)
+
+    def update(self, full=False):
+        """
+        Brings the index up to date with the nii and qc folders. Only folders
+        that have changed since the last update are read unless full is set.
+        """
+        qc_folders = {entry.name: entry for entry in _scandir(self.qc_dir)
+                      if entry.is_dir()}
+        checklist = self._get_checklist()
+
+        subjects = {}
+        for entry in _scandir(self.nii_dir):
+            if not entry.is_dir():
+                continue
+            old = {} if full else self.subjects.get(entry.name, {})
+            state = dict(old)
+
+            nii_mtime = _get_mtime(entry)
+            if nii_mtime != old.get('nii_mtime'):
+                state['nii_mtime'] = nii_mtime
+                state['data_mtime'] = get_data_mtime(entry.path, nii_mtime)
+
+            qc_entry = qc_folders.get(entry.name)
+            qc_mtime = _get_mtime(qc_entry) if qc_entry else None
+            if qc_mtime != old.get('qc_mtime') or 'report_mtime' not in old:
+                state.update(read_qc_folder(qc_entry, entry.name))
+                state['qc_mtime'] = qc_mtime
+
+            state['checklist'] = (checklist.get_comment(entry.name)
+                                  if checklist else None)
+            subjects[entry.name] = state
+
+        self.subjects = subjects
+        return self
+
+    def _get_checklist(self):
+        if not self.checklist_path:
+            return None
+        checklist = datman.metadata.get_checklist(self.checklist_path)
+        try:
+            checklist.refresh()
+        except (IOError, OSError):
+            return None
+        return checklist
+
+    def get_new_subjects(self, rewrite=False):
+        """
+        Returns the sessions that need QC. Sessions are finished when their qc
+        folder holds an html page, and phantoms are finished when their qc
+        folder holds anything. If rewrite is set all sessions are returned.
+        """
+        if rewrite:
+            return sorted(self.subjects)
+        new_subs = []
+        for subject, state in sorted(self.subjects.items()):
+            if state.get('has_report'):
+                continue
+            if '_PHA_' in subject and state.get('qc_files'):
+                continue
+            new_subs.append(subject)
+        return new_subs
+
+
+class _DirEntry(object):
+    """The parts of os.DirEntry used here, for python 2 which has no
+    os.scandir"""
+
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _listdir(path):
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def _scandir(path):
+    scandir = getattr(os, 'scandir', _listdir)
+    try:
+        return list(scandir(path))
+    except (IOError, OSError) as e:
+        logger.warning('Cant read folder {}. Reason: {}'.format(path, e))
+        return []
+
+
+def _get_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        # broken links (e.g. to removed, blacklisted data) have no mtime
+        return 0
+
+
+def get_data_mtime(nii_path, folder_mtime):
+    """
+    Returns the latest modification time of a session's nii folder and the
+    .nii.gz files in it
+    """
+    mtimes = [folder_mtime]
+    for entry in _scandir(nii_path):
+        if entry.name.endswith('.nii.gz'):
+            mtimes.append(_get_mtime(entry))
+    return max(mtimes)
+
+
+def read_qc_folder(qc_entry, subject):
+    """
+    Returns the report_mtime, has_report and qc_files fields for a session's
+    qc folder (a DirEntry, or None if it doesn't exist)
+    """
+    state = {'report_mtime': None, 'has_report': False, 'qc_files': False}
+    if qc_entry is None:
+        return state
+    report_name = 'qc_{}.html'.format(subject)
+    for entry in _scandir(qc_entry.path):
+        state['qc_files'] = True
+        if entry.name.startswith('.'):
+            continue
+        if entry.name.endswith('.html'):
+            state['has_report'] = True
+        if entry.name == report_name:
+            state['report_mtime'] = _get_mtime(entry)
+    return state
@@ -1,8 +1,15 @@
 """
 Represents scan identifiers that conform to the TIGRLab naming scheme
+
+Parsed identifiers are immutable and are memoized, so parsing the same name
+again (e.g. from a sort key, or while walking a large nii folder) costs a
+dictionary lookup.
 """
 import os.path
 import re
+import sys
+import functools
+import collections
 
 SCANID_RE = '(?P<study>[^_]+)_' \
             '(?P<site>[^_]+)_' \
@@ -45,24 +52,91 @@ SCANID_PHA_PATTERN   = re.compile('^'+SCANID_PHA_RE+'$')
 FILENAME_PATTERN     = re.compile('^'+FILENAME_RE+'$')
 FILENAME_PHA_PATTERN = re.compile('^'+FILENAME_PHA_RE+'$')
 
+# The number of names (and file names) whose parse results are kept
+PARSE_CACHE_SIZE = 2 ** 17
+
 #python 2 - 3 compatibility hack
 try:
     basestring
 except NameError:
     basestring = str
 
+try:
+    _intern = sys.intern
+    _lru_cache = functools.lru_cache
+except AttributeError:
+    # python 2 has no lru_cache, so a plain dictionary (emptied when full)
+    # memoizes parse results there. Names aren't interned, since intern()
+    # rejects unicode.
+    def _intern(value):
+        return value
+
+    def _lru_cache(maxsize):
+        def decorator(func):
+            cache = {}
+            @functools.wraps(func)
+            def memoized(arg):
+                try:
+                    return cache[arg]
+                except KeyError:
+                    pass
+                if len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[arg] = func(arg)
+                return result
+            memoized.cache_clear = cache.clear
+            return memoized
+        return decorator
+
 class ParseException(Exception):
     pass
 
-class Identifier:
+class Identifier(object):
+    """
+    A parsed scan id. Identifiers are shared between callers by the parse
+    cache, so they can't be changed. Use replace() to get a modified copy.
+    """
+    __slots__ = ('study', 'site', 'subject', 'timepoint', '_session',
+                 'modality')
+
     def __init__(self, study, site, subject, timepoint, session, modality):
-        self.study = study
-        self.site = site
-        self.subject = subject
-        self.timepoint = timepoint
-        self._session = session
-        self.modality = modality.strip()
+        init = super(Identifier, self).__setattr__
+        init('study', study)
+        init('site', site)
+        init('subject', subject)
+        init('timepoint', timepoint)
+        init('_session', session)
+        init('modality', modality.strip())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Identifier is immutable, use replace() to "
+                             "change '{}'".format(name))
+
+    __delattr__ = __setattr__
+
+    def _fields(self):
+        return (self.study, self.site, self.subject, self.timepoint,
+                self._session, self.modality)
+
+    def __eq__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __reduce__(self):
+        return (Identifier, self._fields())
 
+    def __repr__(self):
+        return "<Identifier {}>".format(self)
 
     @property
     def session(self):
@@ -70,10 +144,15 @@ class Identifier:
             return ''
         return self._session
 
-    @session.setter
-    def session(self, value):
-        self._x = value
-
+    def replace(self, **changes):
+        """
+        Returns a copy of this identifier with the given fields (study, site,
+        subject, timepoint, session or modality) changed
+        """
+        fields = dict(zip(('study', 'site', 'subject', 'timepoint',
+                           'session', 'modality'), self._fields()))
+        fields.update(changes)
+        return Identifier(**fields)
 
     def get_full_subjectid(self):
         return "_".join([self.study, self.site, self.subject])
@@ -112,42 +191,66 @@ class Identifier:
             return self.get_full_subjectid()
 
 
-def parse(identifier):
-    if not isinstance(identifier, basestring):
-        raise ParseException
+def _make_identifier(match):
+    return Identifier(study    = _intern(match.group("study")),
+                      site     = _intern(match.group("site")),
+                      subject  = _intern(match.group("subject")),
+                      timepoint= _intern(match.group("timepoint")),
+                      session  = _intern(match.group("session")),
+                      modality = _intern(match.group("modality")))
 
+@_lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(identifier):
     match = SCANID_PATTERN.match(identifier)
     if not match: match = SCANID_PHA_PATTERN.match(identifier)
     # work around for matching scanid's when session not supplied
     if not match: match = SCANID_PATTERN.match(identifier + '_XX')
-    if not match: raise ParseException()
+    if not match: return None
+    return _make_identifier(match)
+
+@_lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_filename(fname):
+    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
+    if not match: match = FILENAME_PATTERN.match(fname)
+    if not match: return None
+    return (_make_identifier(match), _intern(match.group("tag")),
+            match.group("series"), match.group("description"))
 
-    ident = Identifier(study    = match.group("study"),
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"),
-                       modality = match.group("modality"))
+def parse(identifier):
+    if not isinstance(identifier, basestring):
+        raise ParseException
 
+    ident = _parse(identifier)
+    if ident is None: raise ParseException()
     return ident
 
 def parse_filename(path):
-    fname = os.path.basename(path)
-    match = FILENAME_PHA_PATTERN.match(fname)  # check PHA first
-    if not match: match = FILENAME_PATTERN.match(fname)
-    if not match: raise ParseException()
-
-    ident = Identifier(study    = match.group("study"),
-                       site     = match.group("site"),
-                       subject  = match.group("subject"),
-                       timepoint= match.group("timepoint"),
-                       session  = match.group("session"),
-                       modality = match.group("modality"))
-
-    tag = match.group("tag")
-    series = match.group("series")
-    description = match.group("description")
-    return ident, tag, series, description
+    result = _parse_filename(os.path.basename(path))
+    if result is None: raise ParseException()
+    return result
+
+def parse_many(names, filenames=False):
+    """
+    Parses a list of scan ids (or file names, if filenames=True), such as a
+    directory listing. Returns an ordered dictionary mapping each name that
+    could be parsed to the result of parse() (or parse_filename()). Names
+    that can't be parsed are left out.
+    """
+    parser = parse_filename if filenames else parse
+    parsed = collections.OrderedDict()
+    for name in names:
+        if name in parsed:
+            continue
+        try:
+            parsed[name] = parser(name)
+        except ParseException:
+            continue
+    return parsed
+
+def clear_cache():
+    """Forgets all memoized parse results"""
+    _parse.cache_clear()
+    _parse_filename.cache_clear()
 
 def make_filename(ident, tag, series, description, ext=None):
     filename = "_".join([str(ident), tag, series, description])
@@ -14,6 +14,11 @@ import shutil
 import shlex
 import pipes
 import contextlib
+import signal
+import struct
+import zlib
+import itertools
+import collections
 import subprocess as proc
 
 import pydicom as dcm
@@ -21,6 +26,7 @@ import numpy as np
 import nibabel as nib
 
 import datman.config
+import datman.metadata
 import datman.scanid as scanid
 
 logger = logging.getLogger(__name__)
@@ -51,24 +57,13 @@ def check_checklist(session_name, study=None):
         return
 
     try:
-        with open(checklist_path, 'r') as f:
-            lines = f.readlines()
+        return datman.metadata.get_checklist(checklist_path).get_comment(
+                session_name)
     except IOError:
         logger.warning('Unable to open checklist file:{} for reading'
                        .format(checklist_path))
         return
 
-    for line in lines:
-        parts = line.split(None, 1)
-        if parts:  # fix for empty lines
-            if os.path.splitext(parts[0])[0] == 'qc_{}'.format(session_name):
-                try:
-                    return parts[1].strip()
-                except IndexError:
-                    return ''
-
-    return None
-
 def check_blacklist(scan_name, study=None):
     """Reads the checklist identified from the session_name
     If there is an entry returns the comment, otherwise
@@ -77,7 +72,6 @@ def check_blacklist(scan_name, study=None):
 
     try:
         ident, tag, series_num, _ = scanid.parse_filename(scan_name)
-        blacklist_id = "_".join([str(ident), tag, series_num])
     except scanid.ParseException:
         logger.warning('Invalid session id:{}'.format(scan_name))
         return
@@ -96,20 +90,12 @@ def check_blacklist(scan_name, study=None):
         return
 
     try:
-        with open(checklist_path, 'r') as f:
-            lines = f.readlines()
+        return datman.metadata.get_blacklist(checklist_path).get_comment(
+                scan_name)
     except IOError:
         logger.warning('Unable to open blacklist file:{} for reading'
                        .format(checklist_path))
         return
-    for line in lines:
-        parts = line.split(None, 1)
-        if parts:  # fix for empty lines
-            if blacklist_id in parts[0]:
-                try:
-                    return parts[1].strip()
-                except IndexError:
-                    return
 
 
 def get_subject_from_filename(filename):
@@ -181,7 +167,14 @@ def get_extension(path):
     else:
         return os.path.splitext(path)[1]
 
-def get_archive_headers(path, stop_after_first = False):
+# Bytes read from each file when scanning for dicom headers. The rest of a
+# file is only read if its header doesn't fit.
+HEADER_READ_SIZE = 1024 * 1024
+
+# Tags needed to compare an archive's scans with the ones on XNAT
+UID_TAGS = ['StudyInstanceUID', 'SeriesInstanceUID']
+
+def get_archive_headers(path, stop_after_first = False, tags=None):
     """
     Get dicom headers from a scan archive.
 
@@ -195,17 +188,50 @@ def get_archive_headers(path, stop_after_first = False):
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    Only headers are read, never pixel data. If tags is a list of keywords
+    (e.g. UID_TAGS) only those elements are parsed.
     """
     if os.path.isdir(path):
-        return get_folder_headers(path, stop_after_first)
+        return get_folder_headers(path, stop_after_first, tags)
     elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
+        return get_zipfile_headers(path, stop_after_first, tags)
     elif os.path.isfile(path) and path.endswith('.tar.gz'):
-        return get_tarfile_headers(path, stop_after_first)
+        return get_tarfile_headers(path, stop_after_first, tags)
     else:
         raise Exception("{} must be a file (zip/tar) or folder.".format(path))
 
-def get_tarfile_headers(path, stop_after_first = False):
+def read_dicom_header(fileobj, tags=None, max_bytes=HEADER_READ_SIZE):
+    """
+    Read the header of a dicom from an open binary file, zip member or tar
+    member, stopping before the pixel data.
+
+    Only max_bytes are read unless the header turns out to be longer. If tags
+    is a list of keywords only those elements are parsed. Raises
+    InvalidDicomError if the file isn't a dicom.
+    """
+    data = fileobj.read(max_bytes) if max_bytes else fileobj.read()
+    if data[128:132] != b'DICM':
+        raise dcm.filereader.InvalidDicomError('File is missing DICOM '
+                                               'preamble')
+    truncated = max_bytes and len(data) == max_bytes
+
+    buf = io.BytesIO(data)
+    try:
+        header = dcm.read_file(buf, stop_before_pixels=True,
+                               specific_tags=tags)
+    except Exception:
+        if not truncated:
+            raise
+        header = None
+    # A header that stopped before the pixel data ends before the buffer does
+    if truncated and (header is None or buf.tell() >= len(data)):
+        buf = io.BytesIO(data + fileobj.read())
+        header = dcm.read_file(buf, stop_before_pixels=True,
+                               specific_tags=tags)
+    return header
+
+def get_tarfile_headers(path, stop_after_first = False, tags=None):
     """
     Get headers for dicom files within a tarball
     """
@@ -219,34 +245,36 @@ def get_tarfile_headers(path, stop_after_first = False):
         dirname = os.path.dirname(f.name)
         if dirname in manifest: continue
         try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
+            manifest[dirname] = read_dicom_header(tar.extractfile(f), tags)
             if stop_after_first: break
         except dcm.filereader.InvalidDicomError as e:
             continue
     return manifest
 
-def get_zipfile_headers(path, stop_after_first = False):
+def get_zipfile_headers(path, stop_after_first = False, tags=None):
     """
     Get headers for a dicom file within a zipfile
     """
     zf = zipfile.ZipFile(path)
 
-    manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest: continue
+    # series are kept in archive order (python 2 dicts have no order)
+    manifest = collections.OrderedDict()
+    for info in zf.infolist():
+        dirname = os.path.dirname(info.filename)
+        if dirname in manifest or info.filename.endswith('/'): continue
         try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
+            with zf.open(info) as member:
+                manifest[dirname] = read_dicom_header(member, tags)
             if stop_after_first: break
         except dcm.filereader.InvalidDicomError as e:
             continue
-        except zipfile.BadZipfile:
+        except (zipfile.BadZipfile, zlib.error):
             logger.warning('Error in zipfile:{}'
                            .format(path))
             break
     return manifest
 
-def get_folder_headers(path, stop_after_first = False):
+def get_folder_headers(path, stop_after_first = False, tags=None):
     """
     Generate a dictionary of subfolders and dicom headers.
     """
@@ -262,7 +290,8 @@ def get_folder_headers(path, stop_after_first = False):
             if os.path.isdir(filepath):
                 subdirs.append(filepath)
                 continue
-            manifest[path] = dcm.read_file(filepath)
+            with open(filepath, 'rb') as fileobj:
+                manifest[path] = read_dicom_header(fileobj, tags)
             break
         except dcm.filereader.InvalidDicomError as e:
             pass
@@ -271,10 +300,56 @@ def get_folder_headers(path, stop_after_first = False):
 
     # recurse
     for subdir in subdirs:
-        manifest.update(get_folder_headers(subdir, stop_after_first))
+        manifest.update(get_folder_headers(subdir, stop_after_first, tags))
     return manifest
 
-def get_all_headers_in_folder(path, recurse = False):
+ArchiveScan = collections.namedtuple('ArchiveScan', ['path', 'headers', 'error'])
+
+def scan_archives(paths, workers=1, stop_after_first=False, tags=None,
+                  reader=None):
+    """
+    Get dicom headers from many scan archives, using a pool of worker
+    processes when workers > 1 (on python 3, python 2 reads them one at a
+    time).
+
+    Returns a list with an ArchiveScan(path, headers, error) for each path, in
+    the same order as paths. headers is what reader (get_archive_headers by
+    default, or another module level function taking the same arguments)
+    returned for the archive. If reading an archive raised an exception
+    headers is None and error holds the exception.
+    """
+    if reader is None:
+        reader = get_archive_headers
+    paths = list(paths)
+    if workers > 1 and len(paths) > 1:
+        try:
+            # imported here so the rest of this module still imports on
+            # python 2
+            import concurrent.futures
+        except ImportError:
+            logger.warning('concurrent.futures is not available, reading '
+                           'archives one at a time')
+            workers = 1
+    if workers <= 1 or len(paths) <= 1:
+        return [_scan_archive(reader, path, stop_after_first, tags)
+                for path in paths]
+
+    # hand archives out a few at a time to keep the overhead low while still
+    # spreading slow archives across the pool
+    chunksize = max(1, len(paths) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(_scan_archive, itertools.repeat(reader),
+                                 paths, itertools.repeat(stop_after_first),
+                                 itertools.repeat(tags), chunksize=chunksize))
+
+def _scan_archive(reader, path, stop_after_first, tags):
+    try:
+        headers = reader(path, stop_after_first=stop_after_first, tags=tags)
+    except Exception as e:
+        return ArchiveScan(path, None, e)
+    return ArchiveScan(path, headers, None)
+
+def get_all_headers_in_folder(path, recurse = False, tags=None):
     """
     Get DICOM headers for all files in the given path.
 
@@ -288,7 +363,8 @@ def get_all_headers_in_folder(path, recurse = False):
             filepath = os.path.join(dirname,filename)
             headers = None
             try:
-                headers = dcm.read_file(filepath)
+                with open(filepath, 'rb') as fileobj:
+                    headers = read_dicom_header(fileobj, tags)
             except dcm.filereader.InvalidDicomError as e:
                 continue
             manifest[filepath] = headers
@@ -432,11 +508,14 @@ def run_dummy_q(list_of_names):
     run(cmd)
     logger.info('... Done.')
 
-def run(cmd, dryrun=False, specialquote=True, verbose=True):
+def run(cmd, dryrun=False, specialquote=True, verbose=True, timeout=None):
     """
     Runs the command in default shell, returning STDOUT and a return code.
     The return code uses the python convention of 0 for success, non-zero for
     failure
+
+    If timeout (in seconds) is given and the command takes longer it is
+    killed, along with anything it started, and a non-zero code is returned.
     """
     # Popen needs a string command.
     if isinstance(cmd, list):
@@ -452,8 +531,21 @@ def run(cmd, dryrun=False, specialquote=True, verbose=True):
 
     logger.debug("Executing command: {}".format(cmd))
 
-    p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
-    out, err = p.communicate()
+    if timeout is None:
+        p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE)
+        out, err = p.communicate()
+    else:
+        # the command gets its own process group so it can be killed along
+        # with its children on timeout (python 3 only)
+        p = proc.Popen(cmd, shell=True, stdout=proc.PIPE, stderr=proc.PIPE,
+                       start_new_session=True)
+        try:
+            out, err = p.communicate(timeout=timeout)
+        except proc.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+            out, err = p.communicate()
+            logger.error('run({}) killed after {} seconds'.format(cmd,
+                                                                  timeout))
 
     if p.returncode and verbose:
         logger.error('run({}) failed with returncode {}. STDERR: {}'
@@ -776,23 +868,61 @@ def submit_job(cmd, job_name, log_dir, system = 'other',
             logger.error("stdout: {}".format(out))
         sys.exit(1)
 
+def make_batches(items, batch_size):
+    """Splits a list into consecutive lists of at most batch_size items"""
+    batch_size = max(1, batch_size)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+def make_array_job(commands):
+    """
+    Returns the body of a bash script for an SGE array job that runs
+    commands[i - 1] as task i (submit it with 'qsub -t 1-<len(commands)>').
+    """
+    tasks = ['    {})\n        {}\n        ;;\n'.format(i + 1, cmd)
+             for i, cmd in enumerate(commands)]
+    return 'case "$SGE_TASK_ID" in\n{}esac\n'.format(''.join(tasks))
+
 def get_resources(open_zipfile):
-    # filter dirs
-    files = open_zipfile.namelist()
-    files = list(filter(lambda f: not f.endswith('/'), files))
+    return [info.filename for info in iter_resources(open_zipfile)]
+
+def classify_resources(open_zipfile):
+    """
+    Finds the non-dicom files in an open zip archive in a single pass over it.
 
-    # filter files named like dicoms
-    files = list(filter(lambda f: not is_named_like_a_dicom(f), files))
+    Returns a tuple of two lists of ZipInfo objects, the resource files that
+    have contents and the ones that are empty.
+    """
+    resources = []
+    empty = []
+    for info in iter_resources(open_zipfile):
+        if info.file_size:
+            resources.append(info)
+        else:
+            empty.append(info)
+    return resources, empty
 
-    # filter actual dicoms :D.
-    resource_files = []
-    for f in files:
+def iter_resources(open_zipfile):
+    """
+    Yields the ZipInfo of each member of an open zip archive that isn't a
+    directory or a dicom. Only the first 132 bytes of members that aren't
+    named like dicoms are read.
+    """
+    for info in open_zipfile.infolist():
+        # filter dirs and files named like dicoms
+        if info.filename.endswith('/') or is_named_like_a_dicom(info.filename):
+            continue
+        # filter actual dicoms :D.
+        if not info.file_size:
+            yield info
+            continue
         try:
-            if not is_dicom(io.BytesIO(open_zipfile.read(f))):
-                resource_files.append(f)
-        except zipfile.BadZipfile:
-            logger.error('Error in zipfile:{}'.format(f))
-    return resource_files
+            with open_zipfile.open(info) as member:
+                if _read_dicom_preamble(member):
+                    continue
+        except (zipfile.BadZipfile, zlib.error):
+            logger.error('Error in zipfile:{}'.format(info.filename))
+            continue
+        yield info
 
 def is_named_like_a_dicom(path):
     dcm_exts = ('dcm', 'img')
@@ -805,6 +935,189 @@ def is_dicom(fileobj):
     except dcm.filereader.InvalidDicomError:
         return False
 
+def has_dicom_preamble(path):
+    """
+    Returns True if a file starts with the 128 byte DICOM preamble followed by
+    the 'DICM' magic number. This is much cheaper than parsing the header and
+    rejects the same files pydicom would without force=True.
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            return _read_dicom_preamble(fileobj)
+    except IOError:
+        return False
+
+def _read_dicom_preamble(fileobj):
+    return fileobj.read(132)[128:] == b'DICM'
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_LOCAL_SIG = b'PK\x03\x04'
+_ZIP_DESCRIPTOR_SIG = b'PK\x07\x08'
+_ZIP_END_SIGS = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+
+class _ZipStreamReader(object):
+    """Reads exact byte counts from a stream, allowing unused bytes to be
+    pushed back"""
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b''
+
+    def read_chunk(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        return self.stream.read(self.chunk_size)
+
+    def read(self, size):
+        data = self.buffer
+        while len(data) < size:
+            chunk = self.stream.read(max(self.chunk_size, size - len(data)))
+            if not chunk:
+                raise zipfile.BadZipfile('Unexpected end of zip stream')
+            data += chunk
+        self.buffer = data[size:]
+        return data[:size]
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+def unzip_stream(stream, dest_dir, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Extracts a zip archive from a non-seekable stream (e.g. a streamed http
+    response) into dest_dir as it is read, so the archive itself never touches
+    the disk.
+
+    Returns the list of extracted file paths. Raises zipfile.BadZipfile if the
+    stream is corrupt and NotImplementedError for entries that can't be read
+    without the central directory (stored, not deflated, entries of unknown
+    size). The latter should be handled by falling back to zipfile.
+
+    Needs python 3.
+    """
+    reader = _ZipStreamReader(stream, chunk_size)
+    dest_dir = os.path.realpath(dest_dir)
+    extracted = []
+
+    while True:
+        # A stream that ends before the central directory was cut short,
+        # even if it ends between two entries, so this raises BadZipfile
+        signature = reader.read(4)
+        if signature in _ZIP_END_SIGS:
+            break
+        if signature != _ZIP_LOCAL_SIG:
+            raise zipfile.BadZipfile('Bad zip entry signature {!r}'
+                                     .format(signature))
+        reader.unread(signature)
+
+        (_, _, flags, method, _, _, crc, compressed_size, _, name_len,
+         extra_len) = _ZIP_LOCAL_HEADER.unpack(
+                reader.read(_ZIP_LOCAL_HEADER.size))
+        name = reader.read(name_len).decode('utf-8' if flags & 0x800
+                                            else 'cp437')
+        extra = reader.read(extra_len)
+        has_descriptor = flags & 0x08
+        zip64_size = _get_zip64_size(extra)
+        is_zip64 = zip64_size is not None
+        if compressed_size == 0xFFFFFFFF:
+            if not is_zip64:
+                raise zipfile.BadZipfile('Zip64 entry {} is missing its extra '
+                                         'field'.format(name))
+            compressed_size = zip64_size
+
+        if flags & 0x01:
+            raise NotImplementedError('Encrypted zip entry {}'.format(name))
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError('Unsupported compression for {}'
+                                      .format(name))
+        if method == zipfile.ZIP_STORED and has_descriptor:
+            raise NotImplementedError('Stored entry {} has no size in its '
+                                      'header'.format(name))
+
+        target = _get_zip_target(dest_dir, name)
+        if name.endswith('/'):
+            makedirs(target)
+            output = None
+        else:
+            makedirs(os.path.dirname(target))
+            output = open(target, 'wb')
+
+        try:
+            if method == zipfile.ZIP_DEFLATED:
+                checksum = _inflate_zip_entry(reader, output)
+            else:
+                checksum = _copy_zip_entry(reader, output, compressed_size)
+        finally:
+            if output:
+                output.close()
+
+        if has_descriptor:
+            descriptor = reader.read(4)
+            if descriptor != _ZIP_DESCRIPTOR_SIG:
+                reader.unread(descriptor)
+            crc = struct.unpack('<I', reader.read(4))[0]
+            # skip the compressed and uncompressed sizes
+            reader.read(16 if is_zip64 else 8)
+
+        if checksum != crc:
+            raise zipfile.BadZipfile('Bad CRC for zip entry {}'.format(name))
+        if output:
+            extracted.append(target)
+
+    return extracted
+
+def _get_zip64_size(extra):
+    """Returns the compressed size from a zip64 extra field, or None if the
+    entry has no zip64 extra field"""
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id == 0x0001:
+            return struct.unpack('<QQ', extra[4:20].ljust(16, b'\0'))[1]
+        extra = extra[4 + size:]
+    return None
+
+def _get_zip_target(dest_dir, name):
+    """Maps a zip member name to a path inside dest_dir, the same way
+    zipfile.ZipFile.extract does"""
+    parts = [part for part in name.replace('\\', '/').split('/')
+             if part and part not in ('.', '..')]
+    return os.path.join(dest_dir, *parts)
+
+def _inflate_zip_entry(reader, output):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    checksum = 0
+    while not decompressor.eof:
+        chunk = reader.read_chunk()
+        if not chunk:
+            raise zipfile.BadZipfile('Unexpected end of zip stream')
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error as e:
+            raise zipfile.BadZipfile('Corrupt zip entry: {}'.format(e))
+        checksum = zlib.crc32(data, checksum)
+        if output:
+            output.write(data)
+    reader.unread(decompressor.unused_data)
+    return checksum & 0xFFFFFFFF
+
+def _copy_zip_entry(reader, output, size):
+    checksum = 0
+    while size:
+        chunk = reader.read_chunk()
+        if not chunk:
+            raise zipfile.BadZipfile('Unexpected end of zip stream')
+        if len(chunk) > size:
+            reader.unread(chunk[size:])
+            chunk = chunk[:size]
+        size -= len(chunk)
+        checksum = zlib.crc32(chunk, checksum)
+        if output:
+            output.write(chunk)
+    return checksum & 0xFFFFFFFF
+
 def make_zip(source_dir, dest_zip):
     # Can't use shutil.make_archive here because for python 2.7 it fails on
     # large zip files (seemingly > 2GB) and zips with more than about 65000 files
@@ -3,15 +3,29 @@
 import logging
 import requests
 import time
+import random
+import hashlib
 import tempfile
 import os
 import urllib.parse
 import getpass
+import queue
+import threading
+import contextlib
+import asyncio
+import functools
+import concurrent.futures
 from datman.exceptions import XnatException
 from xml.etree import ElementTree
 
 logger = logging.getLogger(__name__)
 
+# Size of the blocks read from streamed downloads
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Base and maximum delay in seconds between attempts of a failed download
+RETRY_BACKOFF = 5
+RETRY_BACKOFF_MAX = 300
+
 def get_server(config, url=None, port=None):
     if url and not port:
         # Dont accidentally mangle user's url by appending a port from the config
@@ -62,6 +76,79 @@ def get_port_str(config, port):
 
     return port
 
+def get_connection_settings(config):
+    """
+    Returns the keyword arguments for xnat() (and ConnectionPool()) defined
+    in the site config. The settings are read from these optional keys, which
+    sit next to XNATSERVER and XNATPORT:
+
+        XNAT_POOL_SIZE: Number of HTTP connections kept open for reuse. Should
+                        be at least the number of threads sharing the client.
+        XNAT_RETRIES: Number of times to retry idempotent requests that fail
+                      to connect or get a 502, 503 or 504 response.
+        XNAT_RETRY_BACKOFF: Backoff factor (in seconds) between those retries.
+    """
+    settings = {}
+    for key, setting, cast in [('XNAT_POOL_SIZE', 'pool_size', int),
+                               ('XNAT_RETRIES', 'max_retries', int),
+                               ('XNAT_RETRY_BACKOFF', 'retry_backoff', float)]:
+        try:
+            settings[setting] = cast(config.get_key(key))
+        except KeyError:
+            continue
+    return settings
+
+def get_backoff(attempt):
+    """Returns how long to wait before retry number 'attempt' (starting at 1).
+
+    The delay grows exponentially up to RETRY_BACKOFF_MAX, and is randomized
+    so that many clients failing together don't all retry at once.
+    """
+    limit = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1))
+    return random.uniform(limit / 2.0, limit)
+
+def get_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def get_validator(response):
+    """Returns the value an If-Range header needs to resume the download in
+    response, or None if xnat sent nothing usable (weak ETags can't be used)"""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+def read_validator(part):
+    try:
+        with open(part + '.validator') as validator:
+            return validator.read().strip() or None
+    except IOError:
+        return None
+
+def write_validator(part, validator):
+    """Records the validator of the data in a .part file, so that a later run
+    can resume it. Any previous validator is removed if validator is None"""
+    path = part + '.validator'
+    if validator:
+        with open(path, 'w') as out:
+            out.write(validator)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def remove_download(filename):
+    """Deletes a (possibly partial) download, its .part file and validator"""
+    for path in [filename, filename + '.part', filename + '.part.validator']:
+        try:
+            os.remove(path)
+        except OSError as e:
+            if os.path.exists(path):
+                logger.warning('Failed to delete tempfile:{} with excuse:{}'
+                               .format(path, str(e)))
+
 def get_auth(username=None):
     if username:
         return (username, getpass.getpass())
@@ -77,17 +164,105 @@ def get_auth(username=None):
 
     return (username, password)
 
+class ConnectionPool(object):
+    """A thread safe pool of xnat connections to a single server.
+
+    Connections are opened lazily and reused. At most max_connections are
+    ever handed out at once, any further callers block until one is returned.
+    This keeps concurrent tools from overwhelming the server.
+
+    with ConnectionPool(server, username, password, 4) as pool:
+        with pool.connection() as xnat_connection:
+            xnat_connection.get_sessions(project)
+    """
+
+    def __init__(self, server, username, password, max_connections=4,
+                 **settings):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        self.server = server
+        self.auth = (username, password)
+        # extra keyword arguments for each xnat connection, see
+        # get_connection_settings()
+        self.settings = settings
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection from the pool, opening one if none are idle"""
+        self._slots.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = xnat(self.server, *self.auth, **self.settings)
+                with self._lock:
+                    self._connections.append(connection)
+            try:
+                yield connection
+            finally:
+                self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Ends every session opened by this pool on the server side"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.__exit__(None, None, None)
+            except requests.exceptions.RequestException as e:
+                logger.debug('Failed closing xnat session on {}: {}'
+                             .format(self.server, e))
+        self._idle = queue.Queue()
+
+
 class xnat(object):
+    """A client for the xnat REST API.
+
+    A single instance may be shared between threads. Its HTTP connections are
+    pooled (pool_size) and idempotent requests that fail to connect or get a
+    502/503/504 response are retried max_retries times. When the JSESSION
+    expires it is renewed once, and every request waiting on it reuses the new
+    one.
+
+    Each function in timing_hooks is called after every request as
+    hook(method, url, status_code, seconds), where status_code is None if the
+    request raised an exception.
+
+    If a datman.xnat_cache.ResponseCache is given as cache, metadata queries
+    are answered from it when possible and any put, post or delete drops the
+    cached responses it may have changed.
+    """
     server = None
     auth = None
     headers = None
     session = None
 
-    def __init__(self, server, username, password):
+    def __init__(self, server, username, password, pool_size=10,
+                 max_retries=0, retry_backoff=0.5, timing_hooks=None,
+                 cache=None):
         if server.endswith('/'):
             server = server[:-1]
         self.server = server
         self.auth = (username, password)
+        self.timing_hooks = list(timing_hooks or [])
+        self.cache = cache
+        self._session_lock = threading.Lock()
+        self._session_id = None
+        self.session = self._make_http_session(pool_size, max_retries,
+                                               retry_backoff)
         try:
             self.get_xnat_session()
         except Exception as e:
@@ -102,13 +277,23 @@ class xnat(object):
         url = '{}/data/JSESSION'.format(self.server)
         self.session.delete(url)
 
+    def _make_http_session(self, pool_size, max_retries, retry_backoff):
+        retry = requests.packages.urllib3.util.retry.Retry(
+                total=max_retries, backoff_factor=retry_backoff,
+                status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=retry)
+        s = requests.Session()
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        return s
+
     def get_xnat_session(self):
         """Setup a session with xnat"""
         url = '{}/data/JSESSION'.format(self.server)
 
-        s = requests.Session()
-
-        response = s.post(url, auth=self.auth)
+        response = self._send('post', url, auth=self.auth)
 
         if not response.status_code == requests.codes.ok:
             logger.warn('Failed connecting to xnat server:{}'
@@ -117,9 +302,76 @@ class xnat(object):
             logger.debug('Username: {}')
             response.raise_for_status()
 
-        s.cookies = requests.utils.cookiejar_from_dict({'JSESSIONID':
-                                                        response.text})
-        self.session = s
+        self.session.cookies = requests.utils.cookiejar_from_dict(
+                {'JSESSIONID': response.text})
+        self._session_id = response.text
+
+    def _renew_xnat_session(self, expired_id):
+        """Gets a new JSESSION unless another thread already replaced
+        expired_id while this one waited for the lock"""
+        with self._session_lock:
+            if self._session_id != expired_id:
+                return
+            logger.info('Session may have expired, resetting')
+            self.get_xnat_session()
+
+    def _request(self, method, url, **kwargs):
+        """Makes a request, renewing the JSESSION and trying once more if
+        the server says it has expired"""
+        session_id = self._session_id
+        # an open file is read to the end by the first attempt, so it's
+        # rewound before the retry
+        data = kwargs.get('data')
+        start = data.tell() if hasattr(data, 'seek') else None
+        try:
+            response = self._send(method, url, **kwargs)
+            if response.status_code == 401:
+                # possibly the session has timed out
+                response.close()
+                self._renew_xnat_session(session_id)
+                if start is not None:
+                    data.seek(start)
+                response = self._send(method, url, **kwargs)
+        finally:
+            if self.cache and method != 'get':
+                self.cache.invalidate(url)
+        return response
+
+    def _get_metadata(self, url):
+        """GETs a metadata query, using the response cache if there is one"""
+        if not self.cache:
+            return self._request('get', url, timeout=30)
+
+        cached = self.cache.lookup(url)
+        if cached and cached.is_fresh():
+            return cached
+
+        headers = cached.get_validators() if cached else None
+        response = self._request('get', url, timeout=30, headers=headers)
+        if response.status_code == 304 and cached:
+            return self.cache.refresh(url, cached)
+        if response.status_code == requests.codes.ok:
+            return self.cache.store(url, response)
+        self.cache.count_miss()
+        return response
+
+    def _send(self, method, url, **kwargs):
+        """Makes a single request and reports how long it took"""
+        start = time.time()
+        status = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.time() - start
+            logger.debug('{} {} returned {} after {:.3f}s'.format(
+                    method.upper(), url, status, elapsed))
+            for hook in self.timing_hooks:
+                try:
+                    hook(method, url, status, elapsed)
+                except Exception:
+                    logger.error('Request timing hook failed', exc_info=True)
 
     def get_projects(self):
         """Queries the xnat server for a list of projects"""
@@ -176,6 +428,26 @@ class xnat(object):
 
         return(result['ResultSet']['Result'])
 
+    def get_project_experiments(self, study):
+        """Returns a summary of every experiment in a project, including the
+        subject label and the insert_date / last_modified stamps, from a
+        single query"""
+        logger.debug('Querying xnat server for experiments in study: {}'
+                     .format(study))
+        url = '{}/data/archive/projects/{}/experiments/?format=json' \
+              '&columns=ID,label,subject_label,insert_date,last_modified' \
+              .format(self.server, study)
+        try:
+            result = self._make_xnat_query(url)
+        except:
+            raise XnatException("Failed getting xnat experiments with url:{}"
+                                .format(url))
+
+        if not result:
+            return []
+
+        return(result['ResultSet']['Result'])
+
     def get_session(self, study, session, full_session_id, create=False):
         """Checks to see if session exists in xnat,
         if create and study doesnt exist will try to create it
@@ -299,8 +571,8 @@ class xnat(object):
         try:
             result = self._make_xnat_query(url)
         except:
-            return XnatException('Failed getting scan with url:{}'
-                                 .format(url))
+            raise XnatException('Failed getting scan with url:{}'
+                                .format(url))
 
         if result is None:
             e = XnatException('Scan:{} not found for experiment:{}'
@@ -487,22 +759,42 @@ class xnat(object):
             self._get_xnat_stream(url, filename, retries)
             return(filename)
         except:
-            try:
-                os.remove(filename)
-            except OSError as e:
-                logger.warning('Failed to delete tempfile:{} with excuse:{}'
-                               .format(filename, str(e)))
+            remove_download(filename)
             err = XnatException("Failed getting dicom with url:{}".format(url))
             err.study = project
             err.session = session
             raise err
 
+    def get_dicom_stream(self, project, session, experiment, scan, retries=3):
+        """Opens a streamed download of a zip of a scan's dicoms.
+
+        Returns the requests response, or None if the scan has no dicoms. The
+        caller must close the response. Read the zip from response.raw as it
+        arrives, e.g. with datman.utils.unzip_stream.
+        """
+        url = '{}/data/archive/projects/{}/' \
+              'subjects/{}/experiments/{}/' \
+              'scans/{}/resources/DICOM/files?format=zip' \
+              .format(self.server, project, session, experiment, scan)
+        try:
+            response = self._open_xnat_stream(url, retries)
+        except Exception:
+            err = XnatException("Failed getting dicom with url:{}".format(url))
+            err.study = project
+            err.session = session
+            raise err
+        if response is not None:
+            # undo any gzip transfer encoding when reading from response.raw
+            response.raw.decode_content = True
+        return response
+
     def put_resource(self, project, session, experiment, filename, data, folder,
                      retries=3):
         """POST a resource file to the xnat server
         filename: string to store filename as
         data: string containing data
-            (such as produced by zipfile.ZipFile.read())"""
+            (such as produced by zipfile.ZipFile.read()) or an open file,
+            which is streamed"""
 
         resource_id = self.get_resource_ids(project,
                                             session,
@@ -536,13 +828,50 @@ class xnat(object):
             err.study = project
             err.session = session
 
+    def put_resource_archive(self, project, session, experiment, archive,
+                             folder):
+        """POST a zip of resource files to the xnat server in one request
+        archive: path to the zip file. XNAT extracts it into the resource
+            folder, keeping the paths the files have inside the zip."""
+
+        resource_id = self.get_resource_ids(project,
+                                            session,
+                                            experiment,
+                                            folderName=folder)
+
+        attach_url = "{server}/data/archive/projects/{project}/" \
+                     "subjects/{subject}/experiments/{experiment}/" \
+                     "resources/{resource_id}/" \
+                     "files/{filename}?extract=true&inbody=true"
+
+        url = attach_url.format(server=self.server,
+                                project=project,
+                                subject=session,
+                                experiment=experiment,
+                                resource_id=resource_id,
+                                filename=urllib.parse.quote(
+                                        os.path.basename(archive)))
+
+        try:
+            with open(archive, 'rb') as data:
+                self._make_xnat_post(url, data)
+        except XnatException as err:
+            err.study = project
+            err.session = session
+            raise err
+
     def get_resource(self, project, session, experiment,
                      resource_group_id, resource_id,
-                     filename=None, retries=3, zipped=True):
+                     filename=None, retries=3, zipped=True, size=None,
+                     md5=None):
         """Download a single resource from xnat to filename
         If filename is not specified creates a temporary file and
         retrns the path to that, user needs to be responsible for
-        cleaning up any created tempfiles"""
+        cleaning up any created tempfiles
+
+        If given, size and md5 (e.g. the digest from the resource catalog) are
+        checked against the downloaded file. They only make sense when zipped
+        is False"""
 
 
         url = '{}/data/archive/projects/{}/' \
@@ -563,14 +892,10 @@ class xnat(object):
             os.close(filename[0])
             filename = filename[1]
         try:
-            self._get_xnat_stream(url, filename, retries)
+            self._get_xnat_stream(url, filename, retries, size=size, md5=md5)
             return(filename)
         except:
-            try:
-                os.remove(filename)
-            except OSError as e:
-                logger.warning('Failed to delete tempfile:{} with excude:{}'
-                               .format(filename, str(e)))
+            remove_download(filename)
             logger.error('Failed getting resource from xnat', exc_info=True)
             raise XnatException("Failed downloading resource with url:{}"
                                 .format(url))
@@ -596,11 +921,7 @@ class xnat(object):
             self._get_xnat_stream(url, filename, retries)
             return(filename)
         except:
-            try:
-                os.remove(filename)
-            except OSError as e:
-                logger.warning('Failed to delete tempfile:{} with excude:{}'
-                               .format(filename, str(e)))
+            remove_download(filename)
             logger.error('Failed getting resource archive from xnat', exc_info=True)
             raise XnatException("Failed downloading resource archive with url:{}"
                                 .format(url))
@@ -623,55 +944,151 @@ class xnat(object):
             raise XnatException('Failed deleting resource with url:{}'
                                 .format(url))
 
-    def _get_xnat_stream(self, url, filename, retries=3, timeout=120):
+    def _get_xnat_stream(self, url, filename, retries=3, timeout=120,
+                         size=None, md5=None):
+        """Downloads url to filename.
+
+        Data is written to filename.part, which is only renamed to filename
+        once complete (and, if size or md5 are given, verified). If the
+        connection drops the download is resumed from the end of the .part
+        file. Resumed requests carry an If-Range header with the ETag (or
+        Last-Modified time) xnat first sent, so if the file has changed since
+        xnat sends all of it again. A .part file left behind by an earlier run
+        is only resumed if its validator was saved, and is discarded otherwise.
+        """
+        part = filename + '.part'
+        if os.path.exists(part) and read_validator(part) is None:
+            logger.info('Discarding unverifiable partial download {}'.format(
+                    part))
+            os.remove(part)
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            try:
+                if self._stream_to_file(url, part, offset, retries, timeout,
+                                        read_validator(part)):
+                    break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if attempt >= retries:
+                    logger.error('Failed reading from xnat')
+                    raise(e)
+                attempt += 1
+                delay = get_backoff(attempt)
+                logger.warning('Download of {} interrupted, resuming in {:.0f}'
+                               's. Reason: {}'.format(url, delay, e))
+                time.sleep(delay)
+                continue
+            except IOError as e:
+                logger.error('Failed writing to file')
+                raise(e)
+            # Nothing found at url
+            return
+
+        received = os.path.getsize(part)
+        write_validator(part, None)
+        if size is not None and received != int(size):
+            os.remove(part)
+            raise XnatException('Downloaded {} bytes from {}, expected {}'
+                                .format(received, url, size))
+        if md5 and get_md5(part) != md5.lower():
+            os.remove(part)
+            raise XnatException('Checksum of file downloaded from {} does not '
+                                'match'.format(url))
+        os.replace(part, filename)
+
+    def _stream_to_file(self, url, part, offset, retries, timeout,
+                        validator=None):
+        """Appends the contents of url from byte offset onwards to part, or
+        rewrites part if xnat sends the whole file. Returns False if nothing
+        exists at url"""
+        response = self._open_xnat_stream(url, retries, timeout, offset=offset,
+                                          validator=validator)
+        if response is None:
+            return False
+
+        with contextlib.closing(response):
+            if response.status_code == 416:
+                # part already holds the whole file
+                return True
+            if offset and response.status_code != 206:
+                logger.info('xnat ignored the resume request for {} (or the '
+                            'file changed), restarting download'.format(url))
+                offset = 0
+            if not offset:
+                write_validator(part, get_validator(response))
+
+            received = 0
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+
+            expected = response.headers.get('Content-Length')
+            if (expected and 'Content-Encoding' not in response.headers
+                    and received < int(expected)):
+                raise requests.exceptions.ChunkedEncodingError(
+                        'Connection closed after {} of {} bytes'.format(
+                        received, expected))
+        return True
+
+    def _open_xnat_stream(self, url, retries=3, timeout=120, offset=0,
+                          attempt=1, validator=None):
+        """Starts a streamed GET request, returning the response once xnat has
+        accepted it or None if nothing exists at url. If offset is given only
+        the data from that byte onwards is requested, and if validator is also
+        given only if the file still matches it"""
         logger.debug('Getting {} from XNAT'.format(url))
+        headers = None
+        if offset:
+            headers = {'Range': 'bytes={}-'.format(offset)}
+            if validator:
+                headers['If-Range'] = validator
         try:
-            response = self.session.get(url, stream=True, timeout=timeout)
+            response = self._request('get', url, stream=True, timeout=timeout,
+                                     headers=headers)
         except requests.exceptions.Timeout as e:
             if retries > 0:
-                return(self._get_xnat_stream(url, filename, retries=retries-1,
-                                             timeout=timeout*2))
+                return(self._open_xnat_stream(url, retries=retries-1,
+                                              timeout=timeout*2,
+                                              offset=offset,
+                                              attempt=attempt + 1,
+                                              validator=validator))
             else:
                 raise e
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, stream=True, timeout=timeout)
-
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
                          .format(url))
+            response.close()
             return
-        elif response.status_code is 504:
+        elif response.status_code in (206, 416) and offset:
+            return response
+        elif response.status_code == 504:
+            response.close()
             if retries:
                 logger.warning('xnat server timed out, retrying')
-                time.sleep(30)
-                self._get_xnat_stream(url, filename, retries=retries - 1,
-                                      timeout=timeout * 2)
+                time.sleep(get_backoff(attempt))
+                return(self._open_xnat_stream(url, retries=retries - 1,
+                                              timeout=timeout * 2,
+                                              offset=offset,
+                                              attempt=attempt + 1,
+                                              validator=validator))
             else:
                 logger.error('xnat server timed out, giving up')
                 response.raise_for_status()
-        elif response.status_code is not 200:
+        elif response.status_code != 200:
             logger.error('xnat error:{} at data upload'
                          .format(response.status_code))
+            response.close()
             response.raise_for_status()
 
-        with open(filename, 'wb') as f:
-            try:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
-            except requests.exceptions.RequestException as e:
-                logger.error('Failed reading from xnat')
-                raise(e)
-            except IOError as e:
-                logger.error('Failed writing to file')
-                raise(e)
+        return response
 
     def _make_xnat_query(self, url, retries=3):
         try:
-            response = self.session.get(url, timeout=30)
+            response = self._get_metadata(url)
         except requests.exceptions.Timeout as e:
             if retries > 0:
                 return(self._make_xnat_query(url, retries=retries-1))
@@ -680,12 +1097,6 @@ class xnat(object):
                              .format(url))
                 raise e
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
-
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
                          .format(url))
@@ -700,19 +1111,13 @@ class xnat(object):
 
     def _make_xnat_xml_query(self, url, retries=3):
         try:
-            response = self.session.get(url, timeout=30)
+            response = self._get_metadata(url)
         except requests.exceptions.Timeout as e:
             if retries > 0:
                 return(self._make_xnat_xml_query(url, retries=retries-1))
             else:
                 raise e
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
-
         if response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
                          .format(url))
@@ -732,16 +1137,10 @@ class xnat(object):
             requests.exceptions.HTTPError()
 
         try:
-            response = self.session.put(url, timeout=30)
+            response = self._request('put', url, timeout=30)
         except requests.exceptions.Timeout:
             return(self._make_xnat_put(url, retries=retries-1))
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.put(url, timeout=30)
-
         if not response.status_code in [200, 201]:
             logger.warn("http client error at folder creation: {}"
                         .format(response.status_code))
@@ -749,24 +1148,21 @@ class xnat(object):
 
     def _make_xnat_post(self, url, data, retries=3, headers=None):
         logger.debug('POSTing data to xnat, {} retries left'.format(retries))
-        response = self.session.post(url,
-                                     headers=headers,
-                                     data=data,
-                                     timeout=60*60)
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.post(url,
-                                         headers=headers,
-                                         data=data)
+        # open files are streamed, they must be rewound before a retry
+        start = data.tell() if hasattr(data, 'seek') else None
+        response = self._request('post', url,
+                                 headers=headers,
+                                 data=data,
+                                 timeout=60*60)
 
         if response.status_code is 504:
             if retries:
                 logger.warning('xnat server timed out, retrying')
                 time.sleep(30)
-                self._make_xnat_post(url, data, retries=retries - 1)
+                if start is not None:
+                    data.seek(start)
+                return self._make_xnat_post(url, data, retries=retries - 1,
+                                            headers=headers)
             else:
                 logger.warn('xnat server timed out, giving up')
                 response.raise_for_status()
@@ -787,22 +1183,107 @@ class xnat(object):
 
     def _make_xnat_delete(self, url, retries=3):
         try:
-            response = self.session.delete(url, timeout=30)
+            response = self._request('delete', url, timeout=30)
         except requests.exceptions.Timeout:
             return(self._make_xnat_delete(url, retries=retries-1))
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.delete(url, timeout=30)
-
         if not response.status_code in [200, 201]:
             logger.warn("http client error deleting resource: {}"
                         .format(response.status_code))
             response.raise_for_status()
 
 
+class AsyncXnat(object):
+    """An asyncio interface to an xnat connection for crawling metadata.
+
+    Each query method of xnat is available as a coroutine with the same name,
+    arguments, return value and exceptions. Calls run on a pool of at most
+    max_concurrent threads that share the wrapped connection, so they also
+    share its login, its JSESSION renewal and its 401/404/504 handling. Give
+    the connection a pool_size of at least max_concurrent.
+
+        async def get_all_experiments(client, project):
+            sessions = await client.get_sessions(project)
+            return await asyncio.gather(*[
+                    client.get_experiments(project, session['label'])
+                    for session in sessions])
+
+        with datman.xnat.xnat(server, username, password,
+                              pool_size=16) as connection:
+            with datman.xnat.AsyncXnat(connection, max_concurrent=16) as client:
+                loop = asyncio.get_event_loop()
+                experiments = loop.run_until_complete(
+                        get_all_experiments(client, project))
+    """
+
+    def __init__(self, connection, max_concurrent=8):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.connection = connection
+        self.max_concurrent = max_concurrent
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_concurrent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+                self._executor, functools.partial(method, *args, **kwargs))
+
+def _make_async_method(name):
+    async def method(self, *args, **kwargs):
+        return await self._run(getattr(self.connection, name), *args,
+                               **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of xnat.{}".format(name)
+    return method
+
+ASYNC_METHODS = ['get_projects', 'get_project', 'get_sessions',
+                 'get_project_experiments', 'get_session', 'get_experiments',
+                 'get_experiment', 'get_scan_list', 'get_scan_info',
+                 'get_resource_ids', 'get_resource_list', 'find_session']
+
+for _name in ASYNC_METHODS:
+    setattr(AsyncXnat, _name, _make_async_method(_name))
+
+def gather_queries(connection, queries, max_concurrent=8):
+    """Runs many queries of an xnat connection at once from synchronous code.
+
+    queries is a list of (method name, args) pairs, e.g.
+    [('get_sessions', (project,)) for project in projects]. The results are
+    returned in the same order, with the exception a query raised in place of
+    its result if it failed. This can be called from any thread, since each
+    call runs its own event loop.
+    """
+    if not queries:
+        return []
+
+    async def run_all(client):
+        return await asyncio.gather(
+                *[getattr(client, name)(*args) for name, args in queries],
+                return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with AsyncXnat(connection, min(max_concurrent, len(queries))) as client:
+            return loop.run_until_complete(run_all(client))
+    finally:
+        loop.close()
+
+
 class Session(object):
 
     raw_json = None
@@ -982,12 +1463,16 @@ class Session(object):
         """
         Returns a list of all resource URIs from this session.
         """
-        resources = []
-        resource_ids = self.resource_IDs.values()
+        resource_ids = list(self.resource_IDs.values())
         #resource_ids.extend(self.misc_resource_IDs)
-        for r_id in resource_ids:
-            resource_list = xnat_connection.get_resource_list(self.project,
-                    self.name, self.experiment_label, r_id)
+        # the resource lists are fetched concurrently
+        results = gather_queries(xnat_connection,
+                [('get_resource_list', (self.project, self.name,
+                  self.experiment_label, r_id)) for r_id in resource_ids])
+        resources = []
+        for resource_list in results:
+            if isinstance(resource_list, Exception):
+                raise resource_list
             resources.extend([item['URI'] for item in resource_list])
         return resources
 
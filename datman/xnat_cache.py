@@ -0,0 +1,222 @@
+"""
+An optional cache for the read only metadata queries made by datman.xnat.
+
+Cached responses are kept in memory and, if a path is given, in a SQLite file
+so they can be reused by later runs. Each entry expires after a time to live
+chosen by matching its url against a list of patterns. Expired entries that
+XNAT sent an ETag or Last-Modified header for are revalidated with a
+conditional request instead of being downloaded again. Any put, post or
+delete made through the same client drops the cached entries for the urls it
+may have changed.
+
+    cache = datman.xnat_cache.ResponseCache(default_ttl=120)
+    xnat = datman.xnat.xnat(server, username, password, cache=cache)
+    ...
+    logger.info(cache.stats())
+"""
+import re
+import json
+import time
+import logging
+import sqlite3
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# (pattern, seconds) pairs, matched against the path of each url. The first
+# matching pattern sets the time to live of a response.
+DEFAULT_TTLS = [
+    # the list of projects and project details rarely change
+    (r'/projects/?$', 3600),
+    (r'/projects/[^/]+/?$', 3600),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expires REAL NOT NULL
+);
+"""
+
+
+class CachedResponse(object):
+    """Stands in for a requests response with status 200"""
+
+    status_code = 200
+
+    def __init__(self, text, etag=None, last_modified=None, expires=0):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def get_validators(self):
+        """Returns headers for a conditional request, or None if XNAT
+        didn't provide an ETag or Last-Modified header"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers or None
+
+
+class ResponseCache(object):
+    """A thread safe cache of successful xnat GET responses.
+
+    hits counts responses served without contacting XNAT, revalidated counts
+    expired responses XNAT confirmed were unchanged and misses counts the rest.
+    """
+
+    def __init__(self, default_ttl=60, ttls=None, path=None):
+        self.default_ttl = default_ttl
+        if ttls is None:
+            ttls = DEFAULT_TTLS
+        self.ttls = [(re.compile(pattern), seconds)
+                     for pattern, seconds in ttls]
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'revalidated': self.revalidated}
+
+    def get_ttl(self, url):
+        path = urllib.parse.urlparse(url).path
+        for pattern, seconds in self.ttls:
+            if pattern.search(path):
+                return seconds
+        return self.default_ttl
+
+    def lookup(self, url):
+        """Returns the cached response for url, which may have expired, or
+        None. Fresh responses are counted as hits"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None and self._db:
+                row = self._db.execute(
+                        'SELECT text, etag, last_modified, expires '
+                        'FROM responses WHERE url = ?', (url,)).fetchone()
+                if row:
+                    entry = CachedResponse(*row)
+                    self._entries[url] = entry
+            if entry is not None and entry.is_fresh():
+                self.hits += 1
+        return entry
+
+    def store(self, url, response):
+        """Caches a successful response and counts it as a miss"""
+        entry = CachedResponse(response.text,
+                               etag=response.headers.get('ETag'),
+                               last_modified=response.headers.get(
+                                       'Last-Modified'),
+                               expires=time.time() + self.get_ttl(url))
+        with self._lock:
+            self.misses += 1
+            self._entries[url] = entry
+            if self._db:
+                with self._db:
+                    self._db.execute(
+                            'INSERT OR REPLACE INTO responses (url, text, '
+                            'etag, last_modified, expires) VALUES '
+                            '(?, ?, ?, ?, ?)',
+                            (url, entry.text, entry.etag,
+                             entry.last_modified, entry.expires))
+        return entry
+
+    def refresh(self, url, entry):
+        """Marks an expired response XNAT reported as unchanged as fresh"""
+        entry.expires = time.time() + self.get_ttl(url)
+        with self._lock:
+            self.revalidated += 1
+            if self._db:
+                with self._db:
+                    self._db.execute(
+                            'UPDATE responses SET expires = ? WHERE url = ?',
+                            (entry.expires, url))
+        return entry
+
+    def count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def invalidate(self, url):
+        """Drops every entry that a change made at url may have affected.
+
+        That is any entry for the same object, an object containing it (e.g.
+        the experiment a resource belongs to) or an object inside it. Changes
+        made through urls not rooted at a project (e.g. the import service)
+        clear the whole cache, since the objects they touch can't be told from
+        the url.
+        """
+        key = _get_object_path(url)
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                if self._db:
+                    with self._db:
+                        self._db.execute('DELETE FROM responses')
+                return
+
+            urls = list(self._entries)
+            if self._db:
+                urls.extend(row[0] for row in self._db.execute(
+                        'SELECT url FROM responses'))
+            stale = set(cached for cached in urls
+                        if _is_related(key, _get_object_path(cached)))
+            for cached in stale:
+                self._entries.pop(cached, None)
+            if self._db and stale:
+                with self._db:
+                    self._db.executemany('DELETE FROM responses WHERE url = ?',
+                                         [(cached,) for cached in stale])
+        logger.debug('Dropped {} cached responses after change to {}'
+                     .format(len(stale), url))
+
+
+def _get_object_path(url):
+    """Returns the part of a url's path that identifies an xnat object, e.g.
+    'projects/P/subjects/S', regardless of whether the /data/archive, /data or
+    /REST api was used. Returns None for urls not rooted at a project"""
+    path = urllib.parse.urlparse(url).path.strip('/')
+    for prefix in ['data/archive/', 'data/', 'REST/']:
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+            break
+    if not path.startswith('projects'):
+        return None
+    return path
+
+
+def _is_related(changed, cached):
+    if cached is None:
+        return False
+    return (changed == cached or changed.startswith(cached + '/') or
+            cached.startswith(changed + '/'))
@@ -5,13 +5,27 @@ import yaml
 import sys
 import collections
 
+# libyaml's parser is many times faster than the pure python one, but is only
+# available if pyyaml was built against it
+try:
+    SafeLoader = yaml.CSafeLoader
+except AttributeError:
+    SafeLoader = yaml.SafeLoader
+
+def parse_yaml(stream):
+    """
+    Parses a YAML document from a string or open file with the fastest safe
+    loader available.
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
 def load_yaml(filename):
     """
     Attempts to load a YAML file. Complains and exits if it fails.
     """
     try:
         with open(filename, 'r') as stream:
-            data = yaml.load(stream)
+            data = parse_yaml(stream)
     except:
         print("ERROR: Supplied configuration file {} is not a properly-formatted YAML file.".format(filename))
         sys.exit(1)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Measures how long datman takes to read its configuration at startup.
+
+Usage:
+    benchmark_config_startup.py [options]
+
+Options:
+    --projects N        Number of projects in the generated site config
+                        [default: 100]
+    --repeat N          Number of times to repeat each measurement [default: 20]
+
+Generates a site config with N projects (and a settings file for each) in a
+temporary folder, then reports:
+    - the time to parse the site config with the pure python yaml loader and
+      with the loader datman uses (libyaml's CSafeLoader when available)
+    - the time for a fresh python process to import datman.config and find a
+      study's metadata path, as every short lived datman script does
+    - the time to map a site tag onto its project, which reads every
+      project's settings file
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import yaml
+from docopt import docopt
+
+import datman.config
+import datman.yamltools
+
+STARTUP_SCRIPT = """
+import datman.config
+cfg = datman.config.config(filename={site!r}, system='bench', study='P001')
+cfg.get_path('meta')
+"""
+
+
+def make_config(dest, num_projects):
+    site = {'SystemSettings': {'bench': {'DATMAN_PROJECTSDIR': '/archive',
+                                         'CONFIG_DIR': dest}},
+            'Paths': {'meta': 'metadata/', 'zips': 'data/zips/'},
+            'Projects': {},
+            'ExportSettings': {}}
+    for num in range(50):
+        site['ExportSettings']['TAG{:02}'.format(num)] = {
+                'formats': ['nii', 'dcm', 'mnc'], 'qc_type': 'anat'}
+
+    for num in range(1, num_projects + 1):
+        project = 'P{:03}'.format(num)
+        site['Projects'][project] = '{}_settings.yml'.format(project)
+        study = {'PROJECTDIR': project.lower(), 'STUDY_TAG': project,
+                 'Sites': {}}
+        for site_num in range(3):
+            study['Sites']['S{}'.format(site_num)] = {
+                    'XNAT_Archive': '{}_S{}'.format(project, site_num),
+                    'SITE_TAGS': ['{}S{}'.format(project, site_num)],
+                    'ExportInfo': {
+                        'TAG{:02}'.format(tag): {'Pattern': 'Series{}'.format(
+                                tag), 'Count': 1} for tag in range(30)}}
+        with open(os.path.join(dest, site['Projects'][project]), 'w') as out:
+            yaml.dump(study, out)
+
+    site_file = os.path.join(dest, 'site_config.yml')
+    with open(site_file, 'w') as out:
+        yaml.dump(site, out)
+    return site_file
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def parse(site_file, loader):
+    with open(site_file) as stream:
+        yaml.load(stream, Loader=loader)
+
+
+def main():
+    arguments = docopt(__doc__)
+    num_projects = int(arguments['--projects'])
+    repeat = int(arguments['--repeat'])
+
+    dest = tempfile.mkdtemp()
+    try:
+        site_file = make_config(dest, num_projects)
+        print('Site config with {} projects'.format(num_projects))
+
+        pure = best_of(repeat, lambda: parse(site_file, yaml.SafeLoader))
+        fast = best_of(repeat, lambda: parse(site_file,
+                                             datman.yamltools.SafeLoader))
+        print('  parse site config, {:<13}{:8.2f} ms'.format(
+                'SafeLoader:', pure * 1000))
+        print('  parse site config, {:<13}{:8.2f} ms'.format(
+                datman.yamltools.SafeLoader.__name__ + ':', fast * 1000))
+
+        script = STARTUP_SCRIPT.format(site=site_file)
+        startup = best_of(max(1, repeat // 4), lambda: subprocess.check_call(
+                [sys.executable, '-c', script]))
+        print('  new process, config + get_path:  {:8.2f} ms'.format(
+                startup * 1000))
+
+        def map_tag():
+            datman.config.clear_cache()
+            cfg = datman.config.config(filename=site_file, system='bench')
+            cfg.set_study('P{:03}S0_S0_0001_01_01'.format(num_projects))
+        print('  map site tag to project, cold:   {:8.2f} ms'.format(
+                best_of(repeat, map_tag) * 1000))
+    finally:
+        shutil.rmtree(dest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Measures how long write_manifest.py takes to renumber a manifest.
+
+Usage:
+    benchmark_write_manifest.py [options]
+
+Options:
+    --rows N            Number of rows in the generated manifest
+                        [default: 30000]
+    --new N             Number of those rows that are new archives
+                        [default: 500]
+    --repeat N          Number of times to repeat each measurement [default: 3]
+    --skip-loops        Don't time the row by row implementation (it takes
+                        minutes on large manifests)
+
+Generates a manifest with N rows, then reports the time to append the new
+rows, sort, renumber visits and sessions and generate the XNAT session ids,
+both with write_manifest.py's functions and with the row by row loops they
+replaced. The two manifests are also checked to be byte identical.
+"""
+import time
+import random
+import importlib
+
+import pandas as pd
+from docopt import docopt
+
+write_manifest = importlib.import_module('bin.write_manifest')
+
+
+def make_rows(num_rows, seed=0):
+    rand = random.Random(seed)
+    rows = []
+    for num in range(num_rows):
+        patient = 'P{:05}'.format(rand.randint(0, num_rows // 4))
+        rows.append(['archive{}'.format(num), patient, patient,
+                     20150101 + rand.randint(0, 3) * 10000,
+                     rand.choice([90000, 91500, 130000]), 1, 1,
+                     rand.choice(['', '', '', '<ignore>']), ''])
+    return rows
+
+
+def loop_append(manifest, rows):
+    for row in rows:
+        manifest = manifest.append(pd.DataFrame(
+                [row], columns=write_manifest.columns))
+    return manifest
+
+
+def loop_reindex_visits(dataframe):
+    for index, row in dataframe.iterrows():
+        if index == 0:
+            continue
+        prev_row = dataframe.iloc[index-1]
+
+        if row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] > prev_row['StudyDate']:
+            dataframe.at[index, 'visit'] = prev_row['visit'] + 1
+        elif row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate']:
+            dataframe.at[index, 'visit'] = prev_row['visit']
+    return dataframe
+
+
+def loop_reindex_sessions(dataframe):
+    for index, row in dataframe.iterrows():
+        if index == 0:
+            continue
+        prev_row = dataframe.iloc[index-1]
+
+        if row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate'] and row['StudyTime'] > prev_row['StudyTime']:
+            dataframe.at[index, 'session'] = prev_row['session'] + 1
+        elif row['PatientName'] == prev_row['PatientName'] and row['StudyDate'] == prev_row['StudyDate'] and row['StudyTime'] == prev_row['StudyTime']:
+            dataframe.at[index, 'session'] = prev_row['session']
+    return dataframe
+
+
+def loop_generate_xnat_sessionIDs(study, dataframe):
+    for index, row in dataframe.iterrows():
+        if row['target_name'] == '<ignore>':
+            continue
+        subjectid = write_manifest.get_subjectid(study, row['PatientName'])
+        uid = (study + '_'
+                + 'CMH_'
+                + subjectid + '_'
+                + str(row['visit']).zfill(2) + '_'
+                + 'SE' + str(row['session']).zfill(2) + '_'
+                + 'MR')
+        dataframe.at[index, 'target_name'] = uid
+    return dataframe
+
+
+def vectorized_append(manifest, rows):
+    return pd.concat([manifest, pd.DataFrame(rows,
+                                             columns=write_manifest.columns)])
+
+
+IMPLEMENTATIONS = {
+    'row by row': (loop_append, loop_reindex_visits, loop_reindex_sessions,
+                   loop_generate_xnat_sessionIDs),
+    'vectorized': (vectorized_append, write_manifest.reindex_visits,
+                   write_manifest.reindex_sessions,
+                   write_manifest.generate_xnat_sessionIDs)}
+
+
+def update(manifest, new_rows, implementation):
+    append, visits, sessions, session_ids = implementation
+    manifest = append(manifest.copy(), new_rows)
+    manifest.sort_values(['PatientName', 'StudyDate', 'StudyTime'],
+                         inplace=True)
+    manifest.reset_index(drop=True, inplace=True)
+    manifest = visits(manifest)
+    manifest = sessions(manifest)
+    manifest = session_ids('STUDY', manifest)
+    return manifest.to_csv(index=False)
+
+
+def main():
+    arguments = docopt(__doc__)
+    num_rows = int(arguments['--rows'])
+    num_new = int(arguments['--new'])
+    repeat = int(arguments['--repeat'])
+
+    rows = make_rows(num_rows)
+    manifest = pd.DataFrame(rows[:num_rows - num_new],
+                            columns=write_manifest.columns)
+    manifest = manifest.astype(write_manifest.dtypes)
+    new_rows = rows[num_rows - num_new:]
+    print('Manifest with {} rows, {} new'.format(num_rows, num_new))
+
+    names = ['vectorized']
+    if not arguments['--skip-loops']:
+        names.append('row by row')
+
+    outputs = {}
+    for name in names:
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            outputs[name] = update(manifest, new_rows, IMPLEMENTATIONS[name])
+            times.append(time.time() - start)
+        print('  {:<12}{:10.3f} s'.format(name + ':', min(times)))
+
+    if len(outputs) > 1:
+        identical = outputs['vectorized'] == outputs['row by row']
+        print('  output identical: {}'.format(identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Measures how long crawling the metadata of an xnat project takes when the
+queries are made one after another and when they're made with
+datman.xnat.gather_queries.
+
+Usage:
+    benchmark_xnat_crawl.py [options]
+
+Options:
+    --sessions N        Number of sessions in the project [default: 2000]
+    --resources N       Number of resource folders in each session
+                        [default: 2]
+    --latency SECONDS   How long the simulated server takes to answer each
+                        query [default: 0.02]
+    --concurrent N      Number of queries gather_queries runs at once
+                        [default: 16]
+
+No server is contacted. A stand in for datman.xnat.xnat sleeps for the given
+latency on each query, so the timings show how much of the round trip time
+each approach overlaps. The crawl fetches every session's experiment and the
+file list of each of its resource folders, and the results of both
+approaches are checked to be identical.
+"""
+import time
+
+from docopt import docopt
+
+import datman.xnat
+
+
+class SlowXnat(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_experiment(self, project, session, experiment):
+        time.sleep(self.latency)
+        return {'label': experiment}
+
+    def get_resource_list(self, project, session, experiment, resource_id):
+        time.sleep(self.latency)
+        return [{'URI': '{}/{}/notes.txt'.format(experiment, resource_id)}]
+
+
+def make_queries(num_sessions, num_resources):
+    queries = []
+    for num in range(num_sessions):
+        session = 'STUDY_CMH_{:04}_01'.format(num)
+        args = ('STUDY', session, session + '_01')
+        queries.append(('get_experiment', args))
+        queries.extend(('get_resource_list', args + (str(resource),))
+                       for resource in range(num_resources))
+    return queries
+
+
+def crawl_serially(connection, queries):
+    return [getattr(connection, name)(*args) for name, args in queries]
+
+
+def main():
+    arguments = docopt(__doc__)
+    num_sessions = int(arguments['--sessions'])
+    num_resources = int(arguments['--resources'])
+    latency = float(arguments['--latency'])
+    concurrent = int(arguments['--concurrent'])
+
+    connection = SlowXnat(latency)
+    queries = make_queries(num_sessions, num_resources)
+    print('{} sessions, {} queries, {} s per query'.format(
+            num_sessions, len(queries), latency))
+
+    start = time.time()
+    serial = crawl_serially(connection, queries)
+    print('  {:<16}{:10.3f} s'.format('one at a time:', time.time() - start))
+
+    start = time.time()
+    gathered = datman.xnat.gather_queries(connection, queries,
+                                          max_concurrent=concurrent)
+    print('  {:<16}{:10.3f} s'.format('gather_queries:', time.time() - start))
+    print('  output identical: {}'.format(serial == gathered))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+import subprocess
+
+from test_utils import make_dicom
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'bin', 'archive-manifest.py')
+
+
+class TestArchiveManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archives = []
+        for name in ['exam1', 'exam2']:
+            archive = os.path.join(self.tmpdir, name + '.zip')
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                zip_file.writestr('EXAM/1/1.dcm',
+                                  make_dicom(series_uid='1.2.1.' + name[-1]))
+                zip_file.writestr('EXAM/2/1.dcm',
+                                  make_dicom(series_uid='1.2.2.' + name[-1]))
+            self.archives.append(archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_manifest(self, *args):
+        env = dict(os.environ)
+        env['DM_HEADER_CACHE'] = os.path.join(self.tmpdir, 'headers.sqlite')
+        env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(SCRIPT))] +
+                [p for p in [env.get('PYTHONPATH')] if p])
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                    [sys.executable, SCRIPT] + list(args), env=env,
+                    stderr=devnull)
+        return output.decode('utf-8')
+
+    def test_lists_series_of_each_archive(self):
+        output = self.run_manifest('--headers', 'SeriesInstanceUID',
+                                   *self.archives)
+
+        assert output.split() == ['Path,SeriesInstanceUID',
+                                  'EXAM/1,1.2.1.1',
+                                  'EXAM/2,1.2.2.1',
+                                  'EXAM/1,1.2.1.2',
+                                  'EXAM/2,1.2.2.2']
+
+    def test_jobs_gives_same_output(self):
+        args = ['--headers', 'SeriesInstanceUID'] + self.archives
+
+        assert (self.run_manifest('--jobs', '2', *args) ==
+                self.run_manifest(*args))
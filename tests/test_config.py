@@ -17,3 +17,84 @@ def test_initialise_from_environ():
     os.environ['DM_CONFIG'] = os.path.join(FIXTURE_DIR, 'site_config.yml')
     os.environ['DM_SYSTEM'] = 'test'
     cfg = config.config()
+
+class TestConfigCache(unittest.TestCase):
+    site_config = """
+SystemSettings:
+  test:
+    DATMAN_PROJECTSDIR: /archive/data
+    CONFIG_DIR: {config_dir}
+Projects:
+  STUDY: study_settings.yml
+ExportSettings:
+  T1: {{Formats: [nii]}}
+"""
+    study_config = """
+STUDY_TAG: STUDY
+PROJECTDIR: study
+Sites:
+  CMH:
+    SITE_TAGS: [STU]
+    ExportInfo:
+      T1: {{Pattern: {pattern}, Count: 1}}
+"""
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.site_file = os.path.join(self.tmpdir, 'site_config.yml')
+        self.study_file = os.path.join(self.tmpdir, 'study_settings.yml')
+        with open(self.site_file, 'w') as site_config:
+            site_config.write(self.site_config.format(config_dir=self.tmpdir))
+        self.write_study('T1')
+        config.clear_cache()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+        config.clear_cache()
+
+    def write_study(self, pattern):
+        with open(self.study_file, 'w') as study_config:
+            study_config.write(self.study_config.format(pattern=pattern))
+
+    def make_config(self):
+        return config.config(filename=self.site_file, system='test',
+                             study='STUDY')
+
+    def test_files_are_parsed_once(self):
+        import yaml
+        from mock import patch
+        with patch('yaml.load', wraps=yaml.load) as mock_load:
+            first = self.make_config()
+            second = self.make_config()
+            assert first.get_tags('CMH') is second.get_tags('CMH')
+
+        assert mock_load.call_count == 2
+        assert first.get_study_tags() == {'STUDY': ['CMH'], 'STU': ['CMH']}
+
+    def test_edited_file_is_read_again(self):
+        assert self.make_config().get_tags('CMH').series_map == {'T1': 'T1'}
+
+        self.write_study('MPRAGE_LONGER')
+
+        series_map = self.make_config().get_tags('CMH').series_map
+        assert series_map == {'MPRAGE_LONGER': 'T1'}
+
+    def test_study_config_is_read_when_first_needed(self):
+        import yaml
+        from mock import patch
+        with patch('yaml.load', wraps=yaml.load) as mock_load:
+            cfg = self.make_config()
+            assert mock_load.call_count == 1
+
+            assert cfg.study_config['STUDY_TAG'] == 'STUDY'
+            assert mock_load.call_count == 2
+
+    def test_maps_study_tag_to_project(self):
+        cfg = config.config(filename=self.site_file, system='test')
+
+        cfg.set_study('STU_CMH_0001_01_01')
+
+        assert cfg.study_name == 'STUDY'
+        assert cfg.study_config['PROJECTDIR'] == 'study'
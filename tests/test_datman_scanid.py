@@ -95,4 +95,31 @@ def test_parse_filename_with_path():
     eq_(series, '02')
     eq_(description, 'description')
 
+
+def test_parse_returns_memoized_identifier():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    ok_(scanid.parse("DTI_CMH_H001_01_02") is ident)
+
+@raises(AttributeError)
+def test_identifier_is_immutable():
+    ident = scanid.parse("DTI_CMH_H001_01_02")
+    ident.session = '03'
+
+def test_replace_returns_modified_copy():
+    ident = scanid.parse("DTI_CMH_H001_01_XX_MR")
+    new_ident = ident.replace(session='01')
+    eq_(new_ident.session, '01')
+    eq_(ident.session, '')
+    eq_(new_ident, scanid.parse("DTI_CMH_H001_01_01_MR"))
+
+def test_parse_many_skips_invalid_names():
+    parsed = scanid.parse_many(["DTI_CMH_H001_01_01_MR_T1_02_SagT1.nii.gz",
+                                "garbage.nii.gz",
+                                "DTI_CMH_H002_01_01_MR_DTI_04_Ax-DTI.bvec"],
+                               filenames=True)
+    eq_(list(parsed), ["DTI_CMH_H001_01_01_MR_T1_02_SagT1.nii.gz",
+                       "DTI_CMH_H002_01_01_MR_DTI_04_Ax-DTI.bvec"])
+    eq_(parsed["DTI_CMH_H002_01_01_MR_DTI_04_Ax-DTI.bvec"][1:3],
+        ("DTI", "04"))
+
 # vim: ts=4 sw=4:
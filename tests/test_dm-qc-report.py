@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 import importlib
 import logging
@@ -170,33 +172,37 @@ class RunHeaderQC(unittest.TestCase):
     log = './qc/subject_id/header-diff.log'
 
     @patch('bin.dm_qc_report.get_standards')
-    @patch('datman.utils.run')
-    def test_doesnt_crash_with_empty_dicom_dir(self, mock_run, mock_standards):
+    @patch('datman.header_checks.compare_files')
+    def test_doesnt_crash_with_empty_dicom_dir(self, mock_compare,
+            mock_standards):
         subject = datman.scan.Scan('STUDY_SITE_ID_01', config)
         assert subject.dicoms == []
 
         mock_standards.return_value = ['STUDY_CAMH_0001_01_01_T1_02_SagT1-BRAVO.dcm']
 
-        qc.run_header_qc(subject, self.standards, self.log)
-        assert mock_run.call_count == 0
+        qc.run_header_qc(subject, self.standards, self.log, config)
+        assert mock_compare.call_count == 0
 
     @patch('datman.scan.Scan')
     @patch('bin.dm_qc_report.get_standards')
-    @patch('datman.utils.run')
-    def test_doesnt_crash_without_matching_standards(self, mock_run,
+    @patch('datman.header_checks.compare_files')
+    def test_doesnt_crash_without_matching_standards(self, mock_compare,
             mock_standards, mock_subject):
         dicom1 = datman.scan.Series('STUDY_CAMH_9999_01_01_T1_02_Sag.dcm')
 
         mock_subject.return_value.dicoms = [dicom1]
         mock_standards.return_value = {}
 
-        qc.run_header_qc(mock_subject.return_value, self.standards, self.log)
-        assert mock_run.call_count == 0
+        qc.run_header_qc(mock_subject.return_value, self.standards, self.log,
+                config)
+        assert mock_compare.call_count == 0
 
     @patch('datman.scan.Scan')
     @patch('bin.dm_qc_report.get_standards')
-    @patch('datman.utils.run', autospec=True)
-    def test_expected_qcmon_call_made(self, mock_run, mock_standards, mock_subject):
+    @patch('datman.header_checks.write_diffs')
+    @patch('datman.header_checks.compare_files')
+    def test_expected_header_comparison_made(self, mock_compare, mock_write,
+            mock_standards, mock_subject):
         dicom1 = datman.scan.Series('./dicoms/subject_id/' \
                     'STUDY_CAMH_0001_01_01_OBS_09_Ax-Observe-Task.dcm')
         dicom2 = datman.scan.Series('./dicoms/subject_id/' \
@@ -207,13 +213,15 @@ class RunHeaderQC(unittest.TestCase):
         standard = datman.scan.Series('./standards/STUDY_CAMH_9999_01'\
                     '_01_T1_99_SagT1-BRAVO.dcm')
         mock_standards.return_value = {'T1': standard}
+        mock_compare.return_value = ['header EchoTime missing']
 
-        qc.run_header_qc(mock_subject.return_value, self.standards, self.log)
-
-        expected = 'qc-headers {} {} {}'.format(dicom2.path, standard.path,
-                self.log)
+        qc.run_header_qc(mock_subject.return_value, self.standards, self.log,
+                config)
 
-        mock_run.assert_called_once_with(expected)
+        mock_compare.assert_called_once_with(dicom2.path, standard.path,
+                dti=False)
+        mock_write.assert_called_once_with(self.log, dicom2.path,
+                ['header EchoTime missing'])
 
 class FMRIQC(unittest.TestCase):
     file_name = "./nii/STUDY_SITE_0001_01/" \
@@ -397,61 +405,100 @@ class AddHeaderQC(unittest.TestCase):
 
 class AddReportToChecklist(unittest.TestCase):
     path = "/some/path/"
-    checklist = "./checklist.csv"
     checklist_data = ["qc_subject1.html\n", "qc_subject2.html   signed-off\n",
                       "qc_subject4.pdf\n", "qc_subject5\n"]
 
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checklist = os.path.join(self.tmpdir, 'checklist.csv')
+        with open(self.checklist, 'w') as checklist:
+            checklist.writelines(self.checklist_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
     def test_list_unchanged_with_empty_report_path(self):
         report = ""
-        call_count, arg_list, _ = self.__mock_add_report(report)
-
-        assert call_count == 0
-        assert arg_list == []
+        assert self.__add_report(report) == self.checklist_data
 
     def test_list_updated_with_new_report(self):
         report = "qc_subject3.html"
-        call_count, arg_list, checklist_mock = self.__mock_add_report(self.path
-                + report)
+        lines = self.__add_report(self.path + report)
 
-        assert call_count == 2
-        assert arg_list == [call(self.checklist, 'r'), call(self.checklist, 'a')]
-        checklist_mock().write.assert_called_once_with(report + "\n")
+        assert lines == self.checklist_data + [report + "\n"]
 
     def test_list_not_updated_with_repeat_report(self):
         report = "/path/qc_subject1.html"
-        call_count, arg_list, checklist_mock = self.__mock_add_report(self.path +
-                report)
-
-        assert call_count == 1
-        assert arg_list == [call(self.checklist, 'r')]
-        assert not checklist_mock().write.called
+        assert self.__add_report(self.path + report) == self.checklist_data
 
         # Expect that entries in report with 2+ columns not repeated.
         qced_report = "/path/qc_subject2.html"
-        call_count, arg_list, checklist_mock = self.__mock_add_report(self.path +
-                report)
-
-        assert call_count == 1
-        assert arg_list == [call(self.checklist, 'r')]
-        assert not checklist_mock().write.called
+        assert self.__add_report(self.path + qced_report) == self.checklist_data
 
     def test_list_not_updated_with_same_report_with_new_extension(self):
         report = "/path/qc_subject5.html"
-        call_count, arg_list, checklist_mock = self.__mock_add_report(self.path +
-                report)
-
-        assert call_count == 1
-        assert arg_list == [call(self.checklist, 'r')]
-        assert not checklist_mock().write.called
-
-    def __mock_add_report(self, report):
-        # Checklist not defined as an attribute so that calls don't have to be
-        # reset for each test.
-        checklist_mock = mock_open(read_data=self.checklist_data)
-        with patch("__builtin__.open", checklist_mock) as mock_file:
-            # This line is needed because mock_open wont allow iteration
-            # over a file handler otherwise
-            mock_file.return_value.__iter__.return_value = self.checklist_data
-            qc.add_report_to_checklist(report, self.checklist)
-
-            return mock_file.call_count, mock_file.call_args_list, checklist_mock
+        assert self.__add_report(self.path + report) == self.checklist_data
+
+    def test_list_created_if_missing(self):
+        os.remove(self.checklist)
+        report = "qc_subject3.html"
+
+        assert self.__add_report(self.path + report) == [report + "\n"]
+
+    def __add_report(self, report):
+        qc.add_report_to_checklist(report, self.checklist)
+        with open(self.checklist) as checklist:
+            return checklist.readlines()
+
+@patch('bin.dm_qc_report.get_new_subjects')
+class QcAllScans(unittest.TestCase):
+    new_subjects = ['STUDY_CMH_0001_01', 'STUDY_CMH_PHA_FBN0001',
+                    'STUDY_CMH_0002_01', 'STUDY_CMH_0003_01']
+
+    @patch('bin.dm_qc_report.submit_qc_jobs')
+    @patch('bin.dm_qc_report.submit_qc_array_job')
+    @patch('bin.dm_qc_report.make_qc_command')
+    def test_batches_humans_into_array_job_and_chains_phantoms(self,
+            mock_command, mock_array_job, mock_submit, mock_new_subs):
+        mock_new_subs.return_value = self.new_subjects
+        mock_command.side_effect = lambda subjects, study: " ".join(subjects)
+
+        qc.qc_all_scans(config, batch_size=2)
+
+        mock_array_job.assert_called_once_with(
+                ['STUDY_CMH_0001_01 STUDY_CMH_0002_01', 'STUDY_CMH_0003_01'])
+        mock_submit.assert_called_once_with(['STUDY_CMH_PHA_FBN0001'],
+                chained=True)
+
+    @patch('bin.dm_qc_report.submit_qc_jobs')
+    @patch('bin.dm_qc_report.qc_locally')
+    def test_local_workers_run_subjects_without_queue(self, mock_local,
+            mock_submit, mock_new_subs):
+        mock_new_subs.return_value = self.new_subjects
+
+        qc.qc_all_scans(config, local_workers=4)
+
+        mock_local.assert_called_once_with(
+                ['STUDY_CMH_0001_01', 'STUDY_CMH_0002_01', 'STUDY_CMH_0003_01'],
+                ['STUDY_CMH_PHA_FBN0001'], config, 4)
+        assert not mock_submit.called
+
+class RunQc(unittest.TestCase):
+
+    @patch('bin.dm_qc_report.qc_single_scan')
+    @patch('bin.dm_qc_report.prepare_scan')
+    def test_resets_rewrite_flag_for_each_subject(self, mock_prepare,
+            mock_qc):
+        qc.REWRITE = True
+
+        assert qc.run_qc('STUDY_CMH_0001_01', config, False)
+        assert qc.REWRITE == False
+
+    @patch('bin.dm_qc_report.prepare_scan')
+    def test_returns_false_when_subject_fails(self, mock_prepare):
+        mock_prepare.side_effect = SystemExit(1)
+
+        assert not qc.run_qc('STUDY_CMH_0001_01', config, False)
+
+    def tearDown(self):
+        qc.REWRITE = False
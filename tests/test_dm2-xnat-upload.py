@@ -106,3 +106,140 @@ class GetResources(unittest.TestCase):
         actual_resources = upload.get_resources(archive_zip.return_value)
 
         assert sorted(actual_resources) == sorted(expected_resources)
+
+
+class UploadManifest(unittest.TestCase):
+    manifest_csv = ('source_name,target_name,uploaded\n'
+                    'a.zip,STUDY_CMH_0001_01_01,no\n'
+                    'b.zip,STUDY_CMH_0002_01_01,no\n')
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.tmpdir, 'manifest.csv')
+        self.state_file = os.path.join(self.tmpdir, 'xnat_upload_state.csv')
+        with open(self.manifest_file, 'w') as manifest:
+            manifest.write(self.manifest_csv)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def read_uploaded(self):
+        import pandas as pd
+        return list(pd.read_csv(self.manifest_file)['uploaded'])
+
+    def test_records_are_batched(self):
+        manifest = upload.UploadManifest(self.manifest_file, self.state_file,
+                                         batch_size=2)
+
+        manifest.record('STUDY_CMH_0001_01_01.zip', 'yes')
+        assert self.read_uploaded() == ['no', 'no']
+        assert os.path.exists(self.state_file)
+
+        manifest.record('STUDY_CMH_0002_01_01.zip', 'error')
+        assert self.read_uploaded() == ['yes', 'error']
+        assert not os.path.exists(self.state_file)
+
+    def test_recovers_records_left_by_killed_run(self):
+        with open(self.state_file, 'w') as state:
+            state.write('STUDY_CMH_0002_01_01.zip,yes\n')
+
+        upload.UploadManifest(self.manifest_file, self.state_file)
+
+        assert self.read_uploaded() == ['no', 'yes']
+        assert not os.path.exists(self.state_file)
+
+
+class UploadArchives(unittest.TestCase):
+
+    @patch('bin.dm_xnat_upload.MAX_PER_PROJECT', 1)
+    @patch('bin.dm_xnat_upload.JOBS', 4)
+    @patch('bin.dm_xnat_upload.get_archive_project')
+    @patch('bin.dm_xnat_upload.upload_archive')
+    def test_limits_uploads_per_project(self, mock_upload, mock_project):
+        import threading
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+
+        def fake_upload(dicom_dir, zips_dir, archivefile, manifest):
+            import time
+            project = archivefile[0]
+            with lock:
+                active[project] = active.get(project, 0) + 1
+                peak[project] = max(peak.get(project, 0), active[project])
+            time.sleep(0.01)
+            with lock:
+                active[project] -= 1
+
+        mock_upload.side_effect = fake_upload
+        mock_project.side_effect = lambda archivefile: archivefile[0]
+        archives = ['A1.zip', 'A2.zip', 'A3.zip', 'B1.zip', 'B2.zip']
+
+        upload.upload_archives('dicoms', 'zips', archives, MagicMock())
+
+        assert mock_upload.call_count == 5
+        assert peak == {'A': 1, 'B': 1}
+
+    @patch('bin.dm_xnat_upload.MAX_PER_PROJECT', 0)
+    @patch('bin.dm_xnat_upload.JOBS', 2)
+    @patch('bin.dm_xnat_upload.get_archive_project')
+    @patch('bin.dm_xnat_upload.upload_archive')
+    def test_uploads_everything_when_project_limit_below_one(self,
+            mock_upload, mock_project):
+        mock_project.return_value = 'PROJ'
+
+        upload.upload_archives('dicoms', 'zips', ['A1.zip', 'A2.zip'],
+                               MagicMock())
+
+        assert mock_upload.call_count == 2
+
+    @patch('bin.dm_xnat_upload.JOBS', 2)
+    @patch('bin.dm_xnat_upload.get_archive_project')
+    @patch('bin.dm_xnat_upload.upload_archive')
+    def test_unexpected_failure_is_recorded_as_error(self, mock_upload,
+                                                     mock_project):
+        mock_upload.side_effect = Exception('Broken')
+        mock_project.return_value = 'PROJ'
+        manifest = MagicMock()
+
+        upload.upload_archives('dicoms', 'zips', ['A1.zip'], manifest)
+
+        manifest.record.assert_called_once_with('A1.zip', 'error')
+
+
+class UploadArchive(unittest.TestCase):
+
+    @patch('os.remove')
+    @patch('os.readlink')
+    @patch('bin.dm_xnat_upload.process_archive')
+    def test_failed_cleanup_keeps_archive_recorded_as_uploaded(self,
+            mock_process, mock_readlink, mock_remove):
+        mock_process.return_value = True
+        mock_readlink.side_effect = OSError(22, 'Invalid argument')
+        manifest = MagicMock()
+
+        upload.upload_archive('dicoms', 'zips', 'A1.zip', manifest)
+
+        manifest.record.assert_called_once_with('A1.zip', 'yes')
+        assert not mock_remove.called
+
+
+class BatchResources(unittest.TestCase):
+
+    def make_info(self, name, size):
+        info = zipfile.ZipInfo(name)
+        info.file_size = size
+        return info
+
+    @patch('bin.dm_xnat_upload.RESOURCE_BATCH_FILES', 2)
+    @patch('bin.dm_xnat_upload.SMALL_RESOURCE_SIZE', 100)
+    def test_large_files_are_uploaded_alone(self):
+        resources = [self.make_info('a', 10), self.make_info('big', 1000),
+                     self.make_info('b', 10), self.make_info('c', 10)]
+
+        batches = [[info.filename for info in batch]
+                   for batch in upload.batch_resources(resources)]
+
+        assert batches == [['big'], ['a', 'b'], ['c']]
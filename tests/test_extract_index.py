@@ -0,0 +1,64 @@
+import unittest
+import logging
+
+import datman.extract_index
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+class TestExtractIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = datman.extract_index.ExtractIndex(':memory:')
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_unknown_session_is_not_current(self):
+        assert not self.index.is_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+
+    def test_session_is_current_when_modified_time_matches(self):
+        self.index.mark_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+
+        assert self.index.is_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+
+    def test_session_is_not_current_when_modified_time_changes(self):
+        self.index.mark_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+
+        assert not self.index.is_current('PROJ', 'STUDY_CMH_0001_01', '2019')
+
+    def test_session_without_modified_time_is_never_current(self):
+        self.index.mark_current('PROJ', 'STUDY_CMH_0001_01', None)
+
+        assert not self.index.is_current('PROJ', 'STUDY_CMH_0001_01', None)
+
+    def test_forget_removes_session(self):
+        self.index.mark_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+        self.index.forget('PROJ', 'STUDY_CMH_0001_01')
+
+        assert not self.index.is_current('PROJ', 'STUDY_CMH_0001_01', '2018')
+
+    def test_get_exports_groups_formats_by_series_uid(self):
+        self.index.add_exports('STUDY_CMH_0001_01', [('1.2.3', 'nii'),
+                                                     ('1.2.3', 'dcm'),
+                                                     ('1.2.4', 'nii'),
+                                                     (None, 'nii')])
+
+        exports = self.index.get_exports('STUDY_CMH_0001_01')
+
+        assert exports == {'1.2.3': {'nii', 'dcm'}, '1.2.4': {'nii'}}
+
+class TestGetModified(unittest.TestCase):
+
+    def test_prefers_last_modified(self):
+        experiment = {'insert_date': '2018-01-01', 'last_modified': '2018-02-01'}
+
+        assert datman.extract_index.get_modified(experiment) == '2018-02-01'
+
+    def test_falls_back_to_insert_date(self):
+        experiment = {'insert_date': '2018-01-01', 'last_modified': ''}
+
+        assert datman.extract_index.get_modified(experiment) == '2018-01-01'
+
+    def test_returns_None_when_no_stamp_is_present(self):
+        assert datman.extract_index.get_modified({}) is None
@@ -0,0 +1,96 @@
+import os
+import io
+import shutil
+import zipfile
+import tempfile
+import unittest
+import logging
+
+import pydicom
+from mock import patch
+
+import datman.utils
+import datman.header_cache
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+def make_dicom(series_uid, description):
+    meta = pydicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = series_uid + '.1'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    dicom = pydicom.dataset.FileDataset('dicom', {}, file_meta=meta,
+                                        preamble=b'\0' * 128)
+    dicom.is_little_endian = True
+    dicom.is_implicit_VR = False
+    dicom.StudyInstanceUID = '1.2.3'
+    dicom.SeriesInstanceUID = series_uid
+    dicom.SeriesDescription = description
+    dicom.SeriesNumber = series_uid.split('.')[-1]
+    dicom.PatientName = 'STUDY_CMH_0001_01'
+    dicom.ImageComments = 'not cached'
+    contents = io.BytesIO()
+    dicom.save_as(contents)
+    return contents.getvalue()
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmpdir, 'exam.zip')
+        with zipfile.ZipFile(self.archive, 'w') as zip_file:
+            zip_file.writestr('exam/1/1.dcm', make_dicom('1.2.3.1', 'T1'))
+            zip_file.writestr('exam/2/1.dcm', make_dicom('1.2.3.2', 'DTI'))
+        self.cache = datman.header_cache.HeaderCache(':memory:')
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_archive_is_read_once(self):
+        with patch('datman.utils.get_archive_headers',
+                   wraps=datman.utils.get_archive_headers) as mock_read:
+            first = self.cache.get_archive_headers(self.archive)
+            second = self.cache.get_archive_headers(self.archive)
+
+        assert mock_read.call_count == 1
+        assert first == second
+        assert list(second) == ['exam/1', 'exam/2']
+        assert second['exam/2'].SeriesDescription == 'DTI'
+        assert second['exam/2'].get('SeriesNumber') == 2
+        assert str(second['exam/1'].PatientName) == 'STUDY_CMH_0001_01'
+
+    def test_stop_after_first_returns_first_series(self):
+        headers = self.cache.get_archive_headers(self.archive,
+                                                 stop_after_first=True)
+
+        assert list(headers) == ['exam/1']
+
+    def test_changed_archive_is_read_again(self):
+        self.cache.get_archive_headers(self.archive)
+        with zipfile.ZipFile(self.archive, 'a') as zip_file:
+            zip_file.writestr('exam/3/1.dcm', make_dicom('1.2.3.3', 'REST'))
+
+        headers = self.cache.get_archive_headers(self.archive)
+
+        assert list(headers) == ['exam/1', 'exam/2', 'exam/3']
+        assert self.cache.stats()['entries'] == 1
+
+    def test_uncached_fields_are_read_from_archive(self):
+        headers = self.cache.get_archive_headers(self.archive,
+                                                 tags=['ImageComments'])
+
+        assert headers['exam/1'].ImageComments == 'not cached'
+        assert self.cache.stats()['entries'] == 0
+
+    def test_least_recently_used_archives_are_evicted(self):
+        self.cache.max_entries = 1
+        other = os.path.join(self.tmpdir, 'other.zip')
+        shutil.copy(self.archive, other)
+
+        self.cache.get_archive_headers(self.archive)
+        self.cache.get_archive_headers(other)
+
+        assert self.cache.stats()['entries'] == 1
+        assert self.cache.lookup(datman.header_cache.get_key(other))
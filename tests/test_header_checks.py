@@ -0,0 +1,195 @@
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+import pydicom
+
+import datman.header_checks as header_checks
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+
+def write_dicom(path, bval=None, **fields):
+    meta = pydicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    dicom = pydicom.dataset.FileDataset(path, {}, file_meta=meta,
+                                        preamble=b'\0' * 128)
+    dicom.is_little_endian = True
+    dicom.is_implicit_VR = False
+    dicom.SeriesInstanceUID = '1.2.3.1'
+    dicom.SeriesDescription = 'Ax T1'
+    dicom.EchoTime = '2.5'
+    dicom.RepetitionTime = '6.7'
+    dicom.FlipAngle = '12'
+    dicom.PixelSpacing = ['0.9', '0.9']
+    dicom.ScanOptions = 'FAST_GEMS'
+    for name, value in fields.items():
+        if value is None:
+            delattr(dicom, name)
+        else:
+            setattr(dicom, name, value)
+    if bval is not None:
+        dicom.add_new((0x0043, 0x1039), 'IS', [bval, 8, 0, 0])
+    dicom.add_new(0x7fe00010, 'OB', b'\1' * 1000)
+    dicom.save_as(path)
+    return path
+
+
+class HeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        header_checks.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        header_checks.clear_cache()
+
+    def make(self, name, **fields):
+        return write_dicom(os.path.join(self.tmpdir, name), **fields)
+
+
+class TestCompareFiles(HeaderTest):
+
+    def test_no_differences_for_matching_headers(self):
+        standard = self.make('standard.dcm')
+        dicom = self.make('dicom.dcm', SeriesInstanceUID='1.2.3.9',
+                          SeriesDescription='Renamed')
+
+        assert header_checks.compare_files(dicom, standard) == []
+
+    def test_reports_changed_and_missing_headers(self):
+        standard = self.make('standard.dcm')
+        dicom = self.make('dicom.dcm', FlipAngle='8', ScanOptions=None)
+
+        diffs = header_checks.compare_files(dicom, standard)
+
+        assert diffs == ['header ScanOptions missing',
+                         'header FlipAngle, expected = 12.0, actual = 8.0']
+
+    def test_multi_valued_headers_compared(self):
+        standard = self.make('standard.dcm')
+        dicom = self.make('dicom.dcm', PixelSpacing=['0.9', '1.2'])
+
+        diffs = header_checks.compare_files(dicom, standard)
+
+        assert diffs == ['header PixelSpacing, expected = (0.9, 0.9), '
+                         'actual = (0.9, 1.2)']
+
+    def test_differences_within_tolerance_ignored(self):
+        standard = self.make('standard.dcm')
+        dicom = self.make('dicom.dcm', EchoTime='2.504', RepetitionTime='7.5')
+
+        assert header_checks.compare_files(dicom, standard) == []
+
+    def test_differences_outside_tolerance_reported(self):
+        standard = self.make('standard.dcm')
+        dicom = self.make('dicom.dcm', EchoTime='2.6')
+
+        diffs = header_checks.compare_files(dicom, standard)
+
+        assert diffs == ['header EchoTime, expected = 2.5, actual = 2.6 '
+                         '[tolerance = 0.005]']
+
+    def test_bvals_only_compared_for_dti(self):
+        standard = self.make('standard.dcm', bval=1000)
+        dicom = self.make('dicom.dcm', bval=700)
+
+        assert header_checks.compare_files(dicom, standard) == []
+        assert header_checks.compare_files(dicom, standard, dti=True) == [
+                'Bval mismatch: expected = 1000, actual = 700']
+
+    def test_missing_bval_reported_for_dti(self):
+        standard = self.make('standard.dcm', bval=1000)
+        dicom = self.make('dicom.dcm')
+
+        assert header_checks.compare_files(dicom, standard, dti=True) == [
+                'No bval found in dicom headers']
+
+
+class TestGetStandard(HeaderTest):
+
+    def test_standard_is_parsed_once(self):
+        standard = self.make('standard.dcm')
+
+        first = header_checks.get_standard(standard)
+
+        assert header_checks.get_standard(standard) is first
+
+    def test_modified_standard_is_parsed_again(self):
+        standard = self.make('standard.dcm')
+        first = header_checks.get_standard(standard)
+
+        self.make('standard.dcm', FlipAngle='8')
+        stat = os.stat(standard)
+        os.utime(standard, (stat.st_atime, stat.st_mtime + 1))
+
+        header = header_checks.get_standard(standard)
+        assert header is not first
+        assert header.values['FlipAngle'] == 8.0
+
+
+class TestGetStandardMap(HeaderTest):
+
+    def read_standards(self, standard_dir, site):
+        self.reads.append((standard_dir, site))
+        return {'T1': site}
+
+    def setUp(self):
+        super(TestGetStandardMap, self).setUp()
+        self.reads = []
+
+    def test_map_is_read_once_per_site(self):
+        first = header_checks.get_standard_map(self.tmpdir, 'CMH',
+                                               self.read_standards)
+
+        assert header_checks.get_standard_map(
+                self.tmpdir, 'CMH', self.read_standards) is first
+        assert header_checks.get_standard_map(
+                self.tmpdir, 'MRC', self.read_standards) == {'T1': 'MRC'}
+        assert self.reads == [(self.tmpdir, 'CMH'), (self.tmpdir, 'MRC')]
+
+    def test_map_is_read_again_when_directory_changes(self):
+        header_checks.get_standard_map(self.tmpdir, 'CMH', self.read_standards)
+
+        self.make('STUDY_CMH_9999_01_01_T1_02_SagT1.dcm')
+        stat = os.stat(self.tmpdir)
+        os.utime(self.tmpdir, (stat.st_atime, stat.st_mtime + 1))
+        header_checks.get_standard_map(self.tmpdir, 'CMH', self.read_standards)
+
+        assert len(self.reads) == 2
+
+    def test_map_of_missing_directory_is_not_cached(self):
+        missing = os.path.join(self.tmpdir, 'missing')
+
+        header_checks.get_standard_map(missing, 'CMH', self.read_standards)
+        header_checks.get_standard_map(missing, 'CMH', self.read_standards)
+
+        assert len(self.reads) == 2
+
+
+class TestWriteDiffs(HeaderTest):
+
+    def test_lines_start_with_dicom_path(self):
+        log = os.path.join(self.tmpdir, 'header-diff.log')
+        dicom = '/dicoms/STUDY_CMH_0001_01_01_T1_02_SagT1.dcm'
+
+        header_checks.write_diffs(log, dicom, ['header EchoTime missing'])
+        header_checks.write_diffs(log, dicom, ['header FlipAngle missing'])
+
+        with open(log) as log_file:
+            assert log_file.read() == (
+                    '{0}: header EchoTime missing\n'
+                    '{0}: header FlipAngle missing\n'.format(dicom))
+
+    def test_log_created_when_no_differences(self):
+        log = os.path.join(self.tmpdir, 'header-diff.log')
+
+        header_checks.write_diffs(log, 'dicom.dcm', [])
+
+        assert os.path.exists(log)
@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+import datman.metadata
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+BLACKLIST = """series\treason
+STUDY_CMH_0001_01_01_MR_T1_11_SagT1-BRAVO\tmotion
+STUDY_CMH_0001_01_01_MR_DTI60-1000_05_Ax-DTI-60plus5\t
+STUDY_CMH_0002_01_01_MR_RST_07_Ax-RestingState\tartifacts
+STUDY_CMH_0002_01_01_MR_RST_07_Ax-RestingState\tduplicate entry
+"""
+
+CHECKLIST = """qc_STUDY_CMH_0001_01_01_MR.html signed off
+qc_STUDY_CMH_0002_01_01_MR.html
+qc_STUDY_CMH_0003_01_01_MR.html   fine, some motion
+"""
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents, mtime=None):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as out:
+            out.write(contents)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+
+class TestBlacklistIndex(MetadataTest):
+
+    def setUp(self):
+        super(TestBlacklistIndex, self).setUp()
+        self.path = self.write('blacklist.csv', BLACKLIST)
+        self.blacklist = datman.metadata.BlacklistIndex(self.path)
+
+    def test_returns_comment_for_blacklisted_series(self):
+        comment = self.blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_MR_T1_11_SagT1-BRAVO.nii.gz')
+
+        assert comment == 'motion'
+
+    def test_series_number_must_match_exactly(self):
+        comment = self.blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_MR_T1_1_SagT1-BRAVO')
+
+        assert comment is None
+
+    def test_entry_without_comment_returns_none(self):
+        comment = self.blacklist.get_comment(
+                'STUDY_CMH_0001_01_01_MR_DTI60-1000_05_Ax-DTI-60plus5')
+
+        assert comment is None
+
+    def test_first_entry_for_a_series_wins(self):
+        comment = self.blacklist.get_comment(
+                'STUDY_CMH_0002_01_01_MR_RST_07_Ax-RestingState')
+
+        assert comment == 'artifacts'
+
+    def test_maps_subjects_to_their_entries(self):
+        subjects = self.blacklist.get_subjects()
+
+        assert sorted(subjects) == ['STUDY_CMH_0001_01', 'STUDY_CMH_0002_01']
+        assert len(subjects['STUDY_CMH_0001_01']) == 2
+
+    def test_reloads_file_when_it_changes(self):
+        scan = 'STUDY_CMH_0003_01_01_MR_T1_02_SagT1-BRAVO'
+        os.utime(self.path, (time.time() - 60, time.time() - 60))
+        assert self.blacklist.get_comment(scan) is None
+
+        with open(self.path, 'a') as blacklist:
+            blacklist.write('{}\tbad scan\n'.format(scan))
+
+        assert self.blacklist.get_comment(scan) == 'bad scan'
+
+    def test_raises_ioerror_when_file_is_missing(self):
+        os.remove(self.path)
+
+        with self.assertRaises(IOError):
+            self.blacklist.get_comment(
+                    'STUDY_CMH_0001_01_01_MR_T1_11_SagT1-BRAVO')
+
+
+class TestChecklistIndex(MetadataTest):
+
+    def setUp(self):
+        super(TestChecklistIndex, self).setUp()
+        self.path = self.write('checklist.csv', CHECKLIST)
+        self.checklist = datman.metadata.ChecklistIndex(self.path)
+
+    def test_returns_comment_for_session(self):
+        assert self.checklist.get_comment(
+                'STUDY_CMH_0003_01_01_MR') == 'fine, some motion'
+
+    def test_returns_empty_string_for_unreviewed_session(self):
+        assert self.checklist.get_comment('STUDY_CMH_0002_01_01_MR') == ''
+
+    def test_returns_none_for_missing_session(self):
+        assert self.checklist.get_comment('STUDY_CMH_0004_01_01_MR') is None
+
+    def test_signed_off_sessions_have_a_comment(self):
+        assert self.checklist.get_signed_off() == ['STUDY_CMH_0001_01_01_MR',
+                                                   'STUDY_CMH_0003_01_01_MR']
+
+
+def test_indexes_are_shared_per_file():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'checklist.csv')
+        link = os.path.join(tmpdir, 'link.csv')
+        open(path, 'w').close()
+        os.symlink(path, link)
+
+        checklist = datman.metadata.get_checklist(path)
+
+        assert datman.metadata.get_checklist(link) is checklist
+        assert datman.metadata.get_blacklist(path) is not checklist
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class TestAddToChecklist(MetadataTest):
+
+    def setUp(self):
+        super(TestAddToChecklist, self).setUp()
+        self.path = self.write('checklist.csv', 'qc_STUDY_CMH_0001_01_01_MR'
+                               '.html signed off')
+
+    def read(self):
+        with open(self.path) as checklist:
+            return checklist.read()
+
+    def test_adds_new_pages_in_one_write_on_their_own_lines(self):
+        added = datman.metadata.add_to_checklist(self.path, [
+                'qc_STUDY_CMH_0002_01_01_MR.html',
+                '/qc/STUDY_CMH_0001_01_01_MR/qc_STUDY_CMH_0001_01_01_MR.html',
+                'qc_STUDY_CMH_0003_01_01_MR.html',
+                'qc_STUDY_CMH_0002_01_01_MR.pdf'])
+
+        assert added == ['qc_STUDY_CMH_0002_01_01_MR.html',
+                         'qc_STUDY_CMH_0003_01_01_MR.html']
+        assert self.read() == ('qc_STUDY_CMH_0001_01_01_MR.html signed off\n'
+                               'qc_STUDY_CMH_0002_01_01_MR.html\n'
+                               'qc_STUDY_CMH_0003_01_01_MR.html\n')
+
+    def test_sees_entries_appended_by_other_writers(self):
+        checklist = datman.metadata.get_checklist(self.path)
+        assert checklist.get_comment('STUDY_CMH_0002_01_01_MR') is None
+
+        with open(self.path, 'a') as other:
+            other.write('\nqc_STUDY_CMH_0002_01_01_MR.html\n')
+
+        assert datman.metadata.add_to_checklist(
+                self.path, ['qc_STUDY_CMH_0002_01_01_MR.html']) == []
+        assert checklist.get_comment('STUDY_CMH_0001_01_01_MR') == \
+            'signed off'
+
+    def test_rereads_file_that_was_edited(self):
+        checklist = datman.metadata.ChecklistIndex(self.path)
+        checklist.refresh()
+        past = time.time() - 60
+        os.utime(self.path, (past, past))
+
+        self.write('checklist.csv', 'qc_STUDY_CMH_0001_01_01_MR.html\n'
+                   'qc_STUDY_CMH_0002_01_01_MR.html ok\n')
+
+        assert checklist.get_comment('STUDY_CMH_0001_01_01_MR') == ''
+        assert checklist.get_signed_off() == ['STUDY_CMH_0002_01_01_MR']
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+import matplotlib.image
+
+import datman.montage
+
+
+class TestMontage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # each axial slice is filled with its slice number
+        self.data = np.ones((20, 10, 6, 3), dtype=np.float32)
+        self.data *= np.arange(6, dtype=np.float32)[None, None, :, None]
+        self.data[..., 1:] = 100
+        self.affine = np.diag([-2., 1., 1., 1.])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, data, name):
+        path = os.path.join(self.tmpdir, name)
+        nib.save(nib.Nifti1Image(data, self.affine), path)
+        return path
+
+    def test_reads_first_volume_in_canonical_orientation(self):
+        self.data[0, 0, 0, 0] = -1
+        path = self.save(self.data, 'bold.nii.gz')
+
+        data, zooms = datman.montage.load_volume(path)
+
+        assert data.shape == (20, 10, 6)
+        assert zooms == (2.0, 1.0, 1.0)
+        assert data[19, 0, 0] == -1
+        assert data[:, :, 5].max() == 5
+
+    def test_montage_has_requested_width_and_every_gapth_slice(self):
+        data, zooms = datman.montage.load_volume(
+                self.save(self.data[..., 0], 'anat.nii'))
+
+        montage = datman.montage.make_montage(data, 2, 120, zooms)
+
+        # three 10x40 slices (x stretched to square voxels) fit in one row
+        assert montage.shape == (10, 120)
+        assert montage.dtype == np.uint8
+        column_values = [montage[5, col] for col in (20, 60, 100)]
+        assert column_values == sorted(column_values)
+        assert len(set(column_values)) == 3
+
+    def test_slicer_writes_png(self):
+        output = os.path.join(self.tmpdir, 'bold.png')
+
+        datman.montage.slicer(self.save(self.data, 'bold.nii.gz'), output, 1,
+                              120)
+
+        image = matplotlib.image.imread(output)
+        assert image.shape[1] == 120
@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+import datman.qc_index
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+
+class TestQCIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.nii = os.path.join(self.tmpdir, 'nii')
+        self.qc = os.path.join(self.tmpdir, 'qc')
+        self.meta = os.path.join(self.tmpdir, 'metadata')
+        for sub in ['STUDY_CMH_0001_01', 'STUDY_CMH_0002_01',
+                    'STUDY_CMH_PHA_FBN0001']:
+            self.touch(self.nii, sub, sub + '_01_MR_T1_02_SagT1.nii.gz')
+        self.touch(self.qc, 'STUDY_CMH_0001_01', 'qc_STUDY_CMH_0001_01.html')
+        self.touch(self.qc, 'STUDY_CMH_0002_01', 'STUDY_CMH_0002_01_T1.png')
+        os.makedirs(os.path.join(self.qc, 'STUDY_CMH_PHA_FBN0001'))
+        self.touch(self.meta, 'checklist.csv')
+        with open(os.path.join(self.meta, 'checklist.csv'), 'w') as checklist:
+            checklist.write('qc_STUDY_CMH_0001_01.html signed off\n')
+            checklist.write('qc_STUDY_CMH_0002_01.html\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, *path):
+        path = os.path.join(*path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'a').close()
+        return path
+
+    def make_index(self):
+        return datman.qc_index.QCIndex(
+                os.path.join(self.meta, 'qc_index.json'), self.nii, self.qc,
+                os.path.join(self.meta, 'checklist.csv'))
+
+    def test_finds_subjects_without_report_and_empty_phantoms(self):
+        index = self.make_index().update()
+
+        assert index.get_new_subjects() == ['STUDY_CMH_0002_01',
+                                            'STUDY_CMH_PHA_FBN0001']
+        assert len(index.get_new_subjects(rewrite=True)) == 3
+
+    def test_records_report_and_checklist_state(self):
+        state = self.make_index().update().subjects
+
+        assert state['STUDY_CMH_0001_01']['report_mtime'] is not None
+        assert state['STUDY_CMH_0001_01']['checklist'] == 'signed off'
+        assert state['STUDY_CMH_0002_01']['report_mtime'] is None
+        assert state['STUDY_CMH_0002_01']['checklist'] == ''
+        assert state['STUDY_CMH_PHA_FBN0001']['checklist'] is None
+
+    def test_saved_index_only_rereads_changed_folders(self):
+        index = self.make_index().update()
+        index.save()
+        subject_qc = os.path.join(self.qc, 'STUDY_CMH_0002_01')
+        past = time.time() - 60
+        os.utime(subject_qc, (past, past))
+        index = self.make_index().update()
+        index.save()
+
+        # Added without changing the folder's mtime, so not noticed
+        self.touch(subject_qc, 'qc_STUDY_CMH_0002_01.html')
+        os.utime(subject_qc, (past, past))
+        assert 'STUDY_CMH_0002_01' in self.make_index().update(
+                ).get_new_subjects()
+
+        assert 'STUDY_CMH_0002_01' not in self.make_index().update(
+                full=True).get_new_subjects()
+
+    def test_rewritten_nifti_only_noticed_by_full_update(self):
+        folder = os.path.join(self.nii, 'STUDY_CMH_0002_01')
+        nifti = os.path.join(folder, 'STUDY_CMH_0002_01_01_MR_T1_02_SagT1.nii.gz')
+        past = int(time.time()) - 60
+        os.utime(folder, (past, past))
+        os.utime(nifti, (past, past))
+        index = self.make_index().update()
+        index.save()
+
+        # Rewritten in place, so the folder's mtime doesn't change
+        with open(nifti, 'w') as rewritten:
+            rewritten.write('new data')
+        os.utime(folder, (past, past))
+
+        index = self.make_index().update()
+        assert index.subjects['STUDY_CMH_0002_01']['data_mtime'] == past
+        index.update(full=True)
+        assert index.subjects['STUDY_CMH_0002_01']['data_mtime'] > past
@@ -2,6 +2,14 @@
 
 
 import os
+import io
+import sys
+import time
+import shutil
+import signal
+import zipfile
+import tempfile
+import subprocess
 
 
 import unittest
@@ -62,3 +70,267 @@ class TestCheckDependencyConfigured(unittest.TestCase):
 
     # def test_exception_contains_program_name(self):
     #     assert False
+
+@unittest.skipIf(sys.version_info < (3,), 'unzip_stream needs python 3')
+class TestUnzipStream(unittest.TestCase):
+
+    dicom = b'\0' * 128 + b'DICM' + b'\1' * 1000
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def _make_zip(self, compression=zipfile.ZIP_DEFLATED):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', compression) as zip_file:
+            zip_file.writestr('SESSION/1/1.dcm', self.dicom)
+            zip_file.writestr('SESSION/1/catalog.xml', b'<catalog/>')
+            zip_file.writestr('../outside.txt', b'text')
+        archive.seek(0)
+        return archive
+
+    def test_extracts_every_file_into_dest(self):
+        extracted = utils.unzip_stream(self._make_zip(), self.dest,
+                                       chunk_size=100)
+
+        expected = [os.path.join(self.dest, 'SESSION/1/1.dcm'),
+                    os.path.join(self.dest, 'SESSION/1/catalog.xml'),
+                    os.path.join(self.dest, 'outside.txt')]
+        assert extracted == expected
+        with open(expected[0], 'rb') as dicom:
+            assert dicom.read() == self.dicom
+
+    def test_extracts_stored_entries(self):
+        extracted = utils.unzip_stream(self._make_zip(zipfile.ZIP_STORED),
+                                       self.dest, chunk_size=100)
+
+        assert len(extracted) == 3
+
+    @raises(zipfile.BadZipfile)
+    def test_raises_BadZipfile_when_data_is_corrupt(self):
+        archive = bytearray(self._make_zip().getvalue())
+        archive[60] ^= 0xFF
+
+        utils.unzip_stream(io.BytesIO(bytes(archive)), self.dest)
+
+    def _truncate_at_entry(self, archive, index):
+        """Cuts a zip off just before the given entry's local header (or its
+        central directory, if index is past the last entry)"""
+        with zipfile.ZipFile(archive) as zip_file:
+            entries = zip_file.infolist()
+            if index < len(entries):
+                offset = entries[index].header_offset
+            else:
+                offset = zip_file.start_dir
+        return io.BytesIO(archive.getvalue()[:offset])
+
+    @raises(zipfile.BadZipfile)
+    def test_raises_BadZipfile_when_stream_ends_between_entries(self):
+        archive = self._truncate_at_entry(self._make_zip(), 2)
+
+        utils.unzip_stream(archive, self.dest, chunk_size=100)
+
+    @raises(zipfile.BadZipfile)
+    def test_raises_BadZipfile_when_central_directory_is_missing(self):
+        archive = self._truncate_at_entry(self._make_zip(), 3)
+
+        utils.unzip_stream(archive, self.dest, chunk_size=100)
+
+    def test_has_dicom_preamble(self):
+        extracted = utils.unzip_stream(self._make_zip(), self.dest)
+
+        assert utils.has_dicom_preamble(extracted[0])
+        assert not utils.has_dicom_preamble(extracted[1])
+        assert not utils.has_dicom_preamble(os.path.join(self.dest, 'missing'))
+
+class TestClassifyResources(unittest.TestCase):
+
+    dicom = b'\0' * 128 + b'DICM' + b'\x02\x00' * 50
+
+    def _make_zip(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('SESSION/', b'')
+            zip_file.writestr('SESSION/1.dcm', b'not checked')
+            zip_file.writestr('SESSION/MR.1.2.3', self.dicom)
+            zip_file.writestr('SESSION/notes.txt', b'notes')
+            zip_file.writestr('SESSION/empty.log', b'')
+        archive.seek(0)
+        return zipfile.ZipFile(archive)
+
+    def test_separates_empty_resources(self):
+        resources, empty = utils.classify_resources(self._make_zip())
+
+        assert [info.filename for info in resources] == ['SESSION/notes.txt']
+        assert [info.filename for info in empty] == ['SESSION/empty.log']
+
+    def test_get_resources_includes_empty_files(self):
+        resources = utils.get_resources(self._make_zip())
+
+        assert resources == ['SESSION/notes.txt', 'SESSION/empty.log']
+
+def make_dicom(comments='', series_uid='1.2.3.1'):
+    import pydicom
+    meta = pydicom.dataset.Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.4'
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    dicom = pydicom.dataset.FileDataset('dicom', {}, file_meta=meta,
+                                        preamble=b'\0' * 128)
+    dicom.is_little_endian = True
+    dicom.is_implicit_VR = False
+    dicom.StudyInstanceUID = '1.2.3'
+    dicom.SeriesInstanceUID = series_uid
+    dicom.ImageComments = comments
+    dicom.add_new(0x7fe00010, 'OB', b'\1' * 10000)
+    contents = io.BytesIO()
+    dicom.save_as(contents)
+    return contents.getvalue()
+
+class TestReadDicomHeader(unittest.TestCase):
+
+    def test_stops_before_pixel_data(self):
+        dicom = io.BytesIO(make_dicom())
+
+        header = utils.read_dicom_header(dicom, max_bytes=2000)
+
+        assert header.SeriesInstanceUID == '1.2.3.1'
+        assert 'PixelData' not in header
+        assert dicom.tell() == 2000
+
+    def test_reads_past_limit_when_header_is_longer(self):
+        dicom = io.BytesIO(make_dicom(comments='c' * 3000))
+
+        header = utils.read_dicom_header(dicom, max_bytes=2000)
+
+        assert header.ImageComments == 'c' * 3000
+
+    def test_reads_only_requested_tags(self):
+        header = utils.read_dicom_header(io.BytesIO(make_dicom('c')),
+                                         tags=utils.UID_TAGS)
+
+        assert header.StudyInstanceUID == '1.2.3'
+        assert 'ImageComments' not in header
+
+    @raises(utils.dcm.filereader.InvalidDicomError)
+    def test_raises_InvalidDicomError_for_other_files(self):
+        utils.read_dicom_header(io.BytesIO(b'notes'))
+
+    def test_get_zipfile_headers_streams_members(self):
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        path = os.path.join(dest, 'archive.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('SESSION/1/notes.txt', b'notes')
+            zip_file.writestr('SESSION/1/1.dcm', make_dicom())
+
+        headers = utils.get_zipfile_headers(path, tags=utils.UID_TAGS)
+
+        assert list(headers) == ['SESSION/1']
+        assert headers['SESSION/1'].SeriesInstanceUID == '1.2.3.1'
+
+class TestScanArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.archives = []
+        for num in range(3):
+            path = os.path.join(self.dest, '{}.zip'.format(num))
+            with zipfile.ZipFile(path, 'w') as zip_file:
+                zip_file.writestr('SESSION/1/1.dcm', make_dicom(
+                        series_uid='1.2.3.{}'.format(num)))
+            self.archives.append(path)
+        self.archives.insert(1, os.path.join(self.dest, 'missing.zip'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def check_results(self, results):
+        assert [result.path for result in results] == self.archives
+        uids = [result.headers['SESSION/1'].SeriesInstanceUID
+                for result in results if result.headers]
+        assert uids == ['1.2.3.0', '1.2.3.1', '1.2.3.2']
+        assert results[1].headers is None
+        assert isinstance(results[1].error, Exception)
+
+    def test_returns_results_in_input_order(self):
+        self.check_results(utils.scan_archives(self.archives,
+                                               tags=utils.UID_TAGS))
+
+    @unittest.skipIf(sys.version_info < (3,), 'workers need python 3')
+    def test_returns_results_in_input_order_with_workers(self):
+        self.check_results(utils.scan_archives(self.archives, workers=2,
+                                               tags=utils.UID_TAGS))
+
+class TestMakeBatches(unittest.TestCase):
+
+    def test_splits_items_into_batches_in_order(self):
+        batches = utils.make_batches(['a', 'b', 'c', 'd', 'e'], 2)
+
+        assert batches == [['a', 'b'], ['c', 'd'], ['e']]
+
+    def test_batch_size_below_one_gives_single_items(self):
+        assert utils.make_batches(['a', 'b'], 0) == [['a'], ['b']]
+
+class TestMakeArrayJob(unittest.TestCase):
+
+    def run_task(self, script, task_id):
+        env = dict(os.environ, SGE_TASK_ID=str(task_id))
+        output = subprocess.check_output(['bash', '-c', script], env=env)
+        return output.decode('utf-8')
+
+    def test_each_task_runs_its_own_command(self):
+        script = utils.make_array_job(['echo first', 'echo second'])
+
+        assert self.run_task(script, 1) == 'first\n'
+        assert self.run_task(script, 2) == 'second\n'
+
+    def test_unknown_task_runs_nothing(self):
+        script = utils.make_array_job(['echo first'])
+
+        assert self.run_task(script, 3) == ''
+
+class TestRun(unittest.TestCase):
+
+    def test_returns_return_code_and_output(self):
+        assert utils.run('echo hello') == (0, b'hello\n')
+
+@unittest.skipIf(sys.version_info < (3,), 'timeouts need python 3')
+class TestRunTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def is_running(self, pid):
+        # a killed process can linger as a zombie until it's reaped
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat:
+                return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except IOError:
+            return False
+
+    def test_returns_promptly_with_kill_return_code(self):
+        start = time.time()
+
+        return_code, _ = utils.run('sleep 5', timeout=0.1)
+
+        assert time.time() - start < 2
+        assert return_code == -signal.SIGKILL
+
+    def test_kills_processes_started_by_command(self):
+        pid_file = os.path.join(self.tmpdir, 'pid')
+        cmd = 'sleep 30 & echo $! > {}; wait'.format(pid_file)
+
+        utils.run(cmd, specialquote=False, timeout=0.5)
+
+        with open(pid_file) as pid:
+            child = int(pid.read())
+        deadline = time.time() + 2
+        while self.is_running(child) and time.time() < deadline:
+            time.sleep(0.05)
+        assert not self.is_running(child)
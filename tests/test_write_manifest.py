@@ -0,0 +1,48 @@
+import unittest
+import importlib
+
+import pandas as pd
+
+write_manifest = importlib.import_module('bin.write_manifest')
+
+
+def make_manifest(rows):
+    manifest = pd.DataFrame(
+            [['src{}'.format(num), 'id'] + row + ['']
+             for num, row in enumerate(rows)],
+            columns=write_manifest.columns)
+    return manifest.astype({'visit': 'int64', 'session': 'int64'})
+
+
+class TestReindex(unittest.TestCase):
+
+    # PatientName, StudyDate, StudyTime, visit, session, target_name
+    rows = [['P1', 20180101, 900, 2, 1, ''],
+            ['P1', 20180101, 900, 1, 1, ''],
+            ['P1', 20180101, 1300, 1, 1, ''],
+            ['P1', 20180305, 800, 1, 1, '<ignore>'],
+            ['P2', 20180102, 1000, 1, 1, ''],
+            ['P2', 20180102, 1100, 1, 1, '']]
+
+    def test_visits_count_on_from_each_patients_first_row(self):
+        manifest = write_manifest.reindex_visits(make_manifest(self.rows))
+
+        assert manifest['visit'].tolist() == [2, 2, 2, 3, 1, 1]
+        assert manifest['visit'].dtype == 'int64'
+
+    def test_sessions_count_study_times_within_a_visit(self):
+        manifest = write_manifest.reindex_sessions(make_manifest(self.rows))
+
+        assert manifest['session'].tolist() == [1, 1, 2, 1, 1, 2]
+
+    def test_session_ids_skip_ignored_rows(self):
+        manifest = make_manifest(self.rows)
+        manifest = write_manifest.reindex_visits(manifest)
+        manifest = write_manifest.reindex_sessions(manifest)
+
+        manifest = write_manifest.generate_xnat_sessionIDs('STU', manifest)
+
+        assert manifest['target_name'].tolist() == [
+                'STU_CMH_P1_02_SE01_MR', 'STU_CMH_P1_02_SE01_MR',
+                'STU_CMH_P1_02_SE02_MR', '<ignore>',
+                'STU_CMH_P2_01_SE01_MR', 'STU_CMH_P2_01_SE02_MR']
@@ -1,7 +1,15 @@
+import io
 import os
+import asyncio
+import shutil
+import hashlib
+import tempfile
 import unittest
+import threading
 import logging
 
+import requests
+
 from mock import Mock, patch
 from nose.tools import raises
 
@@ -175,3 +183,297 @@ class TestGetAuth(unittest.TestCase):
         env = {'XNAT_USER': 'someuser'}
         with patch.dict('os.environ', env) as mock_env:
             datman.xnat.get_auth()
+
+class TestGetConnectionSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_config = Mock(spec=Config)
+
+    def test_returns_no_settings_when_config_defines_none(self):
+        self.mock_config.get_key.side_effect = lambda key: {}[key]
+
+        assert datman.xnat.get_connection_settings(self.mock_config) == {}
+
+    def test_converts_settings_found_in_config(self):
+        values = {'XNAT_POOL_SIZE': '16', 'XNAT_RETRIES': 3,
+                  'XNAT_RETRY_BACKOFF': '0.25'}
+        self.mock_config.get_key.side_effect = lambda key: values[key]
+
+        settings = datman.xnat.get_connection_settings(self.mock_config)
+
+        assert settings == {'pool_size': 16, 'max_retries': 3,
+                            'retry_backoff': 0.25}
+
+class TestRenewXnatSession(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(datman.xnat.xnat, 'get_xnat_session'):
+            self.xnat = datman.xnat.xnat('https://xnat.example.com', 'user',
+                                         'password')
+        self.xnat.get_xnat_session = Mock()
+        self.xnat._session_id = 'current'
+
+    def test_renews_expired_session(self):
+        self.xnat._renew_xnat_session('current')
+
+        assert self.xnat.get_xnat_session.call_count == 1
+
+    def test_doesnt_renew_session_already_replaced_by_another_request(self):
+        self.xnat._renew_xnat_session('expired')
+
+        assert self.xnat.get_xnat_session.call_count == 0
+
+    def test_file_body_is_sent_again_after_session_is_renewed(self):
+        bodies = []
+
+        def read_body(method, url, data=None, **kwargs):
+            bodies.append(data.read())
+            return FakeResponse(401 if len(bodies) == 1 else 200, [])
+
+        self.xnat.session = Mock()
+        self.xnat.session.request.side_effect = read_body
+
+        response = self.xnat._request('post', 'https://xnat.example.com/data',
+                                      data=io.BytesIO(b'dicoms'))
+
+        assert response.status_code == 200
+        assert bodies == [b'dicoms', b'dicoms']
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, chunks, fail=False, headers=None):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.fail = fail
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def iter_content(self, size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.fail:
+            raise requests.exceptions.ChunkedEncodingError('Dropped')
+
+@patch('time.sleep')
+class TestGetXnatStream(unittest.TestCase):
+
+    url = 'https://xnat.example.com/data/file'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, 'download')
+        with patch.object(datman.xnat.xnat, 'get_xnat_session'):
+            self.xnat = datman.xnat.xnat(self.url, 'user', 'password')
+        self.xnat.session = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _read_dest(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def _write_part(self, contents, validator=None):
+        with open(self.dest + '.part', 'wb') as part:
+            part.write(contents)
+        if validator:
+            with open(self.dest + '.part.validator', 'w') as out:
+                out.write(validator)
+
+    def test_resumes_interrupted_download_from_end_of_part_file(self, mock_sleep):
+        self.xnat.session.request.side_effect = [
+                FakeResponse(200, [b'abc'], fail=True,
+                             headers={'ETag': '"abc"'}),
+                FakeResponse(206, [b'def'])]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abcdef'
+        resume_headers = self.xnat.session.request.call_args_list[1][1]['headers']
+        assert resume_headers == {'Range': 'bytes=3-', 'If-Range': '"abc"'}
+        assert not os.path.exists(self.dest + '.part')
+        assert not os.path.exists(self.dest + '.part.validator')
+
+    def test_resumes_part_file_of_earlier_run_if_it_has_a_validator(self,
+                                                                     mock_sleep):
+        self._write_part(b'abc', validator='Tue, 01 Jan 2019 00:00:00 GMT')
+        self.xnat.session.request.side_effect = [FakeResponse(206, [b'def'])]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abcdef'
+        headers = self.xnat.session.request.call_args[1]['headers']
+        assert headers == {'Range': 'bytes=3-',
+                           'If-Range': 'Tue, 01 Jan 2019 00:00:00 GMT'}
+
+    def test_discards_part_file_of_earlier_run_without_validator(self,
+                                                                 mock_sleep):
+        self._write_part(b'stale')
+        self.xnat.session.request.side_effect = [FakeResponse(200, [b'abc'])]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abc'
+        assert self.xnat.session.request.call_args[1]['headers'] is None
+
+    def test_restarts_download_when_file_changed_since_part_was_written(
+            self, mock_sleep):
+        self._write_part(b'old', validator='"v1"')
+        self.xnat.session.request.side_effect = [
+                FakeResponse(200, [b'abcdef'], headers={'ETag': '"v2"'})]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abcdef'
+        assert not os.path.exists(self.dest + '.part.validator')
+
+    def test_restarts_download_when_server_ignores_range(self, mock_sleep):
+        self.xnat.session.request.side_effect = [
+                FakeResponse(200, [b'abc'], fail=True),
+                FakeResponse(200, [b'abcdef'])]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abcdef'
+
+    @raises(requests.exceptions.ChunkedEncodingError)
+    def test_gives_up_after_retries_and_keeps_part_file(self, mock_sleep):
+        self.xnat.session.request.side_effect = [
+                FakeResponse(200, [b'a'], fail=True) for _ in range(3)]
+
+        try:
+            self.xnat._get_xnat_stream(self.url, self.dest, retries=2)
+        finally:
+            assert not os.path.exists(self.dest)
+            assert os.path.exists(self.dest + '.part')
+
+    def test_returns_result_of_retry_after_gateway_timeout(self, mock_sleep):
+        self.xnat.session.request.side_effect = [FakeResponse(504, []),
+                                             FakeResponse(200, [b'abc'])]
+
+        self.xnat._get_xnat_stream(self.url, self.dest)
+
+        assert self._read_dest() == b'abc'
+
+    @raises(datman.xnat.XnatException)
+    def test_raises_XnatException_on_md5_mismatch(self, mock_sleep):
+        self.xnat.session.request.side_effect = [FakeResponse(200, [b'abc'])]
+
+        try:
+            self.xnat._get_xnat_stream(self.url, self.dest, md5='0' * 32)
+        finally:
+            assert not os.path.exists(self.dest)
+            assert not os.path.exists(self.dest + '.part')
+
+    def test_accepts_matching_size_and_md5(self, mock_sleep):
+        self.xnat.session.request.side_effect = [FakeResponse(200, [b'abc'])]
+        md5 = hashlib.md5(b'abc').hexdigest()
+
+        self.xnat._get_xnat_stream(self.url, self.dest, size=3, md5=md5)
+
+        assert self._read_dest() == b'abc'
+
+class TestAsyncXnat(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = Mock(spec=datman.xnat.xnat)
+        self.client = datman.xnat.AsyncXnat(self.connection, max_concurrent=2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def test_methods_return_same_results_as_connection(self):
+        self.connection.get_experiments.side_effect = lambda study, session: \
+                [{'label': session}]
+
+        async def crawl():
+            return await asyncio.gather(
+                    self.client.get_experiments('STUDY', 'SESSION1'),
+                    self.client.get_experiments('STUDY', 'SESSION2'))
+
+        result = self.loop.run_until_complete(crawl())
+
+        assert result == [[{'label': 'SESSION1'}], [{'label': 'SESSION2'}]]
+
+    @raises(datman.xnat.XnatException)
+    def test_raises_same_exceptions_as_connection(self):
+        self.connection.get_sessions.side_effect = datman.xnat.XnatException(
+                'Invalid xnat project')
+
+        self.loop.run_until_complete(self.client.get_sessions('STUDY'))
+
+def wait_for_others(barrier, result):
+    """Returns result once every thread sharing barrier has called this, so a
+    test only passes if the calls run at the same time"""
+    barrier.wait()
+    return result
+
+class TestGatherQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = Mock(spec=datman.xnat.xnat)
+
+    def test_returns_results_in_order_with_exceptions_of_failed_queries(self):
+        error = datman.xnat.XnatException('Invalid xnat project')
+        self.connection.get_sessions.side_effect = lambda project: \
+                [project] if project != 'BAD' else self._raise(error)
+
+        results = datman.xnat.gather_queries(self.connection, [
+                ('get_sessions', ('STUDY1',)),
+                ('get_sessions', ('BAD',)),
+                ('get_sessions', ('STUDY2',))])
+
+        assert results == [['STUDY1'], error, ['STUDY2']]
+
+    def test_runs_queries_at_the_same_time(self):
+        barrier = threading.Barrier(3, timeout=5)
+        self.connection.get_sessions.side_effect = lambda project: \
+                wait_for_others(barrier, [project])
+
+        results = datman.xnat.gather_queries(self.connection,
+                [('get_sessions', (str(num),)) for num in range(3)])
+
+        assert results == [['0'], ['1'], ['2']]
+
+    def _raise(self, error):
+        raise error
+
+class TestSessionGetResources(unittest.TestCase):
+
+    def make_session(self, resource_ids):
+        session = datman.xnat.Session.__new__(datman.xnat.Session)
+        session.project = 'STUDY'
+        session.name = 'STUDY_CMH_0001_01'
+        session.experiment_label = 'STUDY_CMH_0001_01_01'
+        session.resource_IDs = resource_ids
+        return session
+
+    def test_fetches_resource_lists_at_the_same_time(self):
+        barrier = threading.Barrier(2, timeout=5)
+        connection = Mock(spec=datman.xnat.xnat)
+        connection.get_resource_list.side_effect = \
+                lambda project, name, label, r_id: wait_for_others(
+                        barrier, [{'URI': '{}/notes.txt'.format(r_id)}])
+        session = self.make_session({'MISC': '1', 'BEHAV': '2'})
+
+        resources = session.get_resources(connection)
+
+        assert sorted(resources) == ['1/notes.txt', '2/notes.txt']
+
+    @raises(datman.xnat.XnatException)
+    def test_raises_exception_of_failed_resource_list(self):
+        connection = Mock(spec=datman.xnat.xnat)
+        connection.get_resource_list.side_effect = datman.xnat.XnatException(
+                'Failed')
+
+        self.make_session({'MISC': '1'}).get_resources(connection)
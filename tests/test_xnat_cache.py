@@ -0,0 +1,101 @@
+import sys
+import unittest
+import logging
+
+from mock import Mock, patch
+
+if sys.version_info < (3,):
+    raise unittest.SkipTest('datman.xnat needs python 3')
+
+import datman.xnat
+import datman.xnat_cache
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+SERVER = 'https://xnat.example.com'
+PROJECT_URL = SERVER + '/data/archive/projects/STUDY?format=json'
+SUBJECT_URL = SERVER + '/data/archive/projects/STUDY/subjects/STUDY_CMH_0001'
+EXPERIMENT_URL = SUBJECT_URL + '/experiments/STUDY_CMH_0001_01?format=json'
+OTHER_URL = SERVER + '/data/archive/projects/OTHER/subjects/OTHER_CMH_0001'
+
+def make_response(status_code=200, text='{"items": [1]}', headers=None):
+    response = Mock()
+    response.status_code = status_code
+    response.text = text
+    response.headers = headers or {}
+    return response
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = datman.xnat_cache.ResponseCache(default_ttl=60)
+        for url in [PROJECT_URL, SUBJECT_URL, EXPERIMENT_URL, OTHER_URL]:
+            self.cache.store(url, make_response())
+
+    def test_stored_responses_are_fresh_hits(self):
+        cached = self.cache.lookup(EXPERIMENT_URL)
+
+        assert cached.is_fresh()
+        assert cached.json() == {'items': [1]}
+        assert self.cache.stats() == {'hits': 1, 'misses': 4,
+                                      'revalidated': 0}
+
+    def test_uses_ttl_of_first_matching_pattern(self):
+        assert self.cache.get_ttl(PROJECT_URL) == 3600
+        assert self.cache.get_ttl(EXPERIMENT_URL) == 60
+
+    def test_change_invalidates_containing_and_contained_objects(self):
+        self.cache.invalidate(SERVER + '/REST/projects/STUDY/subjects/'
+                              'STUDY_CMH_0001')
+
+        assert self.cache.lookup(PROJECT_URL) is None
+        assert self.cache.lookup(SUBJECT_URL) is None
+        assert self.cache.lookup(EXPERIMENT_URL) is None
+        assert self.cache.lookup(OTHER_URL) is not None
+
+    def test_change_outside_a_project_clears_cache(self):
+        self.cache.invalidate(SERVER + '/data/services/import?dest=/prearchive')
+
+        assert self.cache.lookup(OTHER_URL) is None
+
+class TestXnatQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = datman.xnat_cache.ResponseCache(default_ttl=60)
+        with patch.object(datman.xnat.xnat, 'get_xnat_session'):
+            self.xnat = datman.xnat.xnat(SERVER, 'user', 'password',
+                                         cache=self.cache)
+        self.xnat.session = Mock()
+
+    def test_repeated_query_is_answered_from_cache(self):
+        self.xnat.session.request.return_value = make_response()
+
+        first = self.xnat._make_xnat_query(EXPERIMENT_URL)
+        second = self.xnat._make_xnat_query(EXPERIMENT_URL)
+
+        assert first == second == {'items': [1]}
+        assert self.xnat.session.request.call_count == 1
+
+    def test_expired_response_is_revalidated_with_etag(self):
+        self.xnat.session.request.side_effect = [
+                make_response(headers={'ETag': '"abc"'}),
+                make_response(status_code=304, text='')]
+        self.xnat._make_xnat_query(EXPERIMENT_URL)
+        self.cache.lookup(EXPERIMENT_URL).expires = 0
+
+        result = self.xnat._make_xnat_query(EXPERIMENT_URL)
+
+        headers = self.xnat.session.request.call_args[1]['headers']
+        assert headers == {'If-None-Match': '"abc"'}
+        assert result == {'items': [1]}
+        assert self.cache.revalidated == 1
+
+    def test_put_invalidates_cached_response(self):
+        self.xnat.session.request.return_value = make_response()
+        self.xnat._make_xnat_query(EXPERIMENT_URL)
+
+        self.xnat._make_xnat_put(SUBJECT_URL)
+        self.xnat._make_xnat_query(EXPERIMENT_URL)
+
+        assert self.xnat.session.request.call_count == 3